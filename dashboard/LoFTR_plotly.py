@@ -11,6 +11,10 @@ import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import matplotlib.patheffects as PathEffects
 import warnings
+from decoding import decode_gray_reduced
+from export import set_backend, weights_digest
+from precision import set_precision
+from instrumentation import Tracer
 warnings.filterwarnings("ignore")
 
 def readb64(uri):
@@ -49,41 +53,63 @@ def load_torch_image(imgpath, device, res=840):
     img = K.color.bgr_to_rgb(img)
     return img.to(device)
 
-def single_loftr_figure(img0_pth, img1_pth, alpha = 1, threshold = 0, lines = True, dpi = 150, res=840, where="outdoor"):
-    # Determine if a GPU is available, otherwise use CPU
-    print("selecting device")
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    # Initialize LoFTR and load the outdoor weights
-    print("initializing")
-    matcher = KF.LoFTR(pretrained=None)
-
-    if where == "outdoor":
-        matcher.load_state_dict(torch.load("weights/outdoor_ds.ckpt")['state_dict'])
-    elif where == "indoor":
-        matcher.load_state_dict(torch.load("weights/indoor_ds_new.ckpt")['state_dict'])
-    else:
-        raise Exception("No weights for LoFTR defined!")
-
-    matcher = matcher.to(device).eval()
+def load_gray_torch_image(imgpath, device, res=840):
+    # Grayscale tensor for LoFTR, decoded straight to grayscale at a reduced JPEG scale (see decoding.py). Faster than
+    # load_torch_image for large photos, with slightly different pixels.
+    try:
+        source = base64.b64decode(imgpath.split(',')[1])
+        print("custom image recognized!")
+    except:
+        source = imgpath
+        print("image path recognized!")
+    img = torch.from_numpy(decode_gray_reduced(source, res))[None, None].float() / 255.
+    return img.to(device)
+
+def single_loftr_figure(img0_pth, img1_pth, alpha = 1, threshold = 0, lines = True, dpi = 150, res=840, where="outdoor",
+                        precision="float32", backend="eager", trace_path=None, reduced_decode=False):
+    # Every step is timed and printed when it is done; with trace_path the timings are also saved as a trace file.
+    # reduced_decode loads the images for LoFTR with load_gray_torch_image instead of load_torch_image.
+    tracer = Tracer(log=True)
+    with tracer.span("initialize"):
+        # Determine if a GPU is available, otherwise use CPU
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        # Initialize LoFTR and load the outdoor weights
+        matcher = KF.LoFTR(pretrained=None)
+
+        if where == "outdoor":
+            matcher.load_state_dict(torch.load("weights/outdoor_ds.ckpt")['state_dict'])
+        elif where == "indoor":
+            matcher.load_state_dict(torch.load("weights/indoor_ds_new.ckpt")['state_dict'])
+        else:
+            raise Exception("No weights for LoFTR defined!")
+
+        matcher = matcher.to(device).eval()
+        key = f"{weights_digest(matcher)}-{precision}"
+        # backend="torchscript" reuses the traced graphs in exported/ (see export.py)
+        matcher = set_backend(set_precision(matcher, precision), backend, key)
     # Run LoFTR
 
-    print("loading images")
-    img0_torch = load_torch_image(img0_pth, device, res)
-    img1_torch = load_torch_image(img1_pth, device, res)
-    print("loading background images")
-    img0 = load_image(img0_pth, res)
-    img1 = load_image(img1_pth, res)
+    with tracer.span("load"):
+        if reduced_decode:
+            gray0 = load_gray_torch_image(img0_pth, device, res)
+            gray1 = load_gray_torch_image(img1_pth, device, res)
+        else:
+            gray0 = K.color.rgb_to_grayscale(load_torch_image(img0_pth, device, res))
+            gray1 = K.color.rgb_to_grayscale(load_torch_image(img1_pth, device, res))
+    with tracer.span("load background"):
+        img0 = load_image(img0_pth, res)
+        img1 = load_image(img1_pth, res)
 
 
 
-    batch = {"image0": K.color.rgb_to_grayscale(img0_torch), 
-            "image1": K.color.rgb_to_grayscale(img1_torch)}
-    print("matching images")
-    with torch.no_grad():
+    batch = {"image0": gray0, 
+            "image1": gray1}
+    with tracer.span("match"), torch.no_grad():
         matcher(batch)
         mkpts0 = batch['mkpts0_f'].cpu().numpy()
         mkpts1 = batch['mkpts1_f'].cpu().numpy()
         mconf = batch['mconf'].cpu().numpy()
+    tracer.count("matches", len(mkpts0))
     
     results = pd.DataFrame({'mkpts0': mkpts0.tolist(), 'mkpts1': mkpts1.tolist(), 'mconf': mconf.tolist()}) 
 
@@ -92,17 +118,18 @@ def single_loftr_figure(img0_pth, img1_pth, alpha = 1, threshold = 0, lines = Tr
     text = [
     'LoFTR',
     'Matches: {}'.format(len(results.query(f'mconf > {threshold}')))]
-    print("plotting images")
-    plt.switch_backend('Agg')
-    fig = plot_matches(img0, img1, np.array(results.query(f'mconf > {threshold}').mkpts0.values.tolist()), 
-                                        np.array(results.query(f'mconf > {threshold}').mkpts1.values.tolist()), color, text, alpha, lines, dpi)
-    print("initializing buf")
-    buf = io.BytesIO() 
-    print("saving buf")
-    plt.savefig(buf, format = "png") # save to the above file object
+    with tracer.span("plot"):
+        plt.switch_backend('Agg')
+        fig = plot_matches(img0, img1, np.array(results.query(f'mconf > {threshold}').mkpts0.values.tolist()), 
+                                            np.array(results.query(f'mconf > {threshold}').mkpts1.values.tolist()), color, text, alpha, lines, dpi)
+    with tracer.span("save png"):
+        buf = io.BytesIO() 
+        plt.savefig(buf, format = "png") # save to the above file object
     #print("closing pyplot")
     #plt.close()
-    print("done")
+    print(tracer.summary())
+    if trace_path is not None:
+        tracer.save(trace_path)
     return buf
 
 def plot_matches(
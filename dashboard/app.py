@@ -6,6 +6,7 @@ from dash.dependencies import Input,Output,State
 from dash.exceptions import PreventUpdate
 # own .py files
 import viz_utilities as vu
+import calibration_store as cs
 import LoFTR_plotly as lp
 
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
@@ -38,6 +39,7 @@ DEBUG = False # enables verbose debugging in console and on the dashboard
 EMPTYFIGURE = vu.empty_figure() # white placeholder figure
 
 pairings, cal, scalings = vu.load_pairs_and_cal(ALLSCENES,INPUT_DIR)
+calstore = cs.CalibrationStore(INPUT_DIR) # parsed K/R/T arrays per scene, cached next to calibration.csv
 
 # default uploadbutton Div Object
 uploadbutton = html.Div(
@@ -80,7 +82,7 @@ except:
     recreateflag = input("Type y to proceed: ")
     if recreateflag != ("y" or "Y"):
         raise Exception("Failed to load data.")
-    figlist = [vu.plotter(scene, cal, scalings=scalings) for scene in ALLSCENES]
+    figlist = [vu.plotter(scene, cal, scalings=scalings, store=calstore) for scene in ALLSCENES]
     print("writing new json files")
     figures = dict(zip(ALLSCENES,figlist))
     for scene, figure in zip(ALLSCENES,figlist):
@@ -143,6 +145,23 @@ app.layout = html.Div(
                                                 960:"",
                                                 1200:"1200 (slow)"}, 
                                                 tooltip={"placement":"bottom","always_visible":True}),
+                                        html.Label("Precision"),
+                                        dcc.RadioItems(
+                                            id="precision_radio", 
+                                            options=[{"label":"float32","value":"float32"},{"label":"bfloat16","value":"bfloat16"},{"label":"int8 (CPU only)","value":"int8"}],
+                                            value="float32", 
+                                            inline=True),
+                                        html.Label("Backend"),
+                                        dcc.RadioItems(
+                                            id="backend_radio", 
+                                            options=[{"label":"Eager","value":"eager"},{"label":"TorchScript","value":"torchscript"}],
+                                            value="eager", 
+                                            inline=True),
+                                        dcc.Checklist(
+                                            id="reduced_decode_check", 
+                                            options=[{"label":"Fast grayscale decoding (slightly different pixels)","value":"reduced"}],
+                                            value=[], 
+                                            inline=True),
                                         html.Button(
                                             children="reset selection", 
                                             id="resetbutton", 
@@ -234,6 +253,23 @@ app.layout = html.Div(
                                                 960:"",
                                                 1200:"1200 (slow)"}, 
                                             tooltip={"placement":"bottom","always_visible":True}),
+                                        html.Label("Precision"),
+                                        dcc.RadioItems(
+                                            id="precision_radio_c", 
+                                            options=[{"label":"float32","value":"float32"},{"label":"bfloat16","value":"bfloat16"},{"label":"int8 (CPU only)","value":"int8"}],
+                                            value="float32", 
+                                            inline=True),
+                                        html.Label("Backend"),
+                                        dcc.RadioItems(
+                                            id="backend_radio_c", 
+                                            options=[{"label":"Eager","value":"eager"},{"label":"TorchScript","value":"torchscript"}],
+                                            value="eager", 
+                                            inline=True),
+                                        dcc.Checklist(
+                                            id="reduced_decode_check_c", 
+                                            options=[{"label":"Fast grayscale decoding (slightly different pixels)","value":"reduced"}],
+                                            value=[], 
+                                            inline=True),
                                         html.Button(
                                             children="reset selection", 
                                             id="resetbutton_c", 
@@ -354,9 +390,12 @@ def return_clicked_id(clickData, reset, selections, scene):
     State("selectionbuffer", "data"),       # Check currently selected input images for LoFTR
     State("threshhold_slider", "value"),    # Check currently selected confidence threshhold to filter image matchings
     State("alpha_slider", "value"),         # Check currently selected line alpha to make the connecting lines more/less rtansparent
-    State("scale_slider", "value")          # Check currently selected image scale for LoFTR to compute. larger images deliver better results, but take longer to compute
+    State("scale_slider", "value"),         # Check currently selected image scale for LoFTR to compute. larger images deliver better results, but take longer to compute
+    State("precision_radio", "value"),      # Check currently selected inference precision
+    State("backend_radio", "value"),        # Check currently selected backend (eager or traced graphs)
+    State("reduced_decode_check", "value")  # Check whether the images are decoded straight to grayscale at a reduced scale
 )
-def plot_imagepair(calculate, scene, selections,threshhold,alpha,scale):
+def plot_imagepair(calculate, scene, selections,threshhold,alpha,scale,precision,backend,reduced_decode):
     # calculates LoFTR image-matchings and visualizes them. plots are buffered as png and base64 encoded to display in an html.Img object.
     if len(selections) != 2 or calculate == 0 or scene == None: # prevent update on initial callback trigger, or if insufficient scenes were selected
         raise PreventUpdate
@@ -366,7 +405,8 @@ def plot_imagepair(calculate, scene, selections,threshhold,alpha,scale):
     print(imgpath1)
     print(imgpath2)
     print("buffering image")
-    buf = lp.single_loftr_figure(imgpath1, imgpath2, alpha = alpha, threshold = threshhold, lines = True, dpi = 150 , res=scale)
+    buf = lp.single_loftr_figure(imgpath1, imgpath2, alpha = alpha, threshold = threshhold, lines = True, dpi = 150 , res=scale,
+                                 precision=precision, backend=backend, reduced_decode=bool(reduced_decode))
     print("encoding")
     imgdata = base64.b64encode(buf.getbuffer()).decode("utf8") # encode to html elements
     print("done")
@@ -423,14 +463,18 @@ def upload(contents1=None,contents2=None,reset=0,filename1=None,filename2=None,b
     State("weights_radio","value"),
     State("threshhold_slider_c", "value"),    # Check currently selected confidence threshhold to filter image matchings
     State("alpha_slider_c", "value"),         # Check currently selected line alpha to make the connecting lines more/less rtansparent
-    State("scale_slider_c", "value")          # Check currently selected image scale for LoFTR to compute. larger images deliver better results, but take longer to compute
+    State("scale_slider_c", "value"),         # Check currently selected image scale for LoFTR to compute. larger images deliver better results, but take longer to compute
+    State("precision_radio_c", "value"),      # Check currently selected inference precision
+    State("backend_radio_c", "value"),        # Check currently selected backend (eager or traced graphs)
+    State("reduced_decode_check_c", "value")  # Check whether the images are decoded straight to grayscale at a reduced scale
 )
-def plot_imagepair_c(calculate, images, weights, threshhold, alpha, scale):
+def plot_imagepair_c(calculate, images, weights, threshhold, alpha, scale, precision, backend, reduced_decode):
     #modified version of plot_imagepair, capable of handling custom uploaded images
     if len(images) != 2 or calculate == 0: # prevent update on initial callback trigger, or if insufficient scenes were selected
         raise PreventUpdate
     print(f"buffering image")
-    buf = lp.single_loftr_figure(images[0], images[1], alpha = alpha, threshold = threshhold, lines = True, dpi = 150 , res=scale, where=weights)
+    buf = lp.single_loftr_figure(images[0], images[1], alpha = alpha, threshold = threshhold, lines = True, dpi = 150 , res=scale, where=weights,
+                                 precision=precision, backend=backend, reduced_decode=bool(reduced_decode))
     print("encoding")
     imgdata = base64.b64encode(buf.getbuffer()).decode("utf8") # encode to html elements
     print("done")
@@ -0,0 +1,192 @@
+import os
+import csv
+import json
+import numpy as np
+
+# Parsed ground truth of the train scenes, for validation.py and the dashboard.
+# calibration.csv stores K, R and T of every image as space-separated strings. A scene is parsed once into contiguous
+# (N, 3, 3) K and R and (N, 3) T arrays indexed by image id, and cached as a binary file that later runs memory-map
+# instead of parsing the CSV again. The cache records the size and modification time of the CSV it was built from and
+# is rebuilt when the CSV changes. Within a process, the parsed scenes and scaling factors are kept in memory.
+#
+# Cache file layout (<scene>/calibration.cache, or <cache_dir>/<scene>.calibration.cache):
+#   8 bytes     magic
+#   8 bytes     length of the JSON header (little endian)
+#   header      JSON with the source signature, the image ids and dtype/shape/position of every array
+#   arrays      K, R, T (float64), each aligned to 64 bytes
+
+MAGIC = b'LOFTRCA1'
+ALIGN = 64
+ARRAYS = ['K', 'R', 'T']
+SHAPES = {'K': (3, 3), 'R': (3, 3), 'T': (3,)}
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+def _memmap(path, dtype, shape, offset=0):
+    # np.memmap refuses empty arrays
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def source_signature(path):
+    # Changes whenever the file is rewritten
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def parse_calibration(path):
+    """
+    Parse a calibration.csv with the same float conversion as validation.LoadCalibration.
+
+    Returns:
+        List of image ids, and a dictionary with the stacked 'K', 'R' and 'T' arrays in the same order
+    """
+    image_ids = []
+    values = {name: [] for name in ARRAYS}
+    with open(path, 'r') as f:
+        reader = csv.reader(f, delimiter=',')
+        # Skip header.
+        next(reader, None)
+        for row in reader:
+            image_ids.append(row[0])
+            for name, column in zip(ARRAYS, row[1:4]):
+                values[name].append([float(v) for v in column.split(' ')])
+    arrays = {name: np.array(values[name], dtype=np.float64).reshape((-1,) + SHAPES[name]) for name in ARRAYS}
+    return image_ids, arrays
+
+def write_cache(path, signature, image_ids, arrays):
+    layout = {}
+    position = 0
+    for name in ARRAYS:
+        layout[name] = {'dtype': arrays[name].dtype.str, 'shape': list(arrays[name].shape), 'offset': position}
+        position = _aligned(position + arrays[name].nbytes)
+    header = json.dumps({'version': 1, 'source': signature, 'image_ids': image_ids, 'arrays': layout}).encode()
+    data_start = _aligned(16 + len(header))
+    # Written to a temporary file first, so that a reader never sees a half-written cache.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name in ARRAYS:
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        f.truncate(data_start + position)
+    os.replace(tmp_path, path)
+
+def read_cache(path, signature):
+    # Image ids and memory-mapped arrays of a cache file, or None if it is missing or was built from another CSV
+    try:
+        with open(path, 'rb') as f:
+            if f.read(8) != MAGIC:
+                return None
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len))
+    except (OSError, ValueError):
+        return None
+    if header['source'] != signature:
+        return None
+    data_start = _aligned(16 + header_len)
+    arrays = {name: _memmap(path, spec['dtype'], tuple(spec['shape']), data_start + spec['offset'])
+              for name, spec in header['arrays'].items()}
+    return header['image_ids'], arrays
+
+class SceneCalibration:
+    """
+    K, R and T of all images of a scene, as (N, 3, 3), (N, 3, 3) and (N, 3) arrays in the order of calibration.csv.
+
+    Example:
+        >>> calibration = store.scene('brandenburg_gate')
+        >>> K, R, T = calibration['00883281_9633489441']
+        >>> Rs = calibration.R[calibration.indices(image_ids)]
+    """
+
+    def __init__(self, image_ids, K, R, T):
+        self.image_ids = image_ids
+        self.K, self.R, self.T = K, R, T
+        self._index = {image_id: i for i, image_id in enumerate(image_ids)}
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id):
+        return str(image_id) in self._index
+
+    def index(self, image_id):
+        return self._index[str(image_id)]
+
+    def indices(self, image_ids):
+        return np.array([self._index[str(image_id)] for image_id in image_ids], dtype=np.int64)
+
+    def __getitem__(self, image_id):
+        i = self.index(image_id)
+        return self.K[i], self.R[i], self.T[i]
+
+class CalibrationStore:
+    """
+    Parsed calibration.csv of every scene and the scaling_factors.csv of a train directory.
+
+    Args:
+        input_dir:      Train directory with <scene>/calibration.csv and scaling_factors.csv
+        cache_dir:      Directory of the cache files (default: next to the calibration.csv of every scene). If the
+                        cache cannot be written, the scene is parsed without caching it.
+    """
+
+    def __init__(self, input_dir, cache_dir=None):
+        self.input_dir = input_dir
+        self.cache_dir = cache_dir
+        self._scenes = {}
+        self._scaling = None
+
+    def cache_path(self, scene):
+        if self.cache_dir is None:
+            return os.path.join(self.input_dir, scene, 'calibration.cache')
+        return os.path.join(self.cache_dir, f'{scene}.calibration.cache')
+
+    def load_scene(self, scene, signature):
+        csv_path = os.path.join(self.input_dir, scene, 'calibration.csv')
+        cache_path = self.cache_path(scene)
+        cached = read_cache(cache_path, signature)
+        if cached is not None:
+            image_ids, arrays = cached
+            return SceneCalibration(image_ids, **arrays)
+        image_ids, arrays = parse_calibration(csv_path)
+        try:
+            if self.cache_dir is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            write_cache(cache_path, signature, image_ids, arrays)
+        except OSError:
+            # e.g. a read-only dataset directory
+            pass
+        return SceneCalibration(image_ids, **arrays)
+
+    def scene(self, scene):
+        # SceneCalibration of a scene, re-read if its calibration.csv changed since the last call
+        signature = source_signature(os.path.join(self.input_dir, scene, 'calibration.csv'))
+        if scene not in self._scenes or self._scenes[scene][0] != signature:
+            self._scenes[scene] = (signature, self.load_scene(scene, signature))
+        return self._scenes[scene][1]
+
+    def scaling_factors(self):
+        # Dictionary of scene -> scaling factor, as read by validation.evaluate
+        path = os.path.join(self.input_dir, 'scaling_factors.csv')
+        signature = source_signature(path)
+        if self._scaling is None or self._scaling[0] != signature:
+            scaling_dict = {}
+            with open(path) as f:
+                reader = csv.reader(f, delimiter=',')
+                # Skip header.
+                next(reader, None)
+                for row in reader:
+                    scaling_dict[row[0]] = float(row[1])
+            self._scaling = (signature, scaling_dict)
+        return dict(self._scaling[1])
+
+# One store per train directory and process, shared by all calls of validation.evaluate
+_stores = {}
+
+def get_store(input_dir, cache_dir=None):
+    key = (os.path.abspath(input_dir), cache_dir)
+    if key not in _stores:
+        _stores[key] = CalibrationStore(input_dir, cache_dir)
+    return _stores[key]
@@ -0,0 +1,38 @@
+import io
+import cv2
+import numpy as np
+from PIL import Image
+
+# Reduced-size grayscale decoding, for --reduced-decode of LoFTR.py and the dashboard (dashboard/decoding.py is a copy
+# of this file). JPEGs can be decoded directly at 1/2, 1/4 or 1/8 of their size, which skips most of the decoding
+# work. The pixels differ slightly from decoding in colour at full size and converting to grayscale afterwards.
+REDUCED_GRAYSCALE = [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                     (2, cv2.IMREAD_REDUCED_GRAYSCALE_2), (1, cv2.IMREAD_GRAYSCALE)]
+
+def target_size(height, width, res):
+    # (w, h) of an image of the given size resized to a long side of res
+    scale = res / max(height, width)
+    return int(width * scale), int(height * scale)
+
+def decode_gray_reduced(source, res):
+    """
+    Decode an image straight to grayscale at the smallest JPEG scale that is still at least res on the long side,
+    then resize it to a long side of res.
+
+    Args:
+        source:         Path of the image, or the bytes of the encoded image (e.g. an upload in the dashboard)
+        res:            Long side of the result
+
+    Returns:
+        uint8 array of shape (h, w)
+    """
+    encoded = isinstance(source, bytes)
+    # Only the header is read here
+    with Image.open(io.BytesIO(source) if encoded else source) as img:
+        width, height = img.size
+    flag = next(flag for factor, flag in REDUCED_GRAYSCALE if -(-max(width, height) // factor) >= res or factor == 1)
+    gray = cv2.imdecode(np.frombuffer(source, np.uint8), flag) if encoded else cv2.imread(source, flag)
+    if (gray.shape[0] > gray.shape[1]) != (height > width):
+        # OpenCV applied a rotation from the EXIF orientation
+        width, height = height, width
+    return cv2.resize(gray, target_size(height, width, res))
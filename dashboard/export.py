@@ -0,0 +1,138 @@
+import os
+import hashlib
+import torch
+import torch.nn as nn
+from kornia.geometry.transform import resize
+
+# TorchScript backend of LoFTR. The dense part of the network (backbone, positional encoding and coarse transformer)
+# has fixed tensor shapes for a given input shape and is traced once per shape bucket; the data dependent rest (coarse
+# matching, fine refinement) stays in eager mode. Traced graphs are cached on disk, keyed by the weights, the device
+# and the input shapes, so a new run loads them instead of tracing again.
+
+BACKENDS = ['eager', 'torchscript']
+
+def weights_digest(module):
+    # Short hash of all parameters and buffers of a module
+    digest = hashlib.sha1()
+    for name, tensor in sorted(module.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+class DenseStage(nn.Module):
+    """
+    Backbone, positional encoding and coarse transformer of a kornia LoFTR, as a module with plain tensor in- and
+    outputs that can be traced.
+
+    forward(image0, image1[, mask0, mask1]) returns the transformed coarse features as (N, H/8, W/8, C) and the fine
+    features as (N, C, H/2, W/2) of both images.
+    """
+
+    def __init__(self, matcher, same_shape, masked):
+        super().__init__()
+        self.backbone = matcher.backbone
+        self.pos_encoding = matcher.pos_encoding
+        self.loftr_coarse = matcher.loftr_coarse
+        self.same_shape = same_shape
+        self.masked = masked
+
+    def forward(self, image0, image1, mask0=None, mask1=None):
+        if self.same_shape:
+            feats_c, feats_f = self.backbone(torch.cat([image0, image1], dim=0))
+            (feat_c0, feat_c1), (feat_f0, feat_f1) = feats_c.split(image0.size(0)), feats_f.split(image0.size(0))
+        else:
+            (feat_c0, feat_f0), (feat_c1, feat_f1) = self.backbone(image0), self.backbone(image1)
+        mask_c0 = mask_c1 = None
+        if self.masked:
+            mask_c0 = resize(mask0, feat_c0.shape[2:], interpolation='nearest').flatten(-2)
+            mask_c1 = resize(mask1, feat_c1.shape[2:], interpolation='nearest').flatten(-2)
+        feat_c0 = self.pos_encoding(feat_c0).permute(0, 2, 3, 1)
+        feat_c1 = self.pos_encoding(feat_c1).permute(0, 2, 3, 1)
+        shape_c0, shape_c1 = feat_c0.shape, feat_c1.shape
+        feat_c0, feat_c1 = self.loftr_coarse(feat_c0.reshape(shape_c0[0], -1, shape_c0[3]),
+                                             feat_c1.reshape(shape_c1[0], -1, shape_c1[3]), mask_c0, mask_c1)
+        return feat_c0.reshape(shape_c0), feat_c1.reshape(shape_c1), feat_f0, feat_f1
+
+class TracedLoFTR(nn.Module):
+    """
+    Drop-in replacement of a kornia LoFTR that runs the dense stage as a TorchScript graph.
+
+    Args:
+        matcher:        kornia LoFTR in eval mode, on its final device
+        key:            Identifies the weights (and precision) of matcher in the cache file names
+        cache_dir:      Directory of the traced graphs
+    """
+
+    def __init__(self, matcher, key, cache_dir='exported'):
+        super().__init__()
+        self.matcher = matcher
+        self.key = key
+        self.cache_dir = cache_dir
+        self.device = next(matcher.parameters()).device
+        self.graphs = {}
+
+    def graph_path(self, inputs):
+        shapes = '-'.join('x'.join(str(s) for s in t.shape) for t in inputs)
+        return os.path.join(self.cache_dir, f'loftr-{self.key}-{self.device.type}-{shapes}.pt')
+
+    def dense_stage(self, inputs):
+        # Graph for the shapes of inputs: from memory, from the disk cache, or traced and saved
+        path = self.graph_path(inputs)
+        if path not in self.graphs:
+            if os.path.exists(path):
+                self.graphs[path] = torch.jit.load(path, map_location=self.device)
+            else:
+                module = DenseStage(self.matcher, inputs[0].shape == inputs[1].shape, len(inputs) == 4).eval()
+                with torch.no_grad():
+                    # Freezing inlines the weights as constants and folds the batch norms into the convolutions.
+                    graph = torch.jit.freeze(torch.jit.trace(module, inputs, check_trace=False))
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # Write to a temporary file first, so concurrent workers never load a half written graph.
+                torch.jit.save(graph, f'{path}.{os.getpid()}.tmp')
+                os.replace(f'{path}.{os.getpid()}.tmp', path)
+                self.graphs[path] = graph
+        return self.graphs[path]
+
+    def prepare(self, batch_size, shape0, shape1, masked=False):
+        # Trace (or load) the graph of a shape bucket ahead of time
+        inputs = (torch.zeros(batch_size, 1, *shape0, device=self.device),
+                  torch.zeros(batch_size, 1, *shape1, device=self.device))
+        if masked:
+            inputs += (torch.ones(batch_size, *shape0, device=self.device),
+                       torch.ones(batch_size, *shape1, device=self.device))
+        self.dense_stage(inputs)
+
+    def forward(self, data):
+        # Same steps and outputs as kornia's LoFTR.forward
+        matcher = self.matcher
+        data.update({'bs': data['image0'].size(0),
+                     'hw0_i': data['image0'].shape[2:], 'hw1_i': data['image1'].shape[2:]})
+        inputs = (data['image0'], data['image1'])
+        if 'mask0' in data:
+            inputs += (data['mask0'], data['mask1'])
+        feat_c0, feat_c1, feat_f0, feat_f1 = self.dense_stage(inputs)(*inputs)
+        data.update({'hw0_c': feat_c0.shape[1:3], 'hw1_c': feat_c1.shape[1:3],
+                     'hw0_f': feat_f0.shape[2:], 'hw1_f': feat_f1.shape[2:]})
+        feat_c0 = feat_c0.reshape(feat_c0.size(0), -1, feat_c0.size(3))
+        feat_c1 = feat_c1.reshape(feat_c1.size(0), -1, feat_c1.size(3))
+
+        mask_c0 = mask_c1 = None
+        if 'mask0' in data:
+            mask_c0 = resize(data['mask0'], data['hw0_c'], interpolation='nearest').flatten(-2)
+            mask_c1 = resize(data['mask1'], data['hw1_c'], interpolation='nearest').flatten(-2)
+        matcher.coarse_matching(feat_c0, feat_c1, data, mask_c0=mask_c0, mask_c1=mask_c1)
+
+        feat_f0_unfold, feat_f1_unfold = matcher.fine_preprocess(feat_f0, feat_f1, feat_c0, feat_c1, data)
+        if feat_f0_unfold.size(0) != 0:
+            feat_f0_unfold, feat_f1_unfold = matcher.loftr_fine(feat_f0_unfold, feat_f1_unfold)
+        matcher.fine_matching(feat_f0_unfold, feat_f1_unfold, data)
+        return {'keypoints0': data['mkpts0_f'], 'keypoints1': data['mkpts1_f'],
+                'confidence': data['mconf'], 'batch_indexes': data['b_ids']}
+
+def set_backend(matcher, backend='eager', key='', cache_dir='exported'):
+    # Wrap a LoFTR matcher for the given backend (one of BACKENDS)
+    if backend == 'eager':
+        return matcher
+    if backend == 'torchscript':
+        return TracedLoFTR(matcher, key, cache_dir)
+    raise ValueError(f'Unknown backend: {backend}')
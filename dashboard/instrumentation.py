@@ -0,0 +1,61 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Same timers and counters as models/LoFTR/instrumentation.py, for single_loftr_figure. Spans can be printed as they
+# finish and saved as a trace file in the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev).
+
+class Tracer:
+    """
+    Collects spans and counters.
+
+    Args:
+        log:            Print every finished span, for interactive use
+    """
+
+    def __init__(self, log=False):
+        self.log = log
+        self.events = []
+        self.totals = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        # Times the body of the with statement
+        start_time, start = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start_time, time.perf_counter() - start, **args)
+
+    def record(self, name, start_time, seconds, **args):
+        event = {'name': name, 'ph': 'X', 'ts': start_time * 1e6, 'dur': seconds * 1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        with self._lock:
+            self.events.append(event)
+            count, total = self.totals.get(name, (0, 0.))
+            self.totals[name] = (count + 1, total + seconds)
+        if self.log:
+            print(f'{name}: {1000 * seconds:.1f} ms')
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.events.append({'name': name, 'ph': 'C', 'ts': time.time() * 1e6, 'pid': os.getpid(),
+                                'args': {name: self.counters[name]}})
+
+    def save(self, path):
+        with self._lock:
+            trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+
+    def summary(self):
+        lines = [f"{'span':<20}{'count':>8}{'total [s]':>11}{'mean [ms]':>11}"]
+        for name, (count, total) in self.totals.items():
+            lines.append(f'{name:<20}{count:>8}{total:>11.2f}{1000 * total / count:>11.2f}')
+        lines += [f'{name}: {value}' for name, value in self.counters.items()]
+        return '\n'.join(lines)
@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+
+# Reduced-precision inference modes of LoFTR for CPU-only machines.
+#   float32     Unchanged model
+#   bfloat16    The backbone and both transformers run under bfloat16 autocast. Their outputs are cast back to
+#               float32, so the coarse matching and the keypoint coordinates keep full precision.
+#   int8        Dynamic int8 quantization of the linear layers of both transformers (weights stored as int8,
+#               activations quantized on the fly). CPU only.
+
+PRECISIONS = ['float32', 'bfloat16', 'int8']
+
+# The compute-heavy submodules of kornia's LoFTR
+AUTOCAST_MODULES = ['backbone', 'loftr_coarse', 'loftr_fine']
+TRANSFORMER_MODULES = ['loftr_coarse', 'loftr_fine']
+
+def _to_float(output):
+    if torch.is_tensor(output):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, (tuple, list)):
+        return type(output)(_to_float(o) for o in output)
+    return output
+
+class Autocast(nn.Module):
+    # Runs the wrapped module under autocast and returns float32 outputs.
+
+    def __init__(self, module, dtype=torch.bfloat16):
+        super().__init__()
+        self.module = module
+        self.dtype = dtype
+
+    def forward(self, *args, **kwargs):
+        device_type = next(self.module.parameters()).device.type
+        with torch.autocast(device_type=device_type, dtype=self.dtype):
+            return _to_float(self.module(*args, **kwargs))
+
+def set_precision(matcher, precision='float32'):
+    """
+    Switch a LoFTR matcher (in eval mode, on its final device) to one of PRECISIONS.
+
+    Returns:
+        The matcher, modified in place
+    """
+    if precision == 'float32':
+        return matcher
+    if precision == 'bfloat16':
+        for name in AUTOCAST_MODULES:
+            setattr(matcher, name, Autocast(getattr(matcher, name)))
+        return matcher
+    if precision == 'int8':
+        if next(matcher.parameters()).device.type != 'cpu':
+            raise ValueError('int8 quantization is only available for CPU inference')
+        for name in TRANSFORMER_MODULES:
+            setattr(matcher, name, torch.ao.quantization.quantize_dynamic(getattr(matcher, name), {nn.Linear},
+                                                                          dtype=torch.qint8))
+        return matcher
+    raise ValueError(f'Unknown precision: {precision}')
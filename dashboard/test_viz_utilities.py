@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('plotly')
+import viz_utilities as vu
+from calibration_store import CalibrationStore
+
+# The camera plot of selected images has to show every image id at the position of its own calibration, whatever the
+# order of the ids, with the calibration from the DataFrame and from the calibration store alike.
+
+SCENE = 'test_scene'
+IMAGE_IDS = ['00883281_9633489441', '01069370_6101291096', '01311237_7536584520', '02204447_2593394853',
+             '03003883_5785829839']
+SCALING = 2.
+
+def write_train_dir(train_dir):
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.join(train_dir, SCENE))
+    with open(os.path.join(train_dir, SCENE, 'calibration.csv'), 'w') as f:
+        f.write('image_id,camera_intrinsics,rotation_matrix,translation_vector\n')
+        for image_id in IMAGE_IDS:
+            R, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+            T = rng.normal(size=3)
+            f.write(f"{image_id},1000.0 0.0 400.0 0.0 1000.0 300.0 0.0 0.0 1.0,"
+                    f"{' '.join(str(v) for v in R.flatten())},{' '.join(str(v) for v in T)}\n")
+    with open(os.path.join(train_dir, SCENE, 'pair_covisibility.csv'), 'w') as f:
+        f.write('pair,covisibility,fundamental_matrix\n')
+    with open(os.path.join(train_dir, 'scaling_factors.csv'), 'w') as f:
+        f.write(f'scene,scaling_factor\n{SCENE},{SCALING}\n')
+
+def camera_x(cal, image_id):
+    row = cal[cal['image_id'] == image_id].iloc[0]
+    R = np.array(row['rotation_matrix'].split(), dtype=float).reshape(3, 3)
+    T = np.array(row['translation_vector'].split(), dtype=float).reshape(3, 1)
+    return float(np.dot(-R.T, T)[0, 0] * SCALING)
+
+@pytest.mark.parametrize('use_store', [False, True])
+def test_plotter_follows_order_of_ids(tmp_path, use_store):
+    train_dir = str(tmp_path)
+    write_train_dir(train_dir)
+    _, cal, scalings = vu.load_pairs_and_cal([SCENE], train_dir)
+    store = CalibrationStore(train_dir, str(tmp_path / 'cache')) if use_store else None
+    ids = [IMAGE_IDS[3], IMAGE_IDS[0], IMAGE_IDS[4], IMAGE_IDS[1]]
+
+    fig = vu.plotter(SCENE, cal, scalings, ids=ids, store=store)
+    cameras = fig.data[0]
+    assert list(cameras.customdata) == ids
+    np.testing.assert_allclose(cameras.x, [camera_x(cal, image_id) for image_id in ids])
+
+    fig = vu.plotter(SCENE, cal, scalings, store=store)
+    assert list(fig.data[0].customdata) == IMAGE_IDS
+    np.testing.assert_allclose(fig.data[0].x, [camera_x(cal, image_id) for image_id in IMAGE_IDS])
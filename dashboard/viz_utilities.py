@@ -168,21 +168,30 @@ def imshow(idlist,scene,path):
         c += 1
     return imlist
 
-def plotter(scene,cal,scalings,ids=None):
+def plotter(scene,cal,scalings,ids=None,store=None):
+    # With a calibration_store.CalibrationStore, R and T are taken from its parsed arrays instead of the strings in cal
+    scenecal = cal.query(f"scene == '{scene}'")
     if ids:
         print("selected elements detected...")
         print(len(ids))
         cmap="Reds"
-        scenecal = pd.DataFrame()
-        for id in ids:
-            scenecal.append(cal.query(f"image_id == {id}"))
+        # The rows of the selected images in the order of ids, looked up by image id
+        rows = {str(image_id): i for i, image_id in enumerate(scenecal["image_id"])}
+        scenecal = scenecal.iloc[[rows[str(image_id)] for image_id in ids]]
     else:
         print(f"preparing {scene}")
-        scenecal = cal.query(f"scene == '{scene}'")
-        cmap="Blues"   
+        cmap="Blues"
     print("calculating Rs/Ts")
-    Rs = [np.array(scenecal.iloc[i,2].split()).reshape(3,3).astype(float) for i in range(scenecal.shape[0])]
-    Ts = [np.array(scenecal.iloc[i,3].split()).reshape(3,1).astype(float) for i in range(scenecal.shape[0])]
+    if store is not None:
+        scene_calibration = store.scene(scene)
+        # scenecal holds the rows of ids in that order, or all rows of the scene's calibration.csv in file order, as
+        # the store does
+        index = scene_calibration.indices(ids) if ids else slice(None)
+        Rs = scene_calibration.R[index]
+        Ts = scene_calibration.T[index].reshape(-1, 3, 1)
+    else:
+        Rs = [np.array(scenecal.iloc[i,2].split()).reshape(3,3).astype(float) for i in range(scenecal.shape[0])]
+        Ts = [np.array(scenecal.iloc[i,3].split()).reshape(3,1).astype(float) for i in range(scenecal.shape[0])]
     print("plotting")
     fig = plot_camera_positions(Rs,Ts,scene=scene,img_ids=scenecal["image_id"],cmap=cmap, scalings=scalings)
     print("done.")
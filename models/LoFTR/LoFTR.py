@@ -8,83 +8,605 @@ import kornia as K
 import kornia.feature as KF
 import torch
 import cv2
+import time
 import warnings
+from contextlib import nullcontext
+from image_cache import ImageCache
+from decoding import decode_gray_reduced, target_size
+from batching import iter_buckets, make_batch, split_matches
+from checkpoint import CheckpointWriter, CsvSink
+from match_store import MatchStoreSink
+from pipeline import PipelineStats, make_pool, map_ordered, prefetch
+from verification import DEFAULT_ADAPTIVE, DEFAULT_RANSAC, RANSAC_METHODS, RansacParams, iter_verified
+from retrieval import retrieve_pairs, pruning_recall
+from covisibility import select_covisible_pairs
+from precision import PRECISIONS, set_precision
+from export import BACKENDS, set_backend, weights_digest
+from cascade import DEFAULT_CASCADE, CascadeStats, low_res_ransac, needs_escalation
+from features import FeatureStore, match_features
+from instrumentation import TIMING_COLUMNS, PairTrace, Tracer, span
+from shards import parse_shard, select_shard, shard_name, write_manifest
+from validation import MaaAccumulator
 warnings.filterwarnings("ignore")
 
 # Run this script to match all possible image matches in a folder (given as filepath).
 
+# Long side of the images LoFTR sees; keypoints and fundamental matrices are always given in this frame.
+FULL_RES = 1120
+
+# Results are written in pair order, so results that finish early are held back until all earlier pairs are done.
+# These limits keep that backlog, and with it the memory use, independent of the number of pairs:
+#   MAX_BUCKET_DELAY    A batching bucket is run partially filled once this many later pairs were loaded
+#   MAX_CHUNK_SIZE      Pairs per task of a worker process (see iter_results_parallel)
+MAX_BUCKET_DELAY = 256
+MAX_CHUNK_SIZE = 64
+
 def get_pairs(filepath):
     pairs = [combo for combo in combinations(os.listdir(filepath), 2)]
     return pairs
 
-def load_torch_image(imgpath, device):
-    img = cv2.imread(imgpath)
-    scale = 1120 / max(img.shape[0], img.shape[1])
-    w = int(img.shape[1] * scale)
-    h = int(img.shape[0] * scale)
-    img = cv2.resize(img, (w, h))
+def get_covisibility_path(filepath):
+    # In the train data the images are in <scene>/images and the covisibility file is <scene>/pair_covisibility.csv
+    return os.path.join(os.path.dirname(os.path.normpath(filepath)), 'pair_covisibility.csv')
+
+def prune_pairs(pairs, filepath, retrieval_k):
+    # Keep only the retrieval_k most similar partners per image, and report the recall if ground truth is available.
+    n_before = len(pairs)
+    pairs = retrieve_pairs(filepath, pairs, retrieval_k)
+    print(f'retrieval: kept {len(pairs)} of {n_before} pairs (top {retrieval_k} per image)')
+    covisibility_csv = get_covisibility_path(filepath)
+    if os.path.exists(covisibility_csv):
+        print(f'retrieval: recall {pruning_recall(pairs, covisibility_csv):.3f} of the covisible pairs')
+    return pairs
+
+# The steps of load_torch_image are separate functions, so that benchmark.py can time them one by one.
+def decode_image(imgpath):
+    return cv2.imread(imgpath)
+
+def resize_image(img, res=FULL_RES):
+    return cv2.resize(img, target_size(img.shape[0], img.shape[1], res))
+
+def image_to_tensor(img, device):
     img = K.image_to_tensor(img, False).float() /255.
     img = K.color.bgr_to_rgb(img)
     return img.to(device)
 
-def get_loftr_results(pairs, filepath):
-    # Determine if a GPU is available, otherwise use CPU
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    # Initialize LoFTR and load the outdoor weights
-    matcher = KF.LoFTR(pretrained='outdoor')
-    matcher = matcher.to(device).eval()
-    # Run LoFTR on the image pairs loaded previously. The output is a DataFrame containing all relevant data for each image pair analyzed.
-    fund_matrix_list = []
-    pair_list = []
-    fund_matrix_eval = []
-    pair_eval = []
-    mkpts0_list = []
-    mkpts1_list = []
-    mconf_list = []
-
-    for pair in tqdm(pairs):
-        
-        img_id0 = pair[0]
-        img_id1 = pair[1]
+def load_torch_image(imgpath, device, res=FULL_RES):
+    return image_to_tensor(resize_image(decode_image(imgpath), res), device)
+
+def gray_to_tensor(gray, device):
+    # (1, 1, h, w) float tensor of a uint8 grayscale image, without an intermediate colour tensor
+    return torch.from_numpy(gray).to(device)[None, None].float() / 255.
+
+def load_gray_image(imgpath, device, cache=None, res=FULL_RES, reduced_decode=False):
+    # Grayscale tensor as LoFTR expects it. With a cache, every image is only decoded and resized once per run.
+    # reduced_decode uses decoding.decode_gray_reduced, which is faster for large JPEGs but gives slightly different
+    # pixels than decoding in colour at full size (see decode_benchmark.py).
+    def loader():
+        if reduced_decode:
+            return gray_to_tensor(decode_gray_reduced(imgpath, res), device)
+        return K.color.rgb_to_grayscale(load_torch_image(imgpath, device, res))
+    if cache is None:
+        return loader()
+    return cache.get_or_load((imgpath, res), loader)
+
+def match_pair(matcher, img0, img1):
+    batch = {"image0": img0, "image1": img1}
+    with torch.no_grad():
+        matcher(batch)
+        mkpts0 = batch['mkpts0_f'].cpu().numpy()
+        mkpts1 = batch['mkpts1_f'].cpu().numpy()
+        mconf = batch['mconf'].cpu().numpy()
+    return mkpts0, mkpts1, mconf
 
+def coarse_border(matcher):
+    # Width in coarse cells of the border in which LoFTR drops matches (kornia's border_rm), also behind export.TracedLoFTR
+    return getattr(matcher, 'matcher', matcher).coarse_matching.border_rm
+
+def match_bucket(matcher, key, group):
+    # Runs all pairs of one bucket (see batching.iter_buckets) in a single forward pass.
+    batch = make_batch([img0 for _, img0, _ in group], [img1 for _, _, img1 in group], *key)
+    with torch.no_grad():
+        matcher(batch)
+    shapes = [(tuple(img0.shape[-2:]), tuple(img1.shape[-2:])) for _, img0, img1 in group]
+    return split_matches(batch, len(group), shapes, coarse_border(matcher))
+
+def iter_images(pairs, filepath, device, cache=None, res=FULL_RES, trace=None, reduced_decode=False):
+    for i, (img_id0, img_id1) in enumerate(pairs):
+        img0_pth = os.path.join(filepath, str(img_id0))
+        img1_pth = os.path.join(filepath, str(img_id1))
+        with span(trace, 'load', i):
+            img0 = load_gray_image(img0_pth, device, cache, res, reduced_decode)
+            img1 = load_gray_image(img1_pth, device, cache, res, reduced_decode)
+        yield i, img0, img1
+
+def rescale_matches(matches, res):
+    # (mkpts0, mkpts1, mconf) of images matched at res, with the keypoints in the FULL_RES frame
+    if res == FULL_RES:
+        return matches
+    mkpts0, mkpts1, mconf = matches
+    scale = np.float32(FULL_RES / res)
+    return mkpts0 * scale, mkpts1 * scale, mconf
+
+def iter_feature_matches(features, pairs, filepath, device, cache=None, res=FULL_RES, trace=None,
+                         reduced_decode=False):
+    # Matches from per-image features (see features.py): images are only loaded, and the backbone only run, for
+    # images that are not in the feature store yet.
+    # Features of the two decoding paths differ slightly, so they are stored under different keys.
+    key = f'{res}-reduced' if reduced_decode else res
+    for i, (img_id0, img_id1) in enumerate(pairs):
         img0_pth = os.path.join(filepath, str(img_id0))
         img1_pth = os.path.join(filepath, str(img_id1))
-        img0 = load_torch_image(img0_pth, device)
-        img1 = load_torch_image(img1_pth, device)
-        batch = {"image0": K.color.rgb_to_grayscale(img0), 
-                "image1": K.color.rgb_to_grayscale(img1)}
-        
-        with torch.no_grad():
-            matcher(batch)
-            mkpts0 = batch['mkpts0_f'].cpu().numpy()
-            mkpts1 = batch['mkpts1_f'].cpu().numpy()
-            mconf = batch['mconf'].cpu().numpy()
-            
-        F = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.2, 0.99999, 50000)
-        
-
-        fund_matrix_list.append(F[0])
-        pair_list.append(pair)
-        fund_matrix_eval.append(" ".join(str(num) for num in F[0].flatten().tolist()))
-        mkpts0_list.append(mkpts0)
-        mkpts1_list.append(mkpts1)
-        mconf_list.append(mconf)
-        
-    results = pd.DataFrame({'pair': pair_list, 'fund_matrix': fund_matrix_list, 
-                            'mkpts0': mkpts0_list, 'mkpts1': mkpts1_list, 'mconf': mconf_list, 
-                            'fund_matrix_eval': fund_matrix_eval}) 
+        with span(trace, 'load', i):
+            features0 = features.get(img0_pth, key, lambda: load_gray_image(img0_pth, device, cache, res,
+                                                                            reduced_decode))
+            features1 = features.get(img1_pth, key, lambda: load_gray_image(img1_pth, device, cache, res,
+                                                                            reduced_decode))
+        with span(trace, 'match', i):
+            matches = match_features(features.matcher, features0, features1)
+        yield (i,) + rescale_matches(matches, res)
+
+def iter_matches(matcher, pairs, filepath, device, cache=None, batch_size=1, pad_to=64, prefetch_depth=0, stats=None,
+                 res=FULL_RES, features=None, trace=None, reduced_decode=False):
+    # Yields (pair index, mkpts0, mkpts1, mconf). With batch_size > 1 pairs come out in bucket order, not pair order.
+    # With features (a features.FeatureStore) the pairs are matched one by one from cached per-image features.
+    # trace (an instrumentation.PairTrace) records the 'load' and 'match' spans of every pair.
+    if features is not None:
+        yield from iter_feature_matches(features, pairs, filepath, device, cache, res, trace, reduced_decode)
+        return
+    items = iter_images(pairs, filepath, device, cache, res, trace, reduced_decode)
+    if prefetch_depth > 0:
+        # Load the images of upcoming pairs in a background thread while LoFTR runs.
+        items = prefetch(items, prefetch_depth, stats.stage('load') if stats is not None else None)
+    if batch_size == 1:
+        for i, img0, img1 in items:
+            with span(trace, 'match', i):
+                matches = match_pair(matcher, img0, img1)
+            yield (i,) + rescale_matches(matches, res)
+        return
+    for key, group in iter_buckets(items, batch_size, pad_to, MAX_BUCKET_DELAY):
+        with span(trace, 'match', *(i for i, _, _ in group)):
+            bucket_matches = match_bucket(matcher, key, group)
+        for (i, _, _), matches in zip(group, bucket_matches):
+            yield (i,) + rescale_matches(matches, res)
+
+def get_device():
+    # Determine if a GPU is available, otherwise use CPU
+    return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+def load_matcher(device, precision='float32', backend='eager', export_dir='exported'):
+    # Initialize LoFTR and load the outdoor weights, optionally in reduced precision (see precision.py) and with the
+    # dense stage as cached TorchScript graphs (see export.py)
+    matcher = KF.LoFTR(pretrained='outdoor').to(device).eval()
+    key = f'{weights_digest(matcher)}-{precision}'
+    return set_backend(set_precision(matcher, precision), backend, key, export_dir)
 
+def iter_results(matcher, pairs, filepath, device, cache=None, batch_size=1, pad_to=64,
+                 prefetch_depth=0, ransac=DEFAULT_RANSAC, ransac_threads=0, ransac_processes=0, stats=None,
+                 adaptive=None, res=FULL_RES, features=None, tracer=None, reduced_decode=False, executor=None):
+    # Yields (pair index, mkpts0, mkpts1, mconf, F, inliers) in the order iter_matches produces the matches.
+    # tracer (an instrumentation.Tracer) records the spans of every stage. executor is an existing RANSAC pool.
+    trace = PairTrace(tracer, pairs) if tracer is not None else None
+    matches = iter_matches(matcher, pairs, filepath, device, cache, batch_size, pad_to, prefetch_depth, stats, res,
+                           features, trace, reduced_decode)
+    # With ransac_threads/ransac_processes, F is estimated in a pool while LoFTR matches the next pairs.
+    yield from iter_verified(matches, ransac, ransac_threads, ransac_processes,
+                             stats.stage('ransac') if stats is not None else None, adaptive, trace, executor)
+
+def iter_results_cascade(matcher, pairs, filepath, device, cache=None, batch_size=1, pad_to=64,
+                         prefetch_depth=0, ransac=DEFAULT_RANSAC, ransac_threads=0, ransac_processes=0, stats=None,
+                         adaptive=None, cascade=DEFAULT_CASCADE, cascade_stats=None, features=None, tracer=None,
+                         reduced_decode=False):
+    """
+    Like iter_results, but every block of cascade.block_size pairs is matched at cascade.low_res first, and only the
+    pairs with an uncertain low resolution result (see cascade.needs_escalation) are matched again at FULL_RES.
+
+    Yields:
+        (pair index, mkpts0, mkpts1, mconf, F, inliers) in pair order
+    """
+    cascade_stats = cascade_stats if cascade_stats is not None else CascadeStats()
+    args = (device, cache, batch_size, pad_to, prefetch_depth, ransac, ransac_threads, ransac_processes, stats, adaptive)
+    # The low resolution pass gets an inlier threshold scaled to its coarser keypoints (see cascade.low_res_ransac).
+    low_args = (device, cache, batch_size, pad_to, prefetch_depth, low_res_ransac(ransac, cascade, FULL_RES),
+                ransac_threads, ransac_processes, stats, adaptive)
+    # Every block runs iter_results twice, so the RANSAC pool is started once here and shared by all of them.
+    pool = None
+    if ransac_processes > 0 or ransac_threads > 0:
+        pool = make_pool(ransac_processes or ransac_threads, processes=ransac_processes > 0)
+    with pool or nullcontext():
+        for start in range(0, len(pairs), cascade.block_size):
+            block = pairs[start:start + cascade.block_size]
+            started = time.perf_counter()
+            with span(tracer, 'cascade_low', n_pairs=len(block)):
+                results = {i: rest for i, *rest in iter_results(matcher, block, filepath, *low_args,
+                                                                res=cascade.low_res, features=features, tracer=tracer,
+                                                                reduced_decode=reduced_decode, executor=pool)}
+            escalate = [i for i, (mkpts0, _, _, _, inliers) in results.items()
+                        if needs_escalation(len(mkpts0), inliers.sum(), cascade)]
+            escalated = time.perf_counter()
+            with span(tracer, 'cascade_full', n_pairs=len(escalate)):
+                for j, *rest in iter_results(matcher, [block[i] for i in escalate], filepath, *args, features=features,
+                                             tracer=tracer, reduced_decode=reduced_decode, executor=pool):
+                    results[escalate[j]] = rest
+            cascade_stats.pairs += len(block)
+            cascade_stats.escalated += len(escalate)
+            cascade_stats.low_seconds += escalated - started
+            cascade_stats.full_seconds += time.perf_counter() - escalated
+            for i in range(len(block)):
+                yield (start + i, *results[i])
+
+def load_feature_store(matcher, feature_cache=None, feature_dir=None):
+    # FeatureStore of the per-image feature mode, None if neither an in-memory cache nor a directory is given
+    if feature_cache is None and feature_dir is None:
+        return None
+    return FeatureStore(matcher, feature_cache, feature_dir)
+
+def cache_counts(*caches):
+    return [(cache.hits, cache.misses) if cache is not None else (0, 0) for cache in caches]
+
+# State of a worker process in --workers mode, set up once per process by init_worker.
+_worker = {}
+
+def init_worker(num_threads, cache_bytes, precision='float32', backend='eager', export_dir='exported',
+                feature_cache_bytes=0, feature_dir=None, trace=False):
+    # Limit intra-op threads so that the workers together do not oversubscribe the cores.
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    _worker['device'] = get_device()
+    _worker['matcher'] = load_matcher(_worker['device'], precision, backend, export_dir)
+    _worker['cache'] = ImageCache(cache_bytes) if cache_bytes > 0 else None
+    _worker['feature_cache'] = ImageCache(feature_cache_bytes, 'feature cache') if feature_cache_bytes > 0 else None
+    _worker['features'] = load_feature_store(_worker['matcher'], _worker['feature_cache'], feature_dir)
+    _worker['tracer'] = Tracer() if trace else None
+
+def match_chunk(args):
+    # Runs a contiguous slice of the pair list in a worker. Returns its results, the hits/misses of the worker's image
+    # and feature caches for it, the CascadeStats of the chunk (None without cascade) and the state of the worker's
+    # Tracer for the chunk (None without tracing).
+    (start, chunk, filepath, batch_size, pad_to, prefetch_depth, ransac, ransac_threads, adaptive, cascade,
+     reduced_decode) = args
+    cache = _worker['cache']
+    tracer = _worker['tracer']
+    caches = (cache, _worker['feature_cache'])
+    counts = cache_counts(*caches)
+    cascade_stats = None
+    if cascade is not None:
+        cascade_stats = CascadeStats()
+        results_iter = iter_results_cascade(_worker['matcher'], chunk, filepath, _worker['device'], cache, batch_size,
+                                            pad_to, prefetch_depth, ransac, ransac_threads, adaptive=adaptive,
+                                            cascade=cascade, cascade_stats=cascade_stats,
+                                            features=_worker['features'], tracer=tracer,
+                                            reduced_decode=reduced_decode)
+    else:
+        results_iter = iter_results(_worker['matcher'], chunk, filepath, _worker['device'], cache, batch_size, pad_to,
+                                    prefetch_depth, ransac, ransac_threads, adaptive=adaptive,
+                                    features=_worker['features'], tracer=tracer, reduced_decode=reduced_decode)
+    results = [(start + i, *rest) for i, *rest in results_iter]
+    counts = [(hits - hits0, misses - misses0) for (hits0, misses0), (hits, misses) in zip(counts, cache_counts(*caches))]
+    trace_state = None
+    if tracer is not None:
+        trace_state = tracer.state()
+        tracer.reset()
+    return results, counts, cascade_stats, trace_state
+
+def iter_results_parallel(pairs, filepath, workers, cache=None, batch_size=1, pad_to=64,
+                          prefetch_depth=0, ransac=DEFAULT_RANSAC, ransac_threads=0, adaptive=None,
+                          precision='float32', backend='eager', export_dir='exported', cascade=None,
+                          cascade_stats=None, feature_cache=None, feature_dir=None, chunks_per_worker=4, tracer=None,
+                          max_chunk_size=MAX_CHUNK_SIZE, reduced_decode=False):
+    """
+    Spread the pair list over a pool of worker processes, each with its own LoFTR instance and image cache.
+
+    Pairs are split into contiguous chunks (so images shared by neighbouring pairs stay in a worker's cache) and
+    the chunks are returned in pair order. Chunks have at most max_chunk_size pairs and only a few chunks per worker
+    are in flight, so the results held in memory do not grow with the number of pairs.
+    Cache hits and misses of the workers are added to the given cache's counters; its memory budget is split between
+    the workers. The same holds for feature_cache in the per-image feature mode.
+
+    Worker processes cannot start process pools of their own, so the verification runs inline or in threads.
+    With cascade, every worker runs the resolution cascade on its chunks and their counters are added to cascade_stats.
+    With tracer, the workers record spans as well and send them along with the results of every chunk.
+
+    Yields:
+        (pair index, mkpts0, mkpts1, mconf, F, inliers) for every pair
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    cache_bytes = cache.max_bytes // workers if cache is not None else 0
+    feature_cache_bytes = feature_cache.max_bytes // workers if feature_cache is not None else 0
+    chunk_size = max(1, min(max_chunk_size, -(-len(pairs) // (workers * chunks_per_worker))))
+    tasks = ((start, pairs[start:start + chunk_size], filepath, batch_size, pad_to, prefetch_depth,
+              ransac, ransac_threads, adaptive, cascade, reduced_decode)
+             for start in range(0, len(pairs), chunk_size))
+    initargs = (num_threads, cache_bytes, precision, backend, export_dir, feature_cache_bytes, feature_dir,
+                tracer is not None)
+    chunks = map_ordered(match_chunk, tasks, workers, processes=True, initializer=init_worker, initargs=initargs)
+    for _, (results, counts, chunk_cascade_stats, trace_state) in chunks:
+        for parent_cache, (hits, misses) in zip((cache, feature_cache), counts):
+            if parent_cache is not None:
+                parent_cache.hits += hits
+                parent_cache.misses += misses
+        if cascade_stats is not None and chunk_cascade_stats is not None:
+            cascade_stats.merge(chunk_cascade_stats)
+        if tracer is not None and trace_state is not None:
+            tracer.merge(trace_state)
+        yield from results
+
+RESULT_COLUMNS = ['pair', 'fund_matrix', 'mkpts0', 'mkpts1', 'mconf', 'fund_matrix_eval', 'inliers', 'n_inliers']
+
+def make_record(pair, mkpts0, mkpts1, mconf, F, inliers):
+    # One row of the results, with the RESULT_COLUMNS as keys
+    return {'pair': pair, 'fund_matrix': F,
+            'mkpts0': mkpts0, 'mkpts1': mkpts1, 'mconf': mconf,
+            'fund_matrix_eval': " ".join(str(num) for num in F.flatten().tolist()),
+            'inliers': inliers, 'n_inliers': int(inliers.sum())}
+
+def sample_id(scene, pair):
+    # Prediction key of validation.py, with the image ids without file extension
+    image_id0, image_id1 = (os.path.splitext(str(image_id))[0] for image_id in pair)
+    return f'phototourism;{scene};{image_id0}-{image_id1}'
+
+def iter_loftr_records(pairs, filepath, cache=None, batch_size=1, pad_to=64, workers=1,
+                       prefetch_depth=0, ransac=DEFAULT_RANSAC, ransac_threads=0, ransac_processes=0, stats=None,
+                       adaptive=None, precision='float32', backend='eager', export_dir='exported', cascade=None,
+                       cascade_stats=None, feature_cache=None, feature_dir=None, tracer=None, on_pair=None,
+                       reduced_decode=False, accumulator=None, scene=None):
+    # Run LoFTR on the image pairs and yield one record (dictionary of the result columns) per pair, in pair order.
+    # stats (pipeline.PipelineStats) collects queue depths and stall times of the serial pipeline.
+    # With cascade (CascadeParams), pairs go through the resolution cascade and cascade_stats counts the escalations.
+    # With feature_cache (an ImageCache) or feature_dir, the backbone runs once per image (see features.py).
+    # With tracer (an instrumentation.Tracer), the records also get the TIMING_COLUMNS of their pair.
+    # on_pair is called once per finished pair, e.g. to report progress elsewhere; it replaces the progress bar.
+    # With accumulator (a validation.MaaAccumulator), every record is scored against the ground truth of scene and the
+    # running mAA is shown next to the progress bar.
+    if workers > 1:
+        results_iter = iter_results_parallel(pairs, filepath, workers, cache, batch_size, pad_to,
+                                             prefetch_depth, ransac, ransac_threads, adaptive, precision,
+                                             backend, export_dir, cascade, cascade_stats, feature_cache, feature_dir,
+                                             tracer=tracer, reduced_decode=reduced_decode)
+    else:
+        device = get_device()
+        with span(tracer, 'load_matcher'):
+            matcher = load_matcher(device, precision, backend, export_dir)
+        features = load_feature_store(matcher, feature_cache, feature_dir)
+        if cascade is not None:
+            results_iter = iter_results_cascade(matcher, pairs, filepath, device, cache, batch_size, pad_to,
+                                                prefetch_depth, ransac, ransac_threads, ransac_processes, stats,
+                                                adaptive, cascade, cascade_stats, features, tracer, reduced_decode)
+        else:
+            results_iter = iter_results(matcher, pairs, filepath, device, cache, batch_size, pad_to,
+                                        prefetch_depth, ransac, ransac_threads, ransac_processes, stats, adaptive,
+                                        features=features, tracer=tracer, reduced_decode=reduced_decode)
+
+    # Batched and parallel runs finish pairs out of order, so finished pairs wait here until all earlier ones are done.
+    pending = {}
+    next_index = 0
+    with tqdm(total=len(pairs), disable=on_pair is not None) as pbar:
+        for i, mkpts0, mkpts1, mconf, F, inliers in results_iter:
+            pending[i] = (mkpts0, mkpts1, mconf, F, inliers)
+            pbar.update(1)
+            if on_pair is not None:
+                on_pair()
+            while next_index in pending:
+                record = make_record(pairs[next_index], *pending.pop(next_index))
+                if tracer is not None:
+                    record.update(tracer.pair_columns(pairs[next_index]))
+                    tracer.count('pairs')
+                    tracer.count('matches', len(record['mkpts0']))
+                    tracer.count('inliers', record['n_inliers'])
+                if accumulator is not None:
+                    accumulator.add(sample_id(scene, pairs[next_index]), record['fund_matrix'])
+                    pbar.set_postfix_str(f'mAA {accumulator.maa():.4f}')
+                yield record
+                next_index += 1
+
+def get_loftr_results(pairs, filepath, cache=None, batch_size=1, pad_to=64, workers=1, precision='float32',
+                      backend='eager', trace_path=None):
+    # The output is a DataFrame containing all relevant data for each image pair analyzed, including the time spent
+    # on it per stage (TIMING_COLUMNS). With trace_path, the spans of the run are also saved as a trace file.
+    # All matches are kept in memory; for large scenes use write_loftr_results instead.
+    with Tracer(path=trace_path) as tracer:
+        records = list(iter_loftr_records(pairs, filepath, cache, batch_size, pad_to, workers, precision=precision,
+                                          backend=backend, tracer=tracer))
+    results = pd.DataFrame(records, columns=RESULT_COLUMNS + TIMING_COLUMNS)
+    print(tracer.summary())
     return results
 
-def main(filepath):
-    pairs = get_pairs(filepath)
-    results = get_loftr_results(pairs, filepath)
-    csv_name = filepath.rsplit('/', 3)[-1]
-    results.to_csv(f'{csv_name}.csv',index=False)
+def write_loftr_results(pairs, filepath, sink, cache=None, batch_size=1, pad_to=64, workers=1, precision='float32',
+                        backend='eager', flush_every=16):
+    """
+    Like get_loftr_results, but every record is handed to sink (e.g. from get_sink) as soon as its pair is done,
+    so memory use stays flat however many pairs there are.
+
+    Returns:
+        Number of pairs written
+    """
+    n_pairs = 0
+    with CheckpointWriter(sink, flush_every=flush_every) as writer:
+        for record in iter_loftr_records(pairs, filepath, cache, batch_size, pad_to, workers, precision=precision,
+                                         backend=backend):
+            writer.write(record)
+            n_pairs += 1
+    return n_pairs
+
+def get_sink(name, output_format='csv', keypoint_dtype='float32'):
+    # 'csv' writes the results DataFrame as before, 'store' a binary match store (see match_store.py).
+    if output_format == 'csv':
+        return CsvSink(f'{name}.csv')
+    elif output_format == 'store':
+        return MatchStoreSink(f'{name}.matches', keypoint_dtype)
+    raise ValueError(f'Unknown output format: {output_format}')
+
+def main(filepath, cache_mb=1024, batch_size=1, pad_to=64, workers=1, resume=False, flush_every=16,
+         output_format='csv', keypoint_dtype='float32', prefetch_depth=0, ransac_threads=0, retrieval_k=0,
+         covisibility_threshold=None, sample_per_bin=0, seed=0, ransac=DEFAULT_RANSAC, ransac_processes=0,
+         adaptive=None, precision='float32', backend='eager', export_dir='exported', cascade=None,
+         feature_cache_mb=0, feature_dir=None, trace_path=None, output=None, on_pair=None, shard=None,
+         reduced_decode=False, live_maa=False):
+    # Writes the results to <output>.csv (or .matches); output defaults to the name of the image folder.
+    # With live_maa, filepath has to be the images folder of a train scene (<train>/<scene>/images); the pairs are
+    # scored against its ground truth as they finish (see validation.MaaAccumulator).
+    # With shard = (k, N), only the pairs of shard k of N are matched (see shards.py), into <output>.shard<k>of<N>.
+    if (feature_cache_mb > 0 or feature_dir is not None) and backend != 'eager':
+        raise ValueError('The per-image feature cache runs the backbone itself and needs the eager backend')
+    if covisibility_threshold is not None:
+        # Only the pairs of pair_covisibility.csv that the validation metric scores
+        pairs = select_covisible_pairs(filepath, covisibility_threshold, sample_per_bin, seed=seed)
+        print(f'covisibility: selected {len(pairs)} pairs')
+    else:
+        pairs = get_pairs(filepath)
+    if retrieval_k > 0:
+        pairs = prune_pairs(pairs, filepath, retrieval_k)
+    csv_name = output if output is not None else filepath.rsplit('/', 3)[-1]
+    if shard is not None:
+        all_pairs = pairs
+        pairs = select_shard(all_pairs, *shard)
+        csv_name = shard_name(csv_name, *shard)
+        print(f'shard {shard[0]} of {shard[1]}: {len(pairs)} of {len(all_pairs)} pairs')
+    cache = ImageCache(cache_mb * 2**20) if cache_mb > 0 else None
+    stats = PipelineStats() if prefetch_depth > 0 or ransac_threads > 0 or ransac_processes > 0 else None
+    cascade_stats = CascadeStats() if cascade is not None else None
+    feature_cache = None
+    if feature_cache_mb > 0 and feature_dir is None:
+        feature_cache = ImageCache(feature_cache_mb * 2**20, 'feature cache')
+    accumulator, scene = None, None
+    if live_maa:
+        scene_dir = os.path.dirname(os.path.normpath(filepath))
+        accumulator, scene = MaaAccumulator(os.path.dirname(scene_dir)), os.path.basename(scene_dir)
+    sink = get_sink(csv_name, output_format, keypoint_dtype)
+    if shard is not None:
+        write_manifest(csv_name, sink.path, *shard, all_pairs, pairs)
+    # With trace_path, the output gets per-pair timing columns and the spans are saved as a trace file, also if the
+    # run is interrupted.
+    tracer = Tracer(path=trace_path) if trace_path is not None else None
+    # Finished pairs are flushed to disk every few pairs, so an interrupted run can continue with --resume.
+    with tracer or nullcontext(), CheckpointWriter(sink, resume, flush_every) as writer:
+        if writer.completed:
+            print(f'resuming: {len(writer.completed)} of {len(pairs)} pairs already done')
+            pairs = [pair for pair in pairs if pair not in writer.completed]
+        for record in iter_loftr_records(pairs, filepath, cache, batch_size, pad_to, workers,
+                                         prefetch_depth, ransac, ransac_threads, ransac_processes, stats, adaptive,
+                                         precision, backend, export_dir, cascade, cascade_stats, feature_cache,
+                                         feature_dir, tracer, on_pair, reduced_decode, accumulator, scene):
+            with span(tracer, 'write'):
+                writer.write(record)
+    if cache is not None:
+        print(cache.summary())
+    if feature_cache is not None:
+        print(feature_cache.summary())
+    if stats is not None and stats.stages:
+        print(stats.summary())
+    if cascade_stats is not None:
+        print(cascade_stats.summary())
+    if tracer is not None:
+        print(tracer.summary())
+        print(f'trace written to {trace_path}')
+    if accumulator is not None:
+        print(f'mAA of the {len(accumulator)} pairs matched in this run: {accumulator.maa():.4f}')
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Where are the images located?')
     parser.add_argument('--filepath', metavar='path', required=True,
                         help='the path to the images')
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help='memory budget in MB for decoded images kept between pairs (0 disables the cache)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of image pairs with matching (padded) shapes per LoFTR forward pass')
+    parser.add_argument('--pad-to', type=int, default=64,
+                        help='image sides are padded up to a multiple of this to form shape buckets in batched mode')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each with its own LoFTR instance and a share of the CPU threads')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run, skipping the pairs already written to the output')
+    parser.add_argument('--flush-every', type=int, default=16,
+                        help='number of finished pairs collected before they are written to disk')
+    parser.add_argument('--output-format', choices=['csv', 'store'], default='csv',
+                        help="'csv' for <scene>.csv, 'store' for a compact memory-mappable <scene>.matches file")
+    parser.add_argument('--keypoint-dtype', choices=['float32', 'float16'], default='float32',
+                        help='precision of keypoints and confidences in the match store')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of image pairs loaded ahead in a background thread (0 loads them inline)')
+    parser.add_argument('--ransac-threads', type=int, default=0,
+                        help='threads estimating fundamental matrices while LoFTR matches the next pairs (0 runs inline)')
+    parser.add_argument('--retrieval-k', type=int, default=0,
+                        help='only match every image with its k most similar images by global descriptor (0 matches all pairs)')
+    parser.add_argument('--covisibility-threshold', type=float, default=None,
+                        help="match only the pairs of the scene's pair_covisibility.csv with at least this covisibility")
+    parser.add_argument('--sample-per-bin', type=int, default=0,
+                        help='with --covisibility-threshold, sample at most this many pairs from each of 10 covisibility bins')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for --sample-per-bin')
+    parser.add_argument('--ransac-method', choices=list(RANSAC_METHODS), default=DEFAULT_RANSAC.method,
+                        help='robust estimator for the fundamental matrix')
+    parser.add_argument('--ransac-threshold', type=float, default=DEFAULT_RANSAC.threshold,
+                        help='maximum distance in pixels from the epipolar line for inliers')
+    parser.add_argument('--ransac-confidence', type=float, default=DEFAULT_RANSAC.confidence,
+                        help='desired confidence of the estimate')
+    parser.add_argument('--ransac-iters', type=int, default=DEFAULT_RANSAC.max_iters,
+                        help='maximum number of RANSAC iterations')
+    parser.add_argument('--ransac-processes', type=int, default=0,
+                        help='processes estimating fundamental matrices while LoFTR matches the next pairs (overrides --ransac-threads)')
+    parser.add_argument('--adaptive-ransac', action='store_true',
+                        help='filter and subsample matches, then scale the RANSAC iterations to the inlier ratio of each pair')
+    parser.add_argument('--min-conf', type=float, default=DEFAULT_ADAPTIVE.min_conf,
+                        help='with --adaptive-ransac, drop matches with a lower LoFTR confidence')
+    parser.add_argument('--max-matches', type=int, default=DEFAULT_ADAPTIVE.max_matches,
+                        help='with --adaptive-ransac, spatially uniform subsample of at most this many matches')
+    parser.add_argument('--precision', choices=PRECISIONS, default='float32',
+                        help="inference precision of LoFTR: 'bfloat16' autocast or 'int8' dynamic quantization (CPU only)")
+    parser.add_argument('--backend', choices=BACKENDS, default='eager',
+                        help="'torchscript' runs the backbone and coarse transformer as traced graphs, one per input shape")
+    parser.add_argument('--export-dir', default='exported',
+                        help='cache directory of the traced graphs, keyed by weights, precision, device and shape')
+    parser.add_argument('--cascade', action='store_true',
+                        help='match all pairs at --cascade-res first and only uncertain pairs again at full resolution')
+    parser.add_argument('--cascade-res', type=int, default=DEFAULT_CASCADE.low_res,
+                        help='long side of the images in the low resolution pass of --cascade')
+    parser.add_argument('--cascade-min-matches', type=int, default=DEFAULT_CASCADE.min_matches,
+                        help='pairs with fewer low resolution matches count as unrelated and are not escalated')
+    parser.add_argument('--cascade-confident-matches', type=int, default=DEFAULT_CASCADE.confident_matches,
+                        help='pairs with at least this many low resolution matches ...')
+    parser.add_argument('--cascade-confident-ratio', type=float, default=DEFAULT_CASCADE.confident_inlier_ratio,
+                        help='... and at least this inlier ratio count as matching and are not escalated')
+    parser.add_argument('--feature-cache-mb', type=int, default=0,
+                        help='run the backbone once per image and keep its features in memory, with this budget in MB; '
+                             'pairs are then matched one at a time (0 disables the feature cache). The features of one '
+                             'image are large: about 130 MB at the full resolution of 1120 px, most of it the '
+                             '1x128x560x420 float32 fine map (115 MB), so the budget needs roughly 130 MB per image '
+                             'that should stay cached')
+    parser.add_argument('--feature-dir', default=None,
+                        help='like --feature-cache-mb, but store the features in this directory and memory-map them; '
+                             'needs about 130 MB of disk per image at 1120 px')
+    parser.add_argument('--output', default=None,
+                        help='output file name without extension (default: the name of the image folder)')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="only match shard k of N (given as 'k/N', k from 0 to N-1) of the pairs, selected by a "
+                             "hash of the image ids; merge the shard outputs with shards.py")
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help='decode JPEGs straight to grayscale at a reduced scale (1/2, 1/4 or 1/8) where the '
+                             'target size allows it; faster for large images, slightly different pixels')
+    parser.add_argument('--live-maa', action='store_true',
+                        help='score the pairs against the ground truth of the train scene of --filepath while matching '
+                             'and show the running mAA next to the progress bar')
+    parser.add_argument('--trace', default=None,
+                        help='add per-pair timing columns to the output and save a trace (chrome://tracing, Perfetto) '
+                             'of the run to this JSON file; the events are streamed to the file during the run, so '
+                             'memory use does not grow with the number of pairs')
     args = parser.parse_args()
-    main(filepath=args.filepath)
+    ransac = RansacParams(args.ransac_method, args.ransac_threshold, args.ransac_confidence, args.ransac_iters)
+    adaptive = None
+    if args.adaptive_ransac:
+        adaptive = DEFAULT_ADAPTIVE._replace(min_conf=args.min_conf, max_matches=args.max_matches)
+    cascade = None
+    if args.cascade:
+        cascade = DEFAULT_CASCADE._replace(low_res=args.cascade_res, min_matches=args.cascade_min_matches,
+                                           confident_matches=args.cascade_confident_matches,
+                                           confident_inlier_ratio=args.cascade_confident_ratio)
+    main(filepath=args.filepath, cache_mb=args.cache_mb, batch_size=args.batch_size, pad_to=args.pad_to,
+         workers=args.workers, resume=args.resume, flush_every=args.flush_every,
+         output_format=args.output_format, keypoint_dtype=args.keypoint_dtype,
+         prefetch_depth=args.prefetch, ransac_threads=args.ransac_threads, retrieval_k=args.retrieval_k,
+         covisibility_threshold=args.covisibility_threshold, sample_per_bin=args.sample_per_bin, seed=args.seed,
+         ransac=ransac, ransac_processes=args.ransac_processes, adaptive=adaptive,
+         precision=args.precision, backend=args.backend, export_dir=args.export_dir, cascade=cascade,
+         feature_cache_mb=args.feature_cache_mb, feature_dir=args.feature_dir, trace_path=args.trace,
+         output=args.output, shard=args.shard, reduced_decode=args.reduced_decode, live_maa=args.live_maa)
@@ -0,0 +1,111 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Helpers to run several image pairs through LoFTR in one forward pass.
+# All image0 tensors of a batch (and all image1 tensors) need the same shape, so pairs are grouped into buckets
+# by their padded shapes. Padding is added at the bottom/right and masked out, which keeps keypoint coordinates unchanged.
+
+# Pixels per cell of LoFTR's coarse feature map; an image of side n has ceil(n / 8) coarse cells along it.
+COARSE_STRIDE = 8
+
+def bucket_shape(img, pad_to=64):
+    # Padded (height, width) of a (1, 1, H, W) image tensor. Orientation is kept, so portrait and landscape images
+    # land in different buckets, and similar aspect ratios share a bucket.
+    h, w = img.shape[-2:]
+    return (math.ceil(h / pad_to) * pad_to, math.ceil(w / pad_to) * pad_to)
+
+def bucket_key(img0, img1, pad_to=64):
+    return (bucket_shape(img0, pad_to), bucket_shape(img1, pad_to))
+
+def pad_to_shape(img, shape):
+    # Zero-pads a (1, 1, H, W) tensor to shape and returns it together with its (1, H', W') validity mask.
+    h, w = img.shape[-2:]
+    padded = F.pad(img, (0, shape[1] - w, 0, shape[0] - h))
+    mask = torch.zeros((1,) + tuple(shape), dtype=img.dtype, device=img.device)
+    mask[:, :h, :w] = 1
+    return padded, mask
+
+def make_batch(imgs0, imgs1, shape0, shape1):
+    """
+    Stack the images of several pairs into a single LoFTR input.
+
+    Args:
+        imgs0, imgs1:   Lists of (1, 1, H, W) grayscale tensors, one entry per pair
+        shape0, shape1: Bucket shapes all image0/image1 tensors are padded to
+
+    Returns:
+        batch:          Dictionary with image0/image1 of shape (B, 1, H, W) and, if any image had to be padded,
+                        the matching mask0/mask1 entries
+    """
+    padded0, masks0 = zip(*[pad_to_shape(img, shape0) for img in imgs0])
+    padded1, masks1 = zip(*[pad_to_shape(img, shape1) for img in imgs1])
+    batch = {"image0": torch.cat(padded0), "image1": torch.cat(padded1)}
+    if any(tuple(img.shape[-2:]) != tuple(shape0) for img in imgs0) or \
+            any(tuple(img.shape[-2:]) != tuple(shape1) for img in imgs1):
+        batch["mask0"] = torch.cat(masks0)
+        batch["mask1"] = torch.cat(masks1)
+    return batch
+
+def split_matches(batch, n_pairs, shapes=None, border=0):
+    """
+    Split the concatenated matches of a batched forward pass back into one (mkpts0, mkpts1, mconf) tuple per pair.
+
+    LoFTR drops coarse matches within border cells of the image edges. With padding, kornia's LoFTR only does so at the
+    edges of the padded images: it counts the pixels of mask0/mask1 as coarse cells, so the bottom/right strip of
+    every padded image is kept. Given the unpadded shapes, those matches are removed here, as in an unbatched pass.
+
+    Args:
+        batch:          Batch after the forward pass
+        n_pairs:        Number of pairs in the batch
+        shapes:         List of the unpadded ((H0, W0), (H1, W1)) of every pair
+        border:         kornia's coarse_matching.border_rm
+    """
+    b_ids = batch['m_bids'].cpu().numpy()
+    mkpts0 = batch['mkpts0_f'].cpu().numpy()
+    mkpts1 = batch['mkpts1_f'].cpu().numpy()
+    mconf = batch['mconf'].cpu().numpy()
+    keep = np.ones(len(b_ids), dtype=bool)
+    if shapes is not None and border > 0 and 'mask0' in batch:
+        # Coarse cell of every match, from its coarse keypoints (cell index times the coarse scale of the batch)
+        cells = []
+        for name, hw_i, hw_c in (('mkpts0_c', 'hw0_i', 'hw0_c'), ('mkpts1_c', 'hw1_i', 'hw1_c')):
+            scale = batch[hw_i][0] / batch[hw_c][0]
+            cells.append(np.rint(batch[name].cpu().numpy() / scale).astype(np.int64))
+        for b, pair_shapes in enumerate(shapes):
+            for cell, (h, w) in zip(cells, pair_shapes):
+                h_c, w_c = -(-h // COARSE_STRIDE), -(-w // COARSE_STRIDE)
+                keep &= (b_ids != b) | ((cell[:, 1] < h_c - border) & (cell[:, 0] < w_c - border))
+    return [(mkpts0[keep & (b_ids == b)], mkpts1[keep & (b_ids == b)], mconf[keep & (b_ids == b)])
+            for b in range(n_pairs)]
+
+def iter_buckets(items, batch_size, pad_to=64, max_delay=None):
+    """
+    Group (index, img0, img1) items into batches of pairs with identical bucket shapes.
+
+    A bucket is emitted as soon as it holds batch_size pairs; partially filled buckets are emitted at the end.
+    With max_delay, a bucket is also emitted partially filled once max_delay more items arrived after its first item.
+    This bounds how far a pair can fall behind the pairs after it, e.g. if the shape of its bucket is rare.
+
+    Yields:
+        key:            ((H0, W0), (H1, W1)) bucket shapes
+        group:          List of (index, img0, img1) items in that bucket
+    """
+    buckets = {}
+    first_item = {}
+    for n, (index, img0, img1) in enumerate(items):
+        key = bucket_key(img0, img1, pad_to)
+        if key not in buckets:
+            buckets[key] = []
+            first_item[key] = n
+        buckets[key].append((index, img0, img1))
+        if len(buckets[key]) == batch_size:
+            del first_item[key]
+            yield key, buckets.pop(key)
+        if max_delay is not None:
+            for key in [key for key, first in first_item.items() if n - first >= max_delay]:
+                del first_item[key]
+                yield key, buckets.pop(key)
+    for key, group in buckets.items():
+        yield key, group
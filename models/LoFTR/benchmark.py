@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+from itertools import combinations
+import numpy as np
+import kornia as K
+import torch
+import cv2
+from LoFTR import (FULL_RES, decode_image, get_device, get_sink, image_to_tensor, load_matcher, make_record,
+                   match_pair, resize_image)
+from checkpoint import CheckpointWriter
+from verification import find_fundamental_matrix
+
+# Stage-level benchmark of the LoFTR.py pipeline on a fixed image set. Every pair goes through the same steps as in
+# LoFTR.py (without the image cache, so every image is decoded for every pair) and each step is timed on its own:
+#   python benchmark.py --filepath ../../data/test_images/ --output benchmark.json
+#   python benchmark.py --filepath ../../data/test_images/ --baseline benchmark.json
+# The second call compares against the stored report and exits with status 1 if a stage got slower.
+
+STAGES = ['decode', 'resize', 'to_tensor', 'inference', 'ransac', 'serialization']
+
+class Timer:
+    def __init__(self):
+        self.times = {stage: [] for stage in STAGES}
+
+    def __call__(self, stage, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.times[stage].append(time.perf_counter() - start)
+        return result
+
+def distribution(seconds):
+    ms = 1000 * np.array(seconds)
+    return {'count': len(ms), 'total_s': float(ms.sum() / 1000), 'mean_ms': float(ms.mean()),
+            'median_ms': float(np.median(ms)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'min_ms': float(ms.min()), 'max_ms': float(ms.max())}
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def load_image(timer, imgpath, device, res):
+    img = timer('decode', decode_image, imgpath)
+    img = timer('resize', resize_image, img, res)
+    return timer('to_tensor', lambda: K.color.rgb_to_grayscale(image_to_tensor(img, device)))
+
+def run(filepath, max_pairs=20, res=FULL_RES, output_format='csv', warmup=1):
+    """
+    Run the pipeline stages over the first max_pairs pairs of the sorted images in filepath.
+
+    Returns:
+        The report as a dictionary
+    """
+    pairs = list(combinations(sorted(os.listdir(filepath)), 2))[:max_pairs]
+    device = get_device()
+    matcher = load_matcher(device)
+    timer = Timer()
+    with tempfile.TemporaryDirectory() as tmp:
+        sink = get_sink(os.path.join(tmp, 'benchmark'), output_format)
+        with CheckpointWriter(sink) as writer:
+            # The first forward passes include one-off allocations, they are run but not timed.
+            for pair in pairs[:warmup]:
+                imgs = [load_image(Timer(), os.path.join(filepath, image_id), device, res) for image_id in pair]
+                match_pair(matcher, *imgs)
+            start = time.perf_counter()
+            for pair in pairs:
+                img0, img1 = (load_image(timer, os.path.join(filepath, image_id), device, res) for image_id in pair)
+                mkpts0, mkpts1, mconf = timer('inference', match_pair, matcher, img0, img1)
+                F, inliers = timer('ransac', find_fundamental_matrix, mkpts0, mkpts1)
+                timer('serialization', writer.write, make_record(pair, mkpts0, mkpts1, mconf, F, inliers))
+            # Write the records still buffered inside the timed region.
+            timer('serialization', writer.flush)
+            wall = time.perf_counter() - start
+    return {
+        'config': {'filepath': os.path.abspath(filepath), 'pairs': len(pairs), 'res': res,
+                   'output_format': output_format, 'device': device.type, 'threads': torch.get_num_threads()},
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'opencv': cv2.__version__,
+                        'kornia': K.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'wall_s': wall,
+        'pairs_per_s': len(pairs) / wall,
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': {stage: distribution(seconds) for stage, seconds in timer.times.items() if seconds},
+    }
+
+def compare(report, baseline, tolerance=0.1, min_delta_ms=1.):
+    """
+    Print the mean stage times next to a baseline report. Means rather than medians, because some stages (e.g. the
+    buffered serialization) spend most of their time in a few calls.
+
+    Returns:
+        List of the regressions, i.e. stages whose mean time grew by more than tolerance and by at least min_delta_ms,
+        plus 'pairs_per_s' if the throughput dropped by more than tolerance
+    """
+    regressions = []
+    print(f"{'stage':<15}{'baseline [ms]':>15}{'now [ms]':>12}{'change':>10}")
+    for stage, dist in report['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before, now = baseline['stages'][stage]['mean_ms'], dist['mean_ms']
+        change = now / before - 1 if before > 0 else 0.
+        slower = change > tolerance and now - before >= min_delta_ms
+        print(f"{stage:<15}{before:>15.2f}{now:>12.2f}{change:>+10.1%}{'  <- slower' if slower else ''}")
+        if slower:
+            regressions.append(stage)
+    change = report['pairs_per_s'] / baseline['pairs_per_s'] - 1
+    print(f"{'pairs/s':<15}{baseline['pairs_per_s']:>15.3f}{report['pairs_per_s']:>12.3f}{change:>+10.1%}")
+    print(f"{'peak RSS [MB]':<15}{baseline['peak_rss_mb']:>15.1f}{report['peak_rss_mb']:>12.1f}")
+    if change < -tolerance:
+        regressions.append('pairs_per_s')
+    if baseline['config'] != report['config']:
+        print('warning: the baseline was run with a different configuration')
+    return regressions
+
+def print_report(report):
+    print(f"{report['config']['pairs']} pairs in {report['wall_s']:.1f}s, {report['pairs_per_s']:.3f} pairs/s, "
+          f"peak RSS {report['peak_rss_mb']:.0f} MB")
+    print(f"{'stage':<15}{'mean [ms]':>12}{'median [ms]':>13}{'p90 [ms]':>11}{'max [ms]':>11}{'total [s]':>11}")
+    for stage, dist in report['stages'].items():
+        print(f"{stage:<15}{dist['mean_ms']:>12.2f}{dist['median_ms']:>13.2f}{dist['p90_ms']:>11.2f}"
+              f"{dist['max_ms']:>11.2f}{dist['total_s']:>11.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the stages of the LoFTR.py pipeline on a fixed image set.')
+    parser.add_argument('--filepath', required=True, help='the path to the images')
+    parser.add_argument('--max-pairs', type=int, default=20, help='number of pairs of the sorted image list to run')
+    parser.add_argument('--res', type=int, default=FULL_RES, help='long side of the images LoFTR sees')
+    parser.add_argument('--output-format', choices=['csv', 'store'], default='csv',
+                        help='output format used for the serialization stage')
+    parser.add_argument('--warmup', type=int, default=1, help='number of untimed pairs run first')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 keeps the default)')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    parser.add_argument('--baseline', default=None, help='JSON report of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown of a stage that counts as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=1.,
+                        help='smaller slowdowns of a stage in milliseconds are never counted as a regression')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    report = run(args.filepath, args.max_pairs, args.res, args.output_format, args.warmup)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
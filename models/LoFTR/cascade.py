@@ -0,0 +1,51 @@
+from collections import namedtuple
+
+# Coarse-to-fine resolution cascade: all pairs are matched at low_res first, and only pairs with an uncertain outcome
+# are matched again at full resolution.
+#   low_res                 Long side of the images in the first pass
+#   min_matches             Fewer low resolution matches than this: clearly unrelated, keep the low resolution result
+#   confident_matches       At least this many matches ...
+#   confident_inlier_ratio  ... with at least this inlier ratio: clearly matching, keep the low resolution result
+#   block_size              Pairs per cascade block; results are held back until the block is complete
+# Everything in between is escalated to full resolution.
+CascadeParams = namedtuple('CascadeParams', ['low_res', 'min_matches', 'confident_matches', 'confident_inlier_ratio',
+                                             'block_size'])
+
+DEFAULT_CASCADE = CascadeParams(low_res=480, min_matches=20, confident_matches=200, confident_inlier_ratio=0.5,
+                                block_size=64)
+
+def low_res_ransac(ransac, params, full_res):
+    # RANSAC settings of the low resolution pass. Its keypoints are scaled up to the full_res frame, and with them
+    # their localisation error, so the inlier threshold is scaled by the same factor.
+    return ransac._replace(threshold=ransac.threshold * full_res / params.low_res)
+
+def needs_escalation(n_matches, n_inliers, params=DEFAULT_CASCADE):
+    # True if a low resolution result is neither clearly unrelated nor clearly matching
+    if n_matches < params.min_matches:
+        return False
+    confident = n_matches >= params.confident_matches and n_inliers / n_matches >= params.confident_inlier_ratio
+    return not confident
+
+class CascadeStats:
+    def __init__(self):
+        self.pairs = 0
+        self.escalated = 0
+        self.low_seconds = 0.
+        self.full_seconds = 0.
+
+    def merge(self, other):
+        # Add the counters of another CascadeStats, e.g. of a worker process
+        self.pairs += other.pairs
+        self.escalated += other.escalated
+        self.low_seconds += other.low_seconds
+        self.full_seconds += other.full_seconds
+
+    def summary(self):
+        share = self.escalated / self.pairs if self.pairs else 0.
+        text = (f'cascade: escalated {self.escalated} of {self.pairs} pairs ({share:.1%}), '
+                f'low resolution pass {self.low_seconds:.1f}s, full resolution pass {self.full_seconds:.1f}s')
+        if self.escalated:
+            # Estimated from the full resolution time per escalated pair
+            saved = self.full_seconds / self.escalated * self.pairs - self.low_seconds - self.full_seconds
+            text += f", ~{abs(saved):.1f}s {'saved' if saved >= 0 else 'lost'} against full resolution only"
+        return text
@@ -0,0 +1,117 @@
+import os
+import json
+import pandas as pd
+
+# Incremental writing of LoFTR results, so that an interrupted run can be resumed instead of started over.
+# Records are handed to an output sink in small chunks. After each chunk the sink's state (for a CSV its size in bytes)
+# and the pairs it contained are recorded in a '<output>.progress' file. Everything up to the last recorded state is
+# known to be complete.
+
+def read_progress(progress_path):
+    """
+    Read a progress file written by CheckpointWriter.
+
+    Returns:
+        state:          Sink state after the last complete flush (None if nothing was flushed)
+        completed:      Set of the pairs written up to that point
+        valid_bytes:    Length of the progress file up to its last complete line
+    """
+    state, completed, valid_bytes = None, set(), 0
+    with open(progress_path, 'rb') as f:
+        for line in f:
+            # A line without newline or with broken content was cut off by the crash.
+            if not line.endswith(b'\n'):
+                break
+            try:
+                line_state, pairs = line.decode().rstrip('\n').split('\t', 1)
+                line_state, pairs = json.loads(line_state), json.loads(pairs)
+            except ValueError:
+                break
+            state = line_state
+            completed.update(tuple(pair) for pair in pairs)
+            valid_bytes += len(line)
+    return state, completed, valid_bytes
+
+class CsvSink:
+    # Appends records to a CSV file in the format DataFrame.to_csv writes. Its state is the file size.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._header = True
+
+    def open(self, state=None):
+        offset = state or 0
+        if offset > 0 and (not os.path.exists(self.path) or os.path.getsize(self.path) < offset):
+            raise ValueError(f'{self.path} is shorter than recorded in its progress file, cannot resume')
+        self._header = offset == 0
+        self._file = open(self.path, 'r+b' if offset > 0 else 'wb')
+        self._file.truncate(offset)
+        self._file.seek(offset)
+
+    def append(self, records):
+        chunk = pd.DataFrame(records).to_csv(index=False, header=self._header)
+        self._file.write(chunk.encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._header = False
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+class CheckpointWriter:
+    """
+    Collect per-pair result records and flush them to a sink every few pairs.
+
+    Args:
+        sink:           Output format, e.g. CsvSink or match_store.MatchStoreSink. It needs a `path`, and
+                        open(state), append(records) -> state and close() methods.
+        resume:         Keep the pairs already written by a previous run of the same output. The sink is cut back to
+                        the last complete flush, and the pairs written up to there are available in `completed`.
+        flush_every:    Number of records collected before they are written to disk
+    """
+
+    def __init__(self, sink, resume=False, flush_every=16):
+        self.sink = sink
+        self.progress_path = sink.path + '.progress'
+        self.flush_every = flush_every
+        self.completed = set()
+        self._records = []
+        state = None
+        if resume and os.path.exists(self.progress_path):
+            state, self.completed, valid_bytes = read_progress(self.progress_path)
+            with open(self.progress_path, 'r+b') as f:
+                f.truncate(valid_bytes)
+        elif resume and os.path.exists(sink.path):
+            print(f'no progress file found for {sink.path}, starting from scratch')
+        sink.open(state)
+        self._progress = open(self.progress_path, 'ab' if state is not None else 'wb')
+
+    def write(self, record):
+        # record is a dictionary with one value per column, including 'pair'.
+        self._records.append(record)
+        if len(self._records) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._records:
+            return
+        state = self.sink.append(self._records)
+        pairs = [list(record['pair']) for record in self._records]
+        self._progress.write(f'{json.dumps(state)}\t{json.dumps(pairs)}\n'.encode())
+        self._progress.flush()
+        os.fsync(self._progress.fileno())
+        self.completed.update(tuple(pair) for pair in pairs)
+        self._records = []
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+        self._progress.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
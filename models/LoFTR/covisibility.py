@@ -0,0 +1,47 @@
+import os
+import numpy as np
+from preprocessing import load_pairs
+
+# Pair selection from the ground truth covisibility of the train scenes. Instead of all combinations of images, only the
+# pairs the validation metric can score are matched, optionally sampled evenly over the covisibility range.
+
+def load_covisibility(filepath):
+    # filepath is the images folder of a train scene, i.e. <datadir>/<scene>/images
+    scene_dir = os.path.dirname(os.path.normpath(filepath))
+    return load_pairs([os.path.basename(scene_dir)], os.path.dirname(scene_dir))
+
+def stratified_sample(covisibility, n_per_bin, n_bins=10, seed=0):
+    # Draw up to n_per_bin pairs from each of n_bins equally wide covisibility bins, keeping the original order.
+    edges = np.linspace(covisibility['covisibility'].min(), covisibility['covisibility'].max(), n_bins + 1)
+    bins = np.clip(np.digitize(covisibility['covisibility'], edges[1:-1]), 0, n_bins - 1)
+    samples = [group.sample(min(len(group), n_per_bin), random_state=seed)
+               for _, group in covisibility.groupby(bins)]
+    return covisibility.loc[covisibility.index.isin(np.concatenate([s.index for s in samples]))]
+
+def select_covisible_pairs(filepath, threshold=0.1, n_per_bin=0, n_bins=10, seed=0):
+    """
+    Image pairs of a train scene with a covisibility of at least threshold.
+
+    Args:
+        filepath:       Images folder of the scene, next to its pair_covisibility.csv
+        threshold:      Minimum covisibility of a pair
+        n_per_bin:      If > 0, sample at most this many pairs per covisibility bin (stratified sampling)
+        n_bins:         Number of covisibility bins between the lowest and highest selected covisibility
+        seed:           Random seed of the sampling
+
+    Returns:
+        List of (image file 0, image file 1) pairs in the order and orientation of pair_covisibility.csv, which is
+        the orientation the fundamental matrices are evaluated in.
+    """
+    covisibility = load_covisibility(filepath).reset_index(drop=True)
+    covisibility = covisibility[covisibility['covisibility'] >= threshold]
+    if n_per_bin > 0 and len(covisibility) > 0:
+        covisibility = stratified_sample(covisibility, n_per_bin, n_bins, seed)
+    # pair_covisibility.csv uses image ids without file extension
+    files = {os.path.splitext(f)[0]: f for f in os.listdir(filepath)}
+    pairs = []
+    for pair in covisibility['pair']:
+        image_id0, image_id1 = pair.split('-')
+        if image_id0 in files and image_id1 in files:
+            pairs.append((files[image_id0], files[image_id1]))
+    return pairs
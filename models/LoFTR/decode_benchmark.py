@@ -0,0 +1,49 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from LoFTR import FULL_RES, get_device, load_gray_image
+
+# Compare the default image loader of LoFTR.py (colour decode at full size, resize, RGB tensor, grayscale) with
+# --reduced-decode (grayscale decode at a reduced JPEG scale, resize, tensor) on every image of a folder, e.g.
+#   python decode_benchmark.py --filepath ../../data/test_images/
+# Reports the median load time of both paths and how far apart the grayscale tensors LoFTR sees are.
+
+def time_load(imgpath, device, res, reduced_decode, repeats):
+    # Returns the last tensor and the median time in seconds
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        img = load_gray_image(imgpath, device, res=res, reduced_decode=reduced_decode)
+        times.append(time.perf_counter() - start)
+    return img, float(np.median(times))
+
+def main(filepath, res=FULL_RES, repeats=5):
+    device = get_device()
+    report = {}
+    for image_id in sorted(os.listdir(filepath)):
+        imgpath = os.path.join(filepath, image_id)
+        full, full_time = time_load(imgpath, device, res, False, repeats)
+        reduced, reduced_time = time_load(imgpath, device, res, True, repeats)
+        same_shape = full.shape == reduced.shape
+        # Mean absolute difference in grey levels (0-255)
+        diff = 255 * torch.mean(torch.abs(full - reduced)).item() if same_shape else float('nan')
+        report[image_id] = (full_time, reduced_time, same_shape, diff)
+
+    print(f"{'image':<30}{'full [ms]':>11}{'reduced [ms]':>14}{'speedup':>9}{'same shape':>12}{'mean |diff|':>13}")
+    for image_id, (full_time, reduced_time, same_shape, diff) in report.items():
+        print(f'{image_id:<30}{1000 * full_time:>11.1f}{1000 * reduced_time:>14.1f}{full_time / reduced_time:>8.1f}x'
+              f'{str(same_shape):>12}{diff:>13.2f}')
+    full_total = sum(full_time for full_time, _, _, _ in report.values())
+    reduced_total = sum(reduced_time for _, reduced_time, _, _ in report.values())
+    print(f'total {1000 * full_total:.0f} ms -> {1000 * reduced_total:.0f} ms, speedup {full_total / reduced_total:.1f}x')
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the default image loader against --reduced-decode.')
+    parser.add_argument('--filepath', required=True, help='the path to the images')
+    parser.add_argument('--res', type=int, default=FULL_RES, help='long side of the images LoFTR sees')
+    parser.add_argument('--repeats', type=int, default=5, help='loads per image and path, the median is reported')
+    args = parser.parse_args()
+    main(args.filepath, args.res, args.repeats)
@@ -0,0 +1,77 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from export import weights_digest
+
+# Per-image feature cache for all-pairs matching. The CNN backbone and the positional encoding of LoFTR only depend on
+# one image, so they run once per image instead of once per pair; per pair only the transformers and the matching run.
+# Features are kept in an in-memory LRU cache, or stored as .npy files that are memory-mapped and reused by later runs.
+
+class FeatureStore:
+    """
+    Backbone features of single images: coarse features with positional encoding as (1, H/8, W/8, C), fine features
+    as (1, C, H/2, W/2), and the (H, W) of the image LoFTR saw.
+
+    Args:
+        matcher:        kornia LoFTR in eval mode (eager backend)
+        cache:          image_cache.ImageCache for the in-memory mode
+        directory:      Directory of the memory-mapped mode (takes precedence over cache)
+    """
+
+    def __init__(self, matcher, cache=None, directory=None):
+        self.matcher = matcher
+        self.cache = cache
+        self.directory = directory
+        self.device = next(matcher.parameters()).device
+        # Files of different weights (or precisions) must not be mixed up.
+        self.key = weights_digest(matcher.backbone)
+
+    def compute(self, img):
+        with torch.no_grad():
+            feat_c, feat_f = self.matcher.backbone(img)
+            feat_c = self.matcher.pos_encoding(feat_c).permute(0, 2, 3, 1).contiguous()
+        return feat_c, feat_f, tuple(img.shape[2:])
+
+    def load_mapped(self, imgpath, res, load_image):
+        name = hashlib.sha1(f'{os.path.abspath(imgpath)}:{res}'.encode()).hexdigest()[:16]
+        folder = os.path.join(self.directory, self.key, name)
+        paths = [os.path.join(folder, f'{part}.npy') for part in ('coarse', 'fine', 'shape')]
+        if not os.path.exists(paths[-1]):
+            feat_c, feat_f, shape = self.compute(load_image())
+            os.makedirs(folder, exist_ok=True)
+            # shape.npy is written last and marks the entry as complete.
+            for path, array in zip(paths, (feat_c.cpu().numpy(), feat_f.cpu().numpy(), np.array(shape))):
+                np.save(f'{path}.{os.getpid()}.tmp.npy', array)
+                os.replace(f'{path}.{os.getpid()}.tmp.npy', path)
+        feat_c, feat_f = (torch.from_numpy(np.load(path, mmap_mode='r')).to(self.device) for path in paths[:2])
+        return feat_c, feat_f, tuple(np.load(paths[2]).tolist())
+
+    def get(self, imgpath, res, load_image):
+        # Features of the image at imgpath, resized to res. load_image() returns the image tensor on a cache miss.
+        if self.directory is not None:
+            return self.load_mapped(imgpath, res, load_image)
+        if self.cache is None:
+            return self.compute(load_image())
+        return self.cache.get_or_load((imgpath, res), lambda: self.compute(load_image()))
+
+def match_features(matcher, features0, features1):
+    """
+    Match two images from their FeatureStore features: the remaining steps of kornia's LoFTR.forward after the
+    backbone and the positional encoding.
+
+    Returns:
+        mkpts0, mkpts1, mconf as numpy arrays
+    """
+    (feat_c0, feat_f0, hw0_i), (feat_c1, feat_f1, hw1_i) = features0, features1
+    data = {'bs': 1, 'hw0_i': hw0_i, 'hw1_i': hw1_i, 'hw0_c': feat_c0.shape[1:3], 'hw1_c': feat_c1.shape[1:3],
+            'hw0_f': feat_f0.shape[2:], 'hw1_f': feat_f1.shape[2:]}
+    with torch.no_grad():
+        feat_c0, feat_c1 = matcher.loftr_coarse(feat_c0.reshape(1, -1, feat_c0.size(3)),
+                                                feat_c1.reshape(1, -1, feat_c1.size(3)))
+        matcher.coarse_matching(feat_c0, feat_c1, data)
+        feat_f0_unfold, feat_f1_unfold = matcher.fine_preprocess(feat_f0, feat_f1, feat_c0, feat_c1, data)
+        if feat_f0_unfold.size(0) != 0:
+            feat_f0_unfold, feat_f1_unfold = matcher.loftr_fine(feat_f0_unfold, feat_f1_unfold)
+        matcher.fine_matching(feat_f0_unfold, feat_f1_unfold, data)
+    return data['mkpts0_f'].cpu().numpy(), data['mkpts1_f'].cpu().numpy(), data['mconf'].cpu().numpy()
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+# Bounded LRU cache for preprocessed image tensors. In all-pairs matching every image takes part in N-1 pairs,
+# so keeping the decoded and resized tensors around saves reading the same JPEG over and over again.
+
+def tensor_nbytes(tensor):
+    # Also accepts tuples, e.g. the (coarse, fine, shape) features of features.FeatureStore
+    if isinstance(tensor, tuple):
+        return sum(tensor_nbytes(t) for t in tensor if hasattr(t, 'nelement'))
+    return tensor.element_size() * tensor.nelement()
+
+class ImageCache:
+    """
+    LRU cache with a budget in bytes instead of a number of entries.
+
+    Args:
+        max_bytes:      Upper bound for the summed size of all cached tensors. Least recently used entries are
+                        evicted until a new entry fits. Entries larger than the whole budget are not cached, and a
+                        warning is printed the first time that happens.
+    """
+
+    def __init__(self, max_bytes, name='image cache'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.oversized = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, tensor):
+        size = tensor_nbytes(tensor)
+        if key in self._entries:
+            self.nbytes -= tensor_nbytes(self._entries.pop(key))
+        if size > self.max_bytes:
+            if not self.oversized:
+                print(f'warning: {self.name}: an entry of {size / 2**20:.1f} MB does not fit into the budget of '
+                      f'{self.max_bytes / 2**20:.1f} MB and is not cached')
+            self.oversized += 1
+            return
+        while self._entries and self.nbytes + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= tensor_nbytes(evicted)
+        self._entries[key] = tensor
+        self.nbytes += size
+
+    def get_or_load(self, key, loader):
+        # Return the cached tensor for key, or call loader() and cache its result.
+        tensor = self.get(key)
+        if tensor is None:
+            tensor = loader()
+            self.put(key, tensor)
+        return tensor
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate,
+                'entries': len(self._entries), 'mbytes': self.nbytes / 2**20, 'oversized': self.oversized}
+
+    def summary(self):
+        s = self.stats()
+        return (f"{self.name}: {s['hits']} hits, {s['misses']} misses ({100 * s['hit_rate']:.1f}% hit rate), "
+                f"{s['entries']} images / {s['mbytes']:.1f} MB cached"
+                + (f", {s['oversized']} entries too large for the budget" if s['oversized'] else ''))
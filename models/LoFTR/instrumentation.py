@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Lightweight instrumentation of the hot path of LoFTR.py: context-manager timers (spans) and counters.
+# Spans of a pair add up to its timing columns in the results ('<span>_ms'), and all spans and counters can be saved
+# as a trace file in the Chrome trace event format, which chrome://tracing and https://ui.perfetto.dev open.
+
+# Spans that are reported per pair:
+#   load    Reading and resizing both images (with the per-image feature cache: getting their features)
+#   match   The LoFTR forward pass; a batched pass is split evenly between its pairs
+#   ransac  Fundamental matrix estimation
+PAIR_SPANS = ['load', 'match', 'ransac']
+TIMING_COLUMNS = [f'{name}_ms' for name in PAIR_SPANS]
+
+def pair_name(pair):
+    return '-'.join(str(image_id) for image_id in pair)
+
+class Tracer:
+    """
+    Collects spans and counters. Thread-safe, so spans can be recorded from prefetch and RANSAC threads.
+
+    Args:
+        log:            Print every finished span, for interactive use
+        path:           Stream the trace events to this file as they come in, a batch of flush_every events at a time,
+                        instead of keeping all of them in memory until save(). Needed for long runs, which record
+                        several events per pair.
+        flush_every:    Number of events buffered before they are written to path
+
+    A streaming Tracer is also a context manager that saves on exit, so the trace file is valid JSON even if the run
+    raises.
+    """
+
+    def __init__(self, log=False, path=None, flush_every=1024):
+        self.log = log
+        self.path = path
+        self.flush_every = flush_every
+        self.events = []
+        self.totals = {}
+        self.counters = {}
+        self.pair_times = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._written = 0
+        if path is not None:
+            self._file = open(path, 'w')
+            self._file.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            self.save()
+
+    def _flush(self):
+        # Write the buffered events to the trace file; the caller holds the lock
+        for event in self.events:
+            self._file.write((',\n' if self._written else '') + json.dumps(event))
+            self._written += 1
+        self.events = []
+
+    def _add_events(self, events):
+        # The caller holds the lock
+        self.events += events
+        if self._file is not None and len(self.events) >= self.flush_every:
+            self._flush()
+
+    @contextmanager
+    def span(self, name, *pairs, **args):
+        # Times the body of the with statement and books it on the given pairs
+        start_time, start = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start_time, time.perf_counter() - start, *pairs, **args)
+
+    def record(self, name, start_time, seconds, *pairs, pid=None, tid=None, **args):
+        # Add a span that was timed elsewhere, e.g. in a pool (see timed_call). start_time is a time.time() stamp.
+        if pairs:
+            args['pairs'] = [pair_name(pair) for pair in pairs]
+        event = {'name': name, 'ph': 'X', 'ts': start_time * 1e6, 'dur': seconds * 1e6,
+                 'pid': pid or os.getpid(), 'tid': tid or threading.get_ident(), 'args': args}
+        with self._lock:
+            self._add_events([event])
+            count, total = self.totals.get(name, (0, 0.))
+            self.totals[name] = (count + 1, total + seconds)
+            for pair in pairs:
+                times = self.pair_times.setdefault(pair, {})
+                times[name] = times.get(name, 0.) + seconds / len(pairs)
+        if self.log:
+            print(f'{name}: {1000 * seconds:.1f} ms')
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self._add_events([{'name': name, 'ph': 'C', 'ts': time.time() * 1e6, 'pid': os.getpid(),
+                               'args': {name: self.counters[name]}}])
+
+    def pair_columns(self, pair):
+        # Timing columns of a finished pair, which is then forgotten
+        with self._lock:
+            times = self.pair_times.pop(pair, {})
+        return {f'{name}_ms': 1000 * times.get(name, 0.) for name in PAIR_SPANS}
+
+    def state(self):
+        # Everything recorded so far, picklable, to send it from a worker process to the main process
+        with self._lock:
+            return {'events': self.events, 'totals': self.totals, 'counters': self.counters,
+                    'pair_times': self.pair_times}
+
+    def reset(self):
+        with self._lock:
+            self.events, self.totals, self.counters, self.pair_times = [], {}, {}, {}
+
+    def merge(self, state):
+        # Add the state() of another Tracer
+        with self._lock:
+            self._add_events(state['events'])
+            for name, (count, total) in state['totals'].items():
+                own_count, own_total = self.totals.get(name, (0, 0.))
+                self.totals[name] = (own_count + count, own_total + total)
+            for name, value in state['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for pair, times in state['pair_times'].items():
+                own = self.pair_times.setdefault(pair, {})
+                for name, seconds in times.items():
+                    own[name] = own.get(name, 0.) + seconds
+
+    def save(self, path=None):
+        # Write the trace file. A streaming Tracer (see path) writes its remaining events and closes its file instead.
+        with self._lock:
+            if self._file is not None:
+                self._flush()
+                self._file.write('\n]}\n')
+                self._file.close()
+                self._file = None
+                return
+            trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+
+    def summary(self):
+        lines = [f"{'span':<20}{'count':>8}{'total [s]':>11}{'mean [ms]':>11}"]
+        for name, (count, total) in self.totals.items():
+            lines.append(f'{name:<20}{count:>8}{total:>11.2f}{1000 * total / count:>11.2f}')
+        lines += [f'{name}: {value}' for name, value in self.counters.items()]
+        return '\n'.join(lines)
+
+class PairTrace:
+    """
+    A Tracer bound to a list of pairs, so that the stages of LoFTR.py can book spans on pairs by their index.
+    """
+
+    def __init__(self, tracer, pairs):
+        self.tracer = tracer
+        self.pairs = pairs
+
+    def span(self, name, *indices, **args):
+        return self.tracer.span(name, *(self.pairs[i] for i in indices), **args)
+
+    def record(self, name, start_time, seconds, *indices, **kwargs):
+        self.tracer.record(name, start_time, seconds, *(self.pairs[i] for i in indices), **kwargs)
+
+def span(trace, name, *keys, **args):
+    # trace.span(name, *keys, **args) for a Tracer or PairTrace, or a no-op if trace is None
+    if trace is None:
+        return nullcontext()
+    return trace.span(name, *keys, **args)
+
+def timed_call(fn, *args):
+    # fn(*args) plus its start time, duration, process and thread, for spans of work that runs in a pool
+    start_time, start = time.time(), time.perf_counter()
+    result = fn(*args)
+    return result, (start_time, time.perf_counter() - start, os.getpid(), threading.get_ident())
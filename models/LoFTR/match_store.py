@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+# Binary, memory-mappable storage of LoFTR matches, one file per scene.
+# The matches of all pairs are concatenated into flat arrays (mkpts0, mkpts1, mconf) and an offsets array marks where
+# each pair starts (CSR layout), so the matches of pair i are rows offsets[i]:offsets[i+1]. Reading a single pair only
+# touches these rows instead of parsing the whole scene.
+#
+# File layout:
+#   8 bytes     magic
+#   8 bytes     length of the JSON header (little endian)
+#   header      JSON with the pair list and dtype/shape/position of every array
+#   arrays      offsets (int64), mkpts0, mkpts1, mconf, inliers (bool), fund_matrix (float64), each aligned to 64 bytes
+
+MAGIC = b'LOFTRMS1'
+ALIGN = 64
+CHUNK_ROWS = 1 << 20
+MATCH_ARRAYS = ['mkpts0', 'mkpts1', 'mconf', 'inliers']
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+def _memmap(path, dtype, shape, offset=0):
+    # np.memmap refuses empty arrays
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def write_match_store(path, pairs, offsets, arrays):
+    """
+    Write a match store file.
+
+    Args:
+        path:           Output file
+        pairs:          List of (image_id0, image_id1) pairs
+        offsets:        int64 array of length len(pairs) + 1 with the first match row of every pair
+        arrays:         Dictionary with the concatenated 'mkpts0', 'mkpts1', 'mconf', 'inliers' arrays and the
+                        (len(pairs), 3, 3) 'fund_matrix' array. These may be memory-mapped, they are copied
+                        in chunks.
+    """
+    arrays = dict(arrays, offsets=np.asarray(offsets, dtype=np.int64))
+    order = ['offsets'] + MATCH_ARRAYS + ['fund_matrix']
+    layout = {}
+    position = 0
+    for name in order:
+        array = arrays[name]
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position = _aligned(position + array.nbytes)
+    header = json.dumps({'version': 1, 'pairs': [list(pair) for pair in pairs], 'arrays': layout}).encode()
+    data_start = _aligned(16 + len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name in order:
+            f.seek(data_start + layout[name]['offset'])
+            for start in range(0, len(arrays[name]), CHUNK_ROWS):
+                f.write(np.ascontiguousarray(arrays[name][start:start + CHUNK_ROWS]).tobytes())
+        f.truncate(data_start + position)
+
+class MatchStore:
+    """
+    Read-only view of a match store file. Arrays are memory-mapped, so opening a store is cheap and looking up the
+    matches of a pair is O(1).
+
+    Example:
+        >>> store = MatchStore('brandenburg_gate.matches')
+        >>> matches = store[('image_a.jpg', 'image_b.jpg')]
+        >>> matches['mkpts0'].shape
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(8) != MAGIC:
+                raise ValueError(f'{path} is not a match store file')
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len))
+        data_start = _aligned(16 + header_len)
+        self.pairs = [tuple(pair) for pair in header['pairs']]
+        self._index = {pair: i for i, pair in enumerate(self.pairs)}
+        self.arrays = {}
+        for name, spec in header['arrays'].items():
+            self.arrays[name] = _memmap(path, spec['dtype'], tuple(spec['shape']), data_start + spec['offset'])
+        self.offsets = self.arrays['offsets']
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __contains__(self, pair):
+        return tuple(pair) in self._index
+
+    def index(self, pair):
+        return self._index[tuple(pair)]
+
+    def __getitem__(self, key):
+        # key is either the position of the pair in the store or the (image_id0, image_id1) pair itself.
+        i = key if isinstance(key, (int, np.integer)) else self.index(key)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        matches = {name: self.arrays[name][start:end] for name in MATCH_ARRAYS}
+        matches['fund_matrix'] = self.arrays['fund_matrix'][i]
+        return matches
+
+    def to_dataframe(self):
+        # Same columns as the results DataFrame of LoFTR.py, with the keypoints converted back to float32.
+        records = []
+        for i, pair in enumerate(self.pairs):
+            matches = self[i]
+            F = np.array(matches['fund_matrix'])
+            inliers = np.array(matches['inliers'])
+            records.append({'pair': pair, 'fund_matrix': F,
+                            'mkpts0': matches['mkpts0'].astype(np.float32),
+                            'mkpts1': matches['mkpts1'].astype(np.float32),
+                            'mconf': matches['mconf'].astype(np.float32),
+                            'fund_matrix_eval': " ".join(str(num) for num in F.flatten().tolist()),
+                            'inliers': inliers, 'n_inliers': int(inliers.sum())})
+        return pd.DataFrame(records, columns=['pair', 'fund_matrix', 'mkpts0', 'mkpts1', 'mconf', 'fund_matrix_eval',
+                                              'inliers', 'n_inliers'])
+
+class MatchStoreSink:
+    """
+    Output sink for checkpoint.CheckpointWriter that produces a match store.
+
+    While the run is in progress the columns are appended to raw files in '<path>.parts/', which can be cut back to any
+    flushed state for resuming. close() assembles them into the single store file.
+
+    Args:
+        path:           Store file to write
+        dtype:          dtype of the keypoint and confidence arrays, 'float32' or 'float16' (half the size, but
+                        keypoints above 1024 px are only kept to 1 px)
+    """
+
+    def __init__(self, path, dtype='float32'):
+        self.path = path
+        self.parts_dir = path + '.parts'
+        self.dtype = np.dtype(dtype)
+        self.n_pairs = 0
+        self.n_matches = 0
+        self.pairs_bytes = 0
+        self._files = {}
+
+    def _part(self, name):
+        return os.path.join(self.parts_dir, name)
+
+    def _state(self):
+        return {'pairs': self.n_pairs, 'matches': self.n_matches, 'pairs_bytes': self.pairs_bytes,
+                'dtype': self.dtype.str}
+
+    def open(self, state=None):
+        if state is not None and not os.path.isdir(self.parts_dir) and os.path.exists(self.path):
+            self._unpack()
+        if state is None:
+            shutil.rmtree(self.parts_dir, ignore_errors=True)
+            os.makedirs(self.parts_dir)
+        else:
+            if np.dtype(state['dtype']) != self.dtype:
+                raise ValueError(f"{self.path} was written with dtype {state['dtype']}, cannot resume with {self.dtype}")
+            self.n_pairs, self.n_matches, self.pairs_bytes = state['pairs'], state['matches'], state['pairs_bytes']
+        sizes = {'counts.bin': 8 * self.n_pairs, 'fund_matrix.bin': 72 * self.n_pairs,
+                 'mkpts0.bin': 2 * self.dtype.itemsize * self.n_matches,
+                 'mkpts1.bin': 2 * self.dtype.itemsize * self.n_matches,
+                 'mconf.bin': self.dtype.itemsize * self.n_matches, 'inliers.bin': self.n_matches,
+                 'pairs.jsonl': self.pairs_bytes}
+        for name, size in sizes.items():
+            f = open(self._part(name), 'r+b' if state is not None else 'w+b')
+            if state is not None and os.path.getsize(self._part(name)) < size:
+                raise ValueError(f'{self._part(name)} is shorter than recorded in its progress file, cannot resume')
+            f.truncate(size)
+            f.seek(size)
+            self._files[name] = f
+
+    def _unpack(self):
+        # Turn a finished store back into part files, so that a completed or interrupted store can be extended.
+        store = MatchStore(self.path)
+        os.makedirs(self.parts_dir)
+        counts = np.diff(store.offsets)
+        columns = {'counts.bin': counts.astype(np.int64), 'fund_matrix.bin': store.arrays['fund_matrix']}
+        columns.update({f'{name}.bin': store.arrays[name] for name in MATCH_ARRAYS})
+        for name, array in columns.items():
+            with open(self._part(name), 'wb') as f:
+                for start in range(0, len(array), CHUNK_ROWS):
+                    f.write(np.ascontiguousarray(array[start:start + CHUNK_ROWS]).tobytes())
+        with open(self._part('pairs.jsonl'), 'wb') as f:
+            for pair in store.pairs:
+                f.write((json.dumps(list(pair)) + '\n').encode())
+
+    def append(self, records):
+        for record in records:
+            mkpts0 = np.asarray(record['mkpts0'], dtype=self.dtype).reshape(-1, 2)
+            mkpts1 = np.asarray(record['mkpts1'], dtype=self.dtype).reshape(-1, 2)
+            mconf = np.asarray(record['mconf'], dtype=self.dtype).reshape(-1)
+            inliers = np.asarray(record['inliers'], dtype=bool).reshape(-1)
+            F = np.asarray(record['fund_matrix'], dtype=np.float64).reshape(3, 3)
+            line = (json.dumps(list(record['pair'])) + '\n').encode()
+            self._files['mkpts0.bin'].write(mkpts0.tobytes())
+            self._files['mkpts1.bin'].write(mkpts1.tobytes())
+            self._files['mconf.bin'].write(mconf.tobytes())
+            self._files['inliers.bin'].write(inliers.tobytes())
+            self._files['fund_matrix.bin'].write(F.tobytes())
+            self._files['counts.bin'].write(np.array([len(mconf)], dtype=np.int64).tobytes())
+            self._files['pairs.jsonl'].write(line)
+            self.n_pairs += 1
+            self.n_matches += len(mconf)
+            self.pairs_bytes += len(line)
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        return self._state()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        with open(self._part('pairs.jsonl'), 'rb') as f:
+            pairs = [tuple(json.loads(line)) for line in f.read(self.pairs_bytes).splitlines()]
+        counts = _memmap(self._part('counts.bin'), np.int64, (self.n_pairs,))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        arrays = {'mkpts0': _memmap(self._part('mkpts0.bin'), self.dtype, (self.n_matches, 2)),
+                  'mkpts1': _memmap(self._part('mkpts1.bin'), self.dtype, (self.n_matches, 2)),
+                  'mconf': _memmap(self._part('mconf.bin'), self.dtype, (self.n_matches,)),
+                  'inliers': _memmap(self._part('inliers.bin'), bool, (self.n_matches,)),
+                  'fund_matrix': _memmap(self._part('fund_matrix.bin'), np.float64, (self.n_pairs, 3, 3))}
+        write_match_store(self.path, pairs, offsets, arrays)
+        del counts, arrays
+        shutil.rmtree(self.parts_dir)
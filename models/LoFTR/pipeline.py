@@ -0,0 +1,157 @@
+import time
+import queue
+import threading
+from collections import deque
+from contextlib import nullcontext
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Streaming helpers to overlap the stages of LoFTR.py: image loading runs ahead in a background thread, and the
+# fundamental matrix estimation of finished pairs runs in a thread or process pool while LoFTR works on the next pairs.
+# Every stage records how long it stalled and how full its queue was, to show which stage is the bottleneck.
+
+class StageStats:
+    """
+    Counters of one pipeline stage.
+
+    producer_wait is the time the stage feeding the queue waited because the queue was full (the stage after the
+    queue is slower), consumer_wait the time the stage after the queue waited for input (the stage before is slower).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.producer_wait = 0.
+        self.consumer_wait = 0.
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def record_depth(self, depth):
+        self.items += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def summary(self):
+        mean_depth = self.depth_sum / self.items if self.items else 0.
+        return (f'{self.name}: {self.items} items, queue depth mean {mean_depth:.1f} / max {self.max_depth}, '
+                f'stalled {self.producer_wait:.1f}s on full queue, consumer stalled {self.consumer_wait:.1f}s')
+
+class PipelineStats:
+    def __init__(self):
+        self.stages = {}
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats(name)
+        return self.stages[name]
+
+    def summary(self):
+        return '\n'.join(stage.summary() for stage in self.stages.values())
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+def _put(q, item, stop):
+    # Blocking put that gives up once the consumer is gone.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def prefetch(iterable, depth, stats=None):
+    """
+    Iterate over iterable in a background thread, keeping up to depth items ready.
+
+    Exceptions of the producer are re-raised in the consumer. If the consumer stops early, the producer thread ends
+    at its next put.
+    """
+    stats = stats or StageStats('prefetch')
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                start = time.perf_counter()
+                if not _put(q, item, stop):
+                    return
+                stats.producer_wait += time.perf_counter() - start
+            _put(q, _DONE, stop)
+        except BaseException as exc:
+            _put(q, _Failure(exc), stop)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            depth_now = q.qsize()
+            start = time.perf_counter()
+            item = q.get()
+            stats.consumer_wait += time.perf_counter() - start
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            stats.record_depth(depth_now)
+            yield item
+    finally:
+        stop.set()
+
+def make_pool(workers, processes=False, initializer=None, initargs=()):
+    # Thread pool, or a process pool with spawned workers (forking a process that runs torch is not safe)
+    if processes:
+        return ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'), initializer=initializer,
+                                   initargs=initargs)
+    return ThreadPoolExecutor(workers)
+
+def map_ordered(fn, iterable, workers, stats=None, max_pending=None, processes=False, args=None, initializer=None,
+                initargs=(), executor=None):
+    """
+    Apply fn to every item of iterable in a pool and yield (item, result) in input order.
+
+    Args:
+        workers:        Number of threads (or processes) of the pool
+        max_pending:    At most this many calls (default 2 * workers) are in flight, so a slow fn throttles the
+                        producer instead of piling up results in memory
+        processes:      Use a process pool instead of threads, for work that holds the GIL. fn and its arguments
+                        have to be picklable then.
+        args:           Function that turns an item into the positional arguments of fn (default: the item itself),
+                        e.g. to send only part of an item to a worker process
+        initializer:    Called with initargs once in every worker process (processes=True only), e.g. to load a model
+        executor:       Use this pool (see make_pool) instead of starting one, e.g. to keep the same processes over
+                        many calls; it is not shut down afterwards
+    """
+    stats = stats or StageStats('map')
+    max_pending = max_pending or 2 * workers
+    args = args or (lambda item: (item,))
+    pending = deque()
+
+    def pop_first():
+        item, future = pending.popleft()
+        start = time.perf_counter()
+        result = future.result()
+        return item, result, time.perf_counter() - start
+
+    pool = executor or make_pool(workers, processes, initializer, initargs)
+    with nullcontext() if executor is not None else pool:
+        for item in iterable:
+            stats.record_depth(len(pending))
+            pending.append((item, pool.submit(fn, *args(item))))
+            if len(pending) >= max_pending:
+                # The pool is full: the producer of the items waits for the pool.
+                item, result, waited = pop_first()
+                stats.producer_wait += waited
+                yield item, result
+            while pending and pending[0][1].done():
+                item, result, _ = pop_first()
+                yield item, result
+        while pending:
+            item, result, waited = pop_first()
+            stats.consumer_wait += waited
+            yield item, result
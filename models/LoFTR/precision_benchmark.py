@@ -0,0 +1,70 @@
+import os
+import time
+import argparse
+import torch
+import validation
+from LoFTR import get_device, load_gray_image, load_matcher, match_pair, sample_id
+from covisibility import select_covisible_pairs
+from image_cache import ImageCache
+from precision import PRECISIONS
+from verification import find_fundamental_matrix
+
+# Throughput and accuracy of the LoFTR inference precisions (see precision.py) on a validation subset of a train scene.
+# The pairs are drawn evenly over the covisibility range, e.g.
+#   python precision_benchmark.py --filepath ../../data/train/brandenburg_gate/images --sample-per-bin 5
+
+def benchmark(matcher, pairs, filepath, device, cache):
+    # Returns the F strings for validation.evaluate, the total number of matches and the total matching time.
+    fund_matrix_list, n_matches, seconds = [], 0, 0.
+    for img_id0, img_id1 in pairs:
+        img0 = load_gray_image(os.path.join(filepath, img_id0), device, cache)
+        img1 = load_gray_image(os.path.join(filepath, img_id1), device, cache)
+        start = time.perf_counter()
+        mkpts0, mkpts1, mconf = match_pair(matcher, img0, img1)
+        seconds += time.perf_counter() - start
+        n_matches += len(mkpts0)
+        F, _ = find_fundamental_matrix(mkpts0, mkpts1)
+        fund_matrix_list.append(" ".join(str(num) for num in F.flatten().tolist()))
+    return fund_matrix_list, n_matches, seconds
+
+def main(filepath, precisions=PRECISIONS, threshold=0.1, sample_per_bin=5, seed=0):
+    scene_dir = os.path.dirname(os.path.normpath(filepath))
+    scene, input_dir = os.path.basename(scene_dir), os.path.dirname(scene_dir)
+    pairs = select_covisible_pairs(filepath, threshold, sample_per_bin, seed=seed)
+    sample_id_list = [sample_id(scene, pair) for pair in pairs]
+    device = get_device()
+    # Decode every image once up front, so only the matcher is timed.
+    cache = ImageCache(2**40)
+    report = {}
+    for precision in precisions:
+        print(f'{precision}: matching {len(pairs)} pairs')
+        matcher = load_matcher(device, precision)
+        # Warm-up pass, the first forward pass includes one-off allocations.
+        if pairs:
+            benchmark(matcher, pairs[:1], filepath, device, cache)
+        fund_matrix_list, n_matches, seconds = benchmark(matcher, pairs, filepath, device, cache)
+        maa = validation.evaluate(input_dir, sample_id_list, fund_matrix_list)
+        report[precision] = (n_matches, seconds, maa)
+
+    print(f"{'precision':<10}{'pairs/s':>10}{'matches':>10}{'matches/s':>12}{'mAA':>10}{'delta mAA':>12}")
+    reference = report[precisions[0]][2]
+    for precision, (n_matches, seconds, maa) in report.items():
+        seconds = max(seconds, 1e-12)
+        print(f'{precision:<10}{len(pairs) / seconds:>10.2f}{n_matches:>10}{n_matches / seconds:>12.1f}'
+              f'{maa:>10.4f}{maa - reference:>+12.4f}')
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare LoFTR inference precisions on a validation subset.')
+    parser.add_argument('--filepath', required=True, help='images folder of a train scene')
+    parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=PRECISIONS,
+                        help='precisions to compare, the mAA delta is relative to the first one')
+    parser.add_argument('--covisibility-threshold', type=float, default=0.1)
+    parser.add_argument('--sample-per-bin', type=int, default=5,
+                        help='number of pairs sampled from each of 10 covisibility bins')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 keeps the default)')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    main(args.filepath, args.precisions, args.covisibility_threshold, args.sample_per_bin, args.seed)
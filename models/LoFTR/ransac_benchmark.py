@@ -0,0 +1,61 @@
+import time
+import argparse
+import numpy as np
+from tqdm import tqdm
+import validation
+from LoFTR import sample_id
+from match_store import MatchStore
+from verification import DEFAULT_ADAPTIVE, DEFAULT_RANSAC, find_fundamental_matrix, find_fundamental_matrix_adaptive
+
+# Compare time and accuracy of the fixed-budget and the adaptive geometric verification on stored matches.
+# Run LoFTR.py with --output-format store on a train scene first (the CSV output truncates long keypoint arrays), e.g.
+#   python ransac_benchmark.py --store brandenburg_gate.matches --input-dir ../../data/train --scene brandenburg_gate
+
+def run_verification(store, indices, verify):
+    # Returns the F strings in the format of the fund_matrix_eval column, and the time per pair in seconds.
+    fund_matrix_list, times = [], []
+    for i in tqdm(indices):
+        matches = store[i]
+        mkpts0 = np.asarray(matches['mkpts0'], dtype=np.float32)
+        mkpts1 = np.asarray(matches['mkpts1'], dtype=np.float32)
+        mconf = np.asarray(matches['mconf'], dtype=np.float32)
+        start = time.perf_counter()
+        F, _ = verify(mkpts0, mkpts1, mconf)
+        times.append(time.perf_counter() - start)
+        fund_matrix_list.append(" ".join(str(num) for num in F.flatten().tolist()))
+    return fund_matrix_list, np.array(times)
+
+def main(store_path, input_dir, scene, limit=None, adaptive=DEFAULT_ADAPTIVE, ransac=DEFAULT_RANSAC):
+    store = MatchStore(store_path)
+    indices = list(range(len(store)))[:limit]
+    sample_id_list = [sample_id(scene, store.pairs[i]) for i in indices]
+    modes = {
+        'fixed': lambda mkpts0, mkpts1, mconf: find_fundamental_matrix(mkpts0, mkpts1, ransac),
+        'adaptive': lambda mkpts0, mkpts1, mconf: find_fundamental_matrix_adaptive(mkpts0, mkpts1, mconf,
+                                                                                   ransac, adaptive),
+    }
+    report = {}
+    for name, verify in modes.items():
+        print(f'running {name} verification on {len(indices)} pairs')
+        fund_matrix_list, times = run_verification(store, indices, verify)
+        maa = validation.evaluate(input_dir, sample_id_list, fund_matrix_list)
+        report[name] = (times, maa)
+
+    print(f"{'mode':<10}{'total [s]':>12}{'mean [ms]':>12}{'median [ms]':>14}{'mAA':>10}")
+    for name, (times, maa) in report.items():
+        print(f'{name:<10}{times.sum():>12.2f}{1000 * times.mean():>12.2f}{1000 * np.median(times):>14.2f}{maa:>10.4f}')
+    speedup = report['fixed'][0].sum() / max(report['adaptive'][0].sum(), 1e-12)
+    print(f"speedup {speedup:.1f}x, mAA delta {report['adaptive'][1] - report['fixed'][1]:+.4f}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark fixed against adaptive RANSAC on stored LoFTR matches.')
+    parser.add_argument('--store', required=True, help='match store written by LoFTR.py --output-format store')
+    parser.add_argument('--input-dir', required=True, help='train directory of the dataset (with scaling_factors.csv)')
+    parser.add_argument('--scene', required=True, help='scene the matches belong to')
+    parser.add_argument('--limit', type=int, default=None, help='only use the first n pairs of the store')
+    parser.add_argument('--min-conf', type=float, default=DEFAULT_ADAPTIVE.min_conf)
+    parser.add_argument('--max-matches', type=int, default=DEFAULT_ADAPTIVE.max_matches)
+    args = parser.parse_args()
+    main(args.store, args.input_dir, args.scene, args.limit,
+         DEFAULT_ADAPTIVE._replace(min_conf=args.min_conf, max_matches=args.max_matches))
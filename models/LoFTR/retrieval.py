@@ -0,0 +1,89 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+
+# Retrieval stage to prune the all-pairs list before matching.
+# Every image gets a cheap global descriptor (gradient orientation histograms on a grid over a small grayscale
+# thumbnail, similar to HOG), and each image is only paired with its k most similar images. This brings the number of
+# pairs from N*(N-1)/2 down to at most N*k.
+
+THUMB_SIZE = 128
+GRID = 8
+BINS = 9
+
+def global_descriptor(imgpath):
+    # Decode at reduced size right away, the descriptor only needs a thumbnail.
+    img = cv2.imread(imgpath, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    img = cv2.resize(img, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA)
+    img = cv2.equalizeHist(img).astype(np.float32)
+    gx = cv2.Sobel(img, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(img, cv2.CV_32F, 0, 1)
+    magnitude = np.sqrt(gx**2 + gy**2)
+    # Unsigned orientation, so that bright-on-dark and dark-on-bright edges look the same
+    bins = (np.arctan2(gy, gx) % np.pi / np.pi * BINS).astype(np.int64) % BINS
+    cells = (np.arange(THUMB_SIZE) * GRID // THUMB_SIZE)
+    cell_index = cells[:, None] * GRID + cells[None, :]
+    desc = np.bincount((cell_index * BINS + bins).flatten(), weights=magnitude.flatten(),
+                       minlength=GRID * GRID * BINS).astype(np.float32)
+    # Power normalization dampens dominant gradient bins before the final L2 normalization.
+    desc = np.sqrt(desc)
+    return desc / (np.linalg.norm(desc) + 1e-12)
+
+def compute_descriptors(filepath, image_ids):
+    return np.stack([global_descriptor(os.path.join(filepath, str(image_id))) for image_id in image_ids])
+
+def nearest_neighbours(descriptors, k, chunk_size=1024):
+    """
+    Indices of the k most similar images (cosine similarity) for every image, excluding the image itself.
+
+    Similarities are computed in row chunks, so memory stays at chunk_size x N.
+    """
+    n = len(descriptors)
+    k = min(k, n - 1)
+    neighbours = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, chunk_size):
+        sim = descriptors[start:start + chunk_size] @ descriptors.T
+        rows = np.arange(sim.shape[0])
+        sim[rows, start + rows] = -np.inf
+        neighbours[start:start + chunk_size] = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+    return neighbours
+
+def retrieve_pairs(filepath, pairs, k):
+    """
+    Keep only the pairs in which one image is among the k nearest neighbours of the other.
+
+    Args:
+        filepath:       Directory of the images
+        pairs:          Candidate pairs, as returned by LoFTR.get_pairs
+        k:              Number of retrieved partners per image
+
+    Returns:
+        List of the kept pairs, in their original order
+    """
+    image_ids = sorted({image_id for pair in pairs for image_id in pair})
+    if len(image_ids) < 2:
+        return list(pairs)
+    index = {image_id: i for i, image_id in enumerate(image_ids)}
+    neighbours = nearest_neighbours(compute_descriptors(filepath, image_ids), k)
+    keep = np.zeros((len(image_ids), len(image_ids)), dtype=bool)
+    rows = np.repeat(np.arange(len(image_ids)), neighbours.shape[1])
+    keep[rows, neighbours.flatten()] = True
+    keep |= keep.T
+    return [pair for pair in pairs if keep[index[pair[0]], index[pair[1]]]]
+
+def covisible_pairs(covisibility_csv, threshold=0.1):
+    # Set of frozenset({image_id0, image_id1}) of the pairs at or above the covisibility threshold.
+    covisibility = pd.read_csv(covisibility_csv)
+    covisibility = covisibility[covisibility['covisibility'] >= threshold]
+    return {frozenset(pair.split('-')) for pair in covisibility['pair']}
+
+def pruning_recall(pairs, covisibility_csv, threshold=0.1):
+    """
+    Fraction of the covisible pairs of a scene that survived the pruning.
+
+    Image ids in pair_covisibility.csv come without file extension, so the extensions of the pairs are dropped.
+    """
+    gt = covisible_pairs(covisibility_csv, threshold)
+    kept = {frozenset(os.path.splitext(str(image_id))[0] for image_id in pair) for pair in pairs}
+    return len(gt & kept) / len(gt) if gt else 1.
@@ -0,0 +1,152 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing as mp
+import torch
+import cv2
+from tqdm import tqdm
+from preprocessing import get_scenes
+from covisibility import select_covisible_pairs
+from checkpoint import read_progress
+import LoFTR
+
+# Runs LoFTR.py on every scene of a train root (<train_dir>/<scene>/images) in one call:
+#   python run_scenes.py --train-dir ../../data/train --output-dir results --scene-workers 2
+# The cost of a scene is estimated from its number of pairs, and the scenes are handed to the worker pool largest
+# first. A big scene that starts last would otherwise run alone at the end while the other workers are idle.
+# Progress is shown for all scenes together, in pairs, with an ETA.
+
+def count_pairs(filepath, covisibility_threshold=None, sample_per_bin=0, retrieval_k=0, seed=0):
+    # Number of pairs LoFTR.main will match for the images in filepath (an upper bound with retrieval_k)
+    if covisibility_threshold is not None:
+        return len(select_covisible_pairs(filepath, covisibility_threshold, sample_per_bin, seed=seed))
+    n_images = len(os.listdir(filepath))
+    n_pairs = n_images * (n_images - 1) // 2
+    if retrieval_k > 0:
+        n_pairs = min(n_pairs, n_images * retrieval_k)
+    return n_pairs
+
+def plan_scenes(train_dir, scenes=None, covisibility_threshold=None, sample_per_bin=0, retrieval_k=0, seed=0):
+    """
+    Returns:
+        List of (scene, number of pairs), largest first
+    """
+    scenes = scenes or get_scenes(train_dir)
+    plan = [(scene, count_pairs(os.path.join(train_dir, scene, 'images'), covisibility_threshold, sample_per_bin,
+                                retrieval_k, seed)) for scene in scenes]
+    return sorted(plan, key=lambda item: item[1], reverse=True)
+
+def resumed_pairs(plan, output_dir, output_format='csv'):
+    # Number of pairs of every planned scene that LoFTR.main with resume finds already done in the scene's output
+    done = []
+    for scene, n_pairs in plan:
+        progress_path = LoFTR.get_sink(os.path.join(output_dir, scene), output_format).path + '.progress'
+        completed = read_progress(progress_path)[1] if os.path.exists(progress_path) else set()
+        done.append(min(len(completed), n_pairs))
+    return done
+
+# State of a scene worker process, set up once per process by init_scene_worker.
+_scene_worker = {}
+
+def init_scene_worker(num_threads, counters):
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    _scene_worker['counters'] = counters
+
+def run_scene(index, scene, train_dir, output_dir, kwargs):
+    # Runs LoFTR.main on one scene and counts its finished pairs in the shared counter of the scene.
+    # Returns the wall time in seconds.
+    counter = _scene_worker['counters'][index]
+
+    def on_pair():
+        with counter.get_lock():
+            counter.value += 1
+
+    start = time.perf_counter()
+    LoFTR.main(filepath=os.path.join(train_dir, scene, 'images'), output=os.path.join(output_dir, scene),
+               on_pair=on_pair, **kwargs)
+    return time.perf_counter() - start
+
+def run_scenes(train_dir, output_dir, scene_workers=1, scenes=None, threads=0, poll_interval=1., **kwargs):
+    """
+    Run LoFTR.main for the scenes of train_dir in a pool of scene_workers processes, largest scene first.
+
+    Args:
+        train_dir:      Directory with one <scene>/images folder per scene
+        output_dir:     The results of every scene are written to <output_dir>/<scene>.csv (or .matches)
+        scene_workers:  Number of scenes processed at the same time
+        scenes:         Only these scenes (default: all scenes of train_dir)
+        threads:        torch and OpenCV threads per scene worker (default: the cores split between the workers)
+        kwargs:         Further arguments of LoFTR.main, e.g. covisibility_threshold or output_format
+
+    Returns:
+        Dictionary of scene -> (number of pairs, wall time in seconds)
+    """
+    plan = plan_scenes(train_dir, scenes, kwargs.get('covisibility_threshold'), kwargs.get('sample_per_bin', 0),
+                       kwargs.get('retrieval_k', 0), kwargs.get('seed', 0))
+    print('scenes, largest first: ' + ', '.join(f'{scene} ({n_pairs} pairs)' for scene, n_pairs in plan))
+    os.makedirs(output_dir, exist_ok=True)
+    threads = threads or max(1, (os.cpu_count() or 1) // scene_workers)
+    ctx = mp.get_context('spawn')
+    counters = [ctx.Value('q', 0) for _ in plan]
+    times = {}
+    # A resumed scene only matches (and counts) the pairs that are not in its output yet, so the bar starts at those.
+    done = [0] * len(plan)
+    if kwargs.get('resume'):
+        done = resumed_pairs(plan, output_dir, kwargs.get('output_format', 'csv'))
+        print(f'resuming: {sum(done)} pairs already done')
+    pool = ProcessPoolExecutor(scene_workers, mp_context=ctx, initializer=init_scene_worker,
+                               initargs=(threads, counters))
+    with pool, tqdm(total=sum(n_pairs for _, n_pairs in plan), initial=sum(done), unit='pair') as pbar:
+        # The executor starts its tasks in submission order, so submitting largest first schedules largest first.
+        futures = {pool.submit(run_scene, i, scene, train_dir, output_dir, kwargs): i
+                   for i, (scene, _) in enumerate(plan)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                scene, n_pairs = plan[futures[future]]
+                times[scene] = (n_pairs, future.result())
+            # The pair counts are estimates (e.g. with retrieval), so a finished scene counts with its estimate.
+            progress = sum(n_pairs if scene in times else min(n_done + counter.value, n_pairs)
+                           for (scene, n_pairs), n_done, counter in zip(plan, done, counters))
+            pbar.update(progress - pbar.n)
+            pbar.set_postfix_str(f'{len(times)}/{len(plan)} scenes done')
+    return times
+
+def print_times(times):
+    print(f"{'scene':<30}{'pairs':>8}{'time [s]':>10}{'pairs/s':>9}")
+    for scene, (n_pairs, seconds) in sorted(times.items(), key=lambda item: item[1][0], reverse=True):
+        print(f'{scene:<30}{n_pairs:>8}{seconds:>10.1f}{n_pairs / seconds:>9.2f}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run LoFTR.py on all scenes of a train directory.')
+    parser.add_argument('--train-dir', required=True, help='directory with one <scene>/images folder per scene')
+    parser.add_argument('--output-dir', default='.', help='the results of a scene go to <output-dir>/<scene>.csv')
+    parser.add_argument('--scenes', nargs='+', default=None, help='only run these scenes')
+    parser.add_argument('--scene-workers', type=int, default=1, help='number of scenes processed at the same time')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch and OpenCV threads per scene worker (0 splits the cores between the workers)')
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help='memory budget in MB for decoded images kept between pairs, per scene worker')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of image pairs with matching (padded) shapes per LoFTR forward pass')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue interrupted scenes, skipping the pairs already written to their output')
+    parser.add_argument('--output-format', choices=['csv', 'store'], default='csv',
+                        help="'csv' for <scene>.csv, 'store' for a compact memory-mappable <scene>.matches file")
+    parser.add_argument('--retrieval-k', type=int, default=0,
+                        help='only match every image with its k most similar images by global descriptor (0 matches all pairs)')
+    parser.add_argument('--covisibility-threshold', type=float, default=None,
+                        help="match only the pairs of each scene's pair_covisibility.csv with at least this covisibility")
+    parser.add_argument('--sample-per-bin', type=int, default=0,
+                        help='with --covisibility-threshold, sample at most this many pairs from each of 10 covisibility bins')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for --sample-per-bin')
+    args = parser.parse_args()
+    times = run_scenes(args.train_dir, args.output_dir, args.scene_workers, args.scenes, args.threads,
+                       cache_mb=args.cache_mb, batch_size=args.batch_size, resume=args.resume,
+                       output_format=args.output_format, retrieval_k=args.retrieval_k,
+                       covisibility_threshold=args.covisibility_threshold, sample_per_bin=args.sample_per_bin,
+                       seed=args.seed)
+    print_times(times)
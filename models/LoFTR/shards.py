@@ -0,0 +1,186 @@
+import os
+import ast
+import json
+import hashlib
+import argparse
+import pandas as pd
+from match_store import MatchStore, MatchStoreSink
+
+# Deterministic sharding of the pair list, to split one scene over several machines without a coordinator:
+#   node k of N:    python LoFTR.py --filepath <images> --shard k/N
+#   afterwards:     python shards.py --output <name> <images>.shard*of*.json
+# A pair belongs to the shard given by a hash of its two image ids, so every node selects the same subset no matter
+# in which order os.listdir returns the images or in which orientation the pair appears. Every shard writes a manifest
+# next to its output with the pairs it is responsible for and a digest of the whole pair list. The merge uses these to
+# check that the shards add up to the full pair list, with no pair missing or duplicated.
+
+def parse_shard(text):
+    # 'k/N' -> (k, N) with 0 <= k < N
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard has to be given as 'k/N', got {text!r}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Shard index has to be in 0..N-1, got {text!r}')
+    return index, count
+
+def pair_key(pair):
+    # Same key for (a, b) and (b, a)
+    return '-'.join(sorted(str(image_id) for image_id in pair))
+
+def shard_of(pair, count):
+    return int(hashlib.sha1(pair_key(pair).encode()).hexdigest()[:16], 16) % count
+
+def select_shard(pairs, index, count):
+    # The pairs of shard index out of count, in their original order
+    return [pair for pair in pairs if shard_of(pair, count) == index]
+
+def keys_digest(keys):
+    digest = hashlib.sha1()
+    for key in sorted(keys):
+        digest.update(key.encode() + b'\n')
+    return digest.hexdigest()
+
+def pairs_digest(pairs):
+    # Fingerprint of a pair list that does not depend on the order or orientation of the pairs
+    return keys_digest(pair_key(pair) for pair in pairs)
+
+def shard_name(name, index, count):
+    return f'{name}.shard{index}of{count}'
+
+def write_manifest(name, output_path, index, count, all_pairs, pairs):
+    # <name>.json with the shard's pairs and the digest of the full pair list
+    manifest = {'shard': index, 'count': count, 'output': os.path.basename(output_path),
+                'total_pairs': len(all_pairs), 'digest': pairs_digest(all_pairs),
+                'pairs': [list(pair) for pair in pairs]}
+    with open(f'{name}.json', 'w') as f:
+        json.dump(manifest, f)
+
+def read_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest['output'] = os.path.join(os.path.dirname(path), manifest['output'])
+    return manifest
+
+def read_output_pairs(path, chunksize=1024):
+    # Pairs of a results CSV or a match store, in file order
+    if path.endswith('.matches'):
+        return list(MatchStore(path).pairs)
+    pairs = []
+    for chunk in pd.read_csv(path, usecols=['pair'], chunksize=chunksize):
+        pairs += [tuple(ast.literal_eval(pair)) for pair in chunk['pair']]
+    return pairs
+
+def read_csv_header(path):
+    with open(path, 'rb') as f:
+        return f.readline()
+
+def check_shards(manifests):
+    """
+    Check that the shards are complete: all N shards of the same pair list are present, every output holds exactly
+    the pairs of its manifest, and together they cover the full pair list once. CSV outputs also need the same header
+    line, since merge_csv keeps only the first one.
+
+    Returns:
+        List of problems, empty if the shards can be merged
+    """
+    problems = []
+    counts = {manifest['count'] for manifest in manifests}
+    digests = {manifest['digest'] for manifest in manifests}
+    if len(counts) > 1 or len(digests) > 1:
+        return ['the manifests belong to different shardings or pair lists']
+    count = counts.pop()
+    indices = [manifest['shard'] for manifest in manifests]
+    missing_shards = sorted(set(range(count)) - set(indices))
+    if missing_shards:
+        problems.append(f'missing shards: {missing_shards}')
+    if len(indices) != len(set(indices)):
+        problems.append('a shard is given more than once')
+    seen = set()
+    for manifest in manifests:
+        expected = [tuple(pair) for pair in manifest['pairs']]
+        found = read_output_pairs(manifest['output'])
+        found_keys = [pair_key(pair) for pair in found]
+        name = os.path.basename(manifest['output'])
+        n_duplicated = len(found_keys) - len(set(found_keys))
+        if n_duplicated:
+            problems.append(f'{name}: {n_duplicated} pairs written more than once')
+        n_missing = len({pair_key(pair) for pair in expected} - set(found_keys))
+        if n_missing:
+            problems.append(f'{name}: {n_missing} of {len(expected)} pairs missing')
+        n_foreign = len(set(found_keys) - {pair_key(pair) for pair in expected})
+        if n_foreign:
+            problems.append(f'{name}: {n_foreign} pairs that do not belong to this shard')
+        overlap = seen & set(found_keys)
+        if overlap:
+            problems.append(f'{name}: {len(overlap)} pairs also in another shard')
+        seen |= set(found_keys)
+    headers = {os.path.basename(manifest['output']): read_csv_header(manifest['output'])
+               for manifest in manifests if not manifest['output'].endswith('.matches')}
+    if len(set(headers.values())) > 1:
+        first = next(iter(headers.values()))
+        differing = [name for name, header in headers.items() if header != first]
+        problems.append(f'the CSV header of {", ".join(differing)} differs from that of {next(iter(headers))}')
+    if not problems and keys_digest(seen) != digests.pop():
+        problems.append('the merged pairs do not match the digest of the full pair list')
+    return problems
+
+def merge_csv(paths, output_path):
+    # Concatenates the CSV outputs, keeping the header of the first one
+    with open(output_path, 'wb') as out:
+        for i, path in enumerate(paths):
+            with open(path, 'rb') as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                while True:
+                    block = f.read(1 << 24)
+                    if not block:
+                        break
+                    out.write(block)
+
+def merge_stores(paths, output_path, chunk_pairs=256):
+    stores = [MatchStore(path) for path in paths]
+    dtypes = {store.arrays['mkpts0'].dtype for store in stores}
+    if len(dtypes) > 1:
+        raise ValueError('The shards were written with different keypoint dtypes')
+    sink = MatchStoreSink(output_path, dtypes.pop())
+    sink.open()
+    for store in stores:
+        for start in range(0, len(store), chunk_pairs):
+            records = []
+            for i in range(start, min(start + chunk_pairs, len(store))):
+                matches = store[i]
+                records.append(dict(matches, pair=store.pairs[i]))
+            sink.append(records)
+    sink.close()
+
+def merge(manifest_paths, output):
+    """
+    Merge the outputs of all shards of a run into <output>.csv (or <output>.matches), in shard order.
+
+    Raises:
+        ValueError if the shards are incomplete or overlap (see check_shards)
+    """
+    manifests = sorted((read_manifest(path) for path in manifest_paths), key=lambda manifest: manifest['shard'])
+    problems = check_shards(manifests)
+    if problems:
+        raise ValueError('Cannot merge the shards:\n' + '\n'.join(problems))
+    paths = [manifest['output'] for manifest in manifests]
+    extensions = {os.path.splitext(path)[1] for path in paths}
+    if len(extensions) > 1:
+        raise ValueError('The shards were written in different output formats')
+    output_path = output + extensions.pop()
+    if output_path.endswith('.matches'):
+        merge_stores(paths, output_path)
+    else:
+        merge_csv(paths, output_path)
+    print(f"merged {len(manifests)} shards with {manifests[0]['total_pairs']} pairs into {output_path}")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge the outputs of a run of LoFTR.py split with --shard.')
+    parser.add_argument('manifests', nargs='+', help='the <output>.shard<k>of<N>.json manifests of all shards')
+    parser.add_argument('--output', required=True, help='merged output file name without extension')
+    args = parser.parse_args()
+    merge(args.manifests, args.output)
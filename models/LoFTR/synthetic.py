@@ -0,0 +1,253 @@
+import os
+import argparse
+from itertools import combinations
+import numpy as np
+import pandas as pd
+import cv2
+
+# Synthetic multi-view scenes with known geometry, written in the layout of the IMC 2022 train data:
+#   <output>/scaling_factors.csv
+#   <output>/<scene>/calibration.csv         image_id, camera_intrinsics, rotation_matrix, translation_vector
+#   <output>/<scene>/pair_covisibility.csv   pair, covisibility, fundamental_matrix
+#   <output>/<scene>/images/<image_id>.jpg
+# so that LoFTR.py, preprocessing.load_pairs and validation.evaluate run on them without any network access.
+#
+# A scene is a textured courtyard (ground and four walls) with a few textured boxes in it, rendered by ray casting
+# from cameras on an arc around the centre. Units are meters, so every scaling factor is 1. The default image size has
+# a long side of 1120, the resolution LoFTR.py matches at, so its keypoints are in the frame of the intrinsics below.
+
+PIXELS_PER_METER = 96
+MAX_TEXTURE_SIZE = 2048
+
+def make_texture(rng, width_m, height_m):
+    # Random texture for a plane: multi-scale noise plus random shapes, so that LoFTR finds structure at all scales
+    w = int(np.clip(width_m * PIXELS_PER_METER, 64, MAX_TEXTURE_SIZE))
+    h = int(np.clip(height_m * PIXELS_PER_METER, 64, MAX_TEXTURE_SIZE))
+    base = rng.uniform(60, 200, 3)
+    texture = np.zeros((h, w, 3), dtype=np.float32) + base
+    for cells in (4, 16, 64):
+        noise = rng.normal(0, 25, (max(2, h * cells // w), cells, 3)).astype(np.float32)
+        texture += cv2.resize(noise, (w, h), interpolation=cv2.INTER_CUBIC)
+    texture = np.clip(texture, 0, 255).astype(np.uint8)
+    n_shapes = int(w * h / 2000)
+    for _ in range(n_shapes):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, w)), int(rng.integers(0, h))
+        size = int(rng.integers(3, 24))
+        kind = rng.integers(3)
+        if kind == 0:
+            cv2.circle(texture, (x, y), size, color, -1)
+        elif kind == 1:
+            cv2.rectangle(texture, (x, y), (x + size, y + int(rng.integers(3, 24))), color, -1)
+        else:
+            cv2.line(texture, (x, y), (x + int(rng.integers(-40, 40)), y + int(rng.integers(-40, 40))), color, 2)
+    return texture
+
+def make_quad(origin, edge_u, edge_v, rng):
+    # A textured rectangle origin + a * edge_u + b * edge_v with a, b in [0, 1]
+    origin, edge_u, edge_v = (np.asarray(v, dtype=np.float64) for v in (origin, edge_u, edge_v))
+    return {'origin': origin, 'edge_u': edge_u, 'edge_v': edge_v, 'normal': np.cross(edge_u, edge_v),
+            'texture': make_texture(rng, np.linalg.norm(edge_u), np.linalg.norm(edge_v))}
+
+def make_box(center, size, yaw, rng):
+    # The four sides and the top of a box standing on the ground
+    c, s = np.cos(yaw), np.sin(yaw)
+    axis_x, axis_y = np.array([c, s, 0.]) * size[0], np.array([-s, c, 0.]) * size[1]
+    up = np.array([0., 0., size[2]])
+    corner = np.array([center[0], center[1], 0.]) - axis_x / 2 - axis_y / 2
+    return [make_quad(corner, axis_x, up, rng),
+            make_quad(corner + axis_x, axis_y, up, rng),
+            make_quad(corner + axis_x + axis_y, -axis_x, up, rng),
+            make_quad(corner + axis_y, -axis_y, up, rng),
+            make_quad(corner + up, axis_x, axis_y, rng)]
+
+def make_scene(rng, n_boxes=6, courtyard=16., wall_height=5.):
+    half = courtyard / 2
+    corners = [np.array(v) for v in ([-half, -half, 0], [half, -half, 0], [half, half, 0], [-half, half, 0])]
+    quads = [make_quad(corners[0], corners[1] - corners[0], corners[3] - corners[0], rng)]
+    for a, b in zip(corners, corners[1:] + corners[:1]):
+        quads.append(make_quad(a, b - a, [0, 0, wall_height], rng))
+    for _ in range(n_boxes):
+        center = rng.uniform(-3, 3, 2)
+        size = rng.uniform(0.6, 2.0, 3)
+        quads += make_box(center, size, rng.uniform(0, np.pi), rng)
+    return quads
+
+def look_at(center, target):
+    # World to camera rotation of a camera at center looking at target, with the world z axis pointing up in the image
+    forward = target - center
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, [0., 0., 1.])
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    return np.stack([right, down, forward])
+
+def make_cameras(rng, n_images, width, height, arc_degrees=120., radius=(5., 7.), camera_height=(1.2, 3.)):
+    """
+    Cameras on an arc around the scene centre, looking at points near the centre.
+
+    Returns:
+        List of (K, R, T), with x_camera = R @ x_world + T
+    """
+    cameras = []
+    start = rng.uniform(0, 2 * np.pi)
+    for angle in start + np.radians(np.linspace(0, arc_degrees, n_images)):
+        r = rng.uniform(*radius)
+        center = np.array([r * np.cos(angle), r * np.sin(angle), rng.uniform(*camera_height)])
+        target = np.array([*rng.uniform(-1, 1, 2), rng.uniform(0.3, 1.0)])
+        R = look_at(center, target)
+        focal = rng.uniform(0.8, 1.2) * max(width, height)
+        K = np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]])
+        cameras.append((K, R, -R @ center))
+    return cameras
+
+def ray_cast(quads, K, R, T, width, height):
+    """
+    Nearest quad hit by the ray through every pixel.
+
+    Returns:
+        depth:          (height, width) z-depth in camera coordinates, inf where no quad is hit
+        quad_id:        (height, width) index of the visible quad, -1 where no quad is hit
+        coords:         (height, width, 2) position (a, b) of the hit on the visible quad
+    """
+    center = -R.T @ T
+    u, v = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    # Ray directions with a camera z component of 1, so the ray parameter is the z-depth.
+    rays = np.stack([u, v, np.ones_like(u)], -1).reshape(-1, 3) @ np.linalg.inv(K).T @ R
+    depth = np.full(len(rays), np.inf)
+    quad_id = np.full(len(rays), -1)
+    coords = np.zeros((len(rays), 2))
+    for i, quad in enumerate(quads):
+        denom = rays @ quad['normal']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (quad['origin'] - center) @ quad['normal'] / denom
+        hit = center + t[:, None] * rays - quad['origin']
+        a = hit @ quad['edge_u'] / (quad['edge_u'] @ quad['edge_u'])
+        b = hit @ quad['edge_v'] / (quad['edge_v'] @ quad['edge_v'])
+        closer = (t > 1e-6) & (t < depth) & (a >= 0) & (a <= 1) & (b >= 0) & (b <= 1)
+        depth[closer] = t[closer]
+        quad_id[closer] = i
+        coords[closer] = np.stack([a[closer], b[closer]], -1)
+    return depth.reshape(height, width), quad_id.reshape(height, width), coords.reshape(height, width, 2)
+
+def render(quads, K, R, T, width, height, rng):
+    # Returns the BGR image and the depth map of one camera
+    depth, quad_id, coords = ray_cast(quads, K, R, T, width, height)
+    # Sky gradient where no quad is hit
+    sky = np.linspace(230, 170, height, dtype=np.float32)[:, None, None] * np.array([1.0, 0.9, 0.75], np.float32)
+    img = np.broadcast_to(sky, (height, width, 3)).copy()
+    light = np.array([0.4, 0.3, 0.87])
+    for i, quad in enumerate(quads):
+        mask = quad_id == i
+        if not mask.any():
+            continue
+        texture = quad['texture']
+        map_x = (coords[..., 0] * (texture.shape[1] - 1)).astype(np.float32)
+        map_y = (coords[..., 1] * (texture.shape[0] - 1)).astype(np.float32)
+        sampled = cv2.remap(texture, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+        shade = 0.6 + 0.4 * abs(quad['normal'] @ light) / np.linalg.norm(quad['normal'])
+        img[mask] = sampled[mask] * shade
+    # Exposure changes between the views and sensor noise
+    img = img * rng.uniform(0.85, 1.15) + rng.normal(0, 2, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8), depth
+
+def fundamental_matrix(K1, R1, T1, K2, R2, T2):
+    # F with x2^T F x1 = 0, as evaluated by validation.EvaluateSubmission
+    dR = R2 @ R1.T
+    dT = T2 - dR @ T1
+    tx = np.array([[0, -dT[2], dT[1]], [dT[2], 0, -dT[0]], [-dT[1], dT[0], 0]])
+    return np.linalg.inv(K2).T @ tx @ dR @ np.linalg.inv(K1)
+
+def surface_points(K, R, T, depth, stride=8):
+    # World points of the visible surface on a pixel grid
+    v, u = np.mgrid[stride // 2:depth.shape[0]:stride, stride // 2:depth.shape[1]:stride]
+    z = depth[v, u]
+    valid = np.isfinite(z)
+    pixels = np.stack([u[valid] + 0.5, v[valid] + 0.5, np.ones(valid.sum())], -1)
+    return (pixels @ np.linalg.inv(K).T * z[valid, None] - T) @ R
+
+def visible_fraction(points, K, R, T, depth, tolerance=0.02):
+    # Fraction of the world points that are in the image and not occluded
+    if len(points) == 0:
+        return 0.
+    cam = points @ R.T + T
+    z = cam[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pix = cam @ K.T / z[:, None]
+    u, v = np.floor(pix[:, 0]).astype(np.int64), np.floor(pix[:, 1]).astype(np.int64)
+    inside = (z > 0) & (u >= 0) & (u < depth.shape[1]) & (v >= 0) & (v < depth.shape[0])
+    visible = np.zeros(len(points), dtype=bool)
+    visible[inside] = np.abs(depth[v[inside], u[inside]] - z[inside]) <= tolerance * z[inside]
+    return visible.mean()
+
+def matrix_string(m):
+    return " ".join(str(num) for num in np.asarray(m).flatten().tolist())
+
+def generate_scene(output_dir, scene, n_images=20, width=1120, height=840, n_boxes=6, arc_degrees=120., seed=0):
+    """
+    Render one synthetic scene and write its images and ground truth files.
+
+    The covisibility of a pair is the smaller of the two fractions of surface points seen by one camera that the
+    other camera also sees.
+
+    Returns:
+        pair_covisibility DataFrame of the scene
+    """
+    rng = np.random.default_rng(seed)
+    quads = make_scene(rng, n_boxes)
+    cameras = make_cameras(rng, n_images, width, height, arc_degrees)
+    scene_dir = os.path.join(output_dir, scene)
+    os.makedirs(os.path.join(scene_dir, 'images'), exist_ok=True)
+    image_ids = [f'{seed:04d}{i:04d}' for i in range(n_images)]
+
+    depths, calibration = [], []
+    for image_id, (K, R, T) in zip(image_ids, cameras):
+        img, depth = render(quads, K, R, T, width, height, rng)
+        cv2.imwrite(os.path.join(scene_dir, 'images', f'{image_id}.jpg'), img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        depths.append(depth)
+        calibration.append({'image_id': image_id, 'camera_intrinsics': matrix_string(K),
+                            'rotation_matrix': matrix_string(R), 'translation_vector': matrix_string(T)})
+    pd.DataFrame(calibration).to_csv(os.path.join(scene_dir, 'calibration.csv'), index=False)
+
+    points = [surface_points(*camera, depth) for camera, depth in zip(cameras, depths)]
+    pairs = []
+    for i, j in combinations(range(n_images), 2):
+        covisibility = min(visible_fraction(points[i], *cameras[j], depths[j]),
+                           visible_fraction(points[j], *cameras[i], depths[i]))
+        pairs.append({'pair': f'{image_ids[i]}-{image_ids[j]}', 'covisibility': round(covisibility, 3),
+                      'fundamental_matrix': matrix_string(fundamental_matrix(*cameras[i], *cameras[j]))})
+    pair_covisibility = pd.DataFrame(pairs)
+    pair_covisibility.to_csv(os.path.join(scene_dir, 'pair_covisibility.csv'), index=False)
+    return pair_covisibility
+
+def write_scaling_factors(output_dir, scenes):
+    # Adds the scenes with a scaling factor of 1 to scaling_factors.csv, keeping the other scenes in it
+    path = os.path.join(output_dir, 'scaling_factors.csv')
+    factors = pd.read_csv(path) if os.path.exists(path) else pd.DataFrame(columns=['scene', 'scaling_factor'])
+    factors = factors[~factors['scene'].isin(scenes)]
+    factors = pd.concat([factors, pd.DataFrame({'scene': scenes, 'scaling_factor': 1.0})], ignore_index=True)
+    factors.to_csv(path, index=False)
+
+def generate(output_dir, n_scenes=1, n_images=20, width=1120, height=840, n_boxes=6, arc_degrees=120., seed=0):
+    scenes = []
+    for k in range(n_scenes):
+        scene = f'synthetic_{seed + k:03d}'
+        print(f'rendering scene {k + 1} of {n_scenes}: {scene}')
+        pair_covisibility = generate_scene(output_dir, scene, n_images, width, height, n_boxes, arc_degrees, seed + k)
+        print(f"{len(pair_covisibility)} pairs, {(pair_covisibility['covisibility'] >= 0.1).sum()} with covisibility >= 0.1")
+        scenes.append(scene)
+    write_scaling_factors(output_dir, scenes)
+    return scenes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render synthetic scenes with ground truth in the IMC 2022 train layout.')
+    parser.add_argument('--output', required=True, help='output directory, used like data/train')
+    parser.add_argument('--scenes', type=int, default=1, help='number of scenes')
+    parser.add_argument('--images', type=int, default=20, help='number of images per scene')
+    parser.add_argument('--width', type=int, default=1120)
+    parser.add_argument('--height', type=int, default=840)
+    parser.add_argument('--boxes', type=int, default=6, help='number of boxes per scene')
+    parser.add_argument('--arc', type=float, default=120., help='angle in degrees the cameras are spread over')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first scene, the next scenes count up')
+    args = parser.parse_args()
+    generate(args.output, args.scenes, args.images, args.width, args.height, args.boxes, args.arc, args.seed)
@@ -0,0 +1,59 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import kornia.feature as KF
+from kornia.feature.loftr.loftr import default_cfg
+from LoFTR import match_bucket, match_pair
+from batching import bucket_key, iter_buckets
+
+# A padded batch has to give the same matches as matching its pairs one by one. The real backbone sees the zero
+# padding through its receptive field, so its features near the padding differ from an unbatched pass. Here it is
+# replaced by a backbone without any spatial context and without bias, whose features of the image pixels do not
+# depend on the padding; everything after it is kornia's LoFTR with random weights. A coarse threshold of 0 keeps
+# every mutual nearest neighbour, so there are matches up to the image borders.
+
+class LocalBackbone(nn.Module):
+    # Coarse features from each 8x8 and fine features from each 2x2 block of pixels alone
+    def __init__(self):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.coarse = nn.Parameter(torch.randn(256, 1, 8, 8, generator=generator))
+        self.fine = nn.Parameter(torch.randn(128, 1, 2, 2, generator=generator))
+
+    def forward(self, img):
+        return F.conv2d(img, self.coarse, stride=8), F.conv2d(img, self.fine, stride=2)
+
+def make_matcher():
+    torch.manual_seed(0)
+    config = copy.deepcopy(default_cfg)
+    config['match_coarse']['thr'] = 0.
+    matcher = KF.LoFTR(pretrained=None, config=config).eval()
+    matcher.backbone = LocalBackbone()
+    return matcher
+
+def make_image(rng, h, w):
+    return torch.from_numpy(rng.random((1, 1, h, w), dtype=np.float32))
+
+def test_padded_batch_matches_unbatched():
+    matcher = make_matcher()
+    rng = np.random.default_rng(0)
+    # All shapes share the bucket (256, 320) x (256, 320); only the last pair needs no padding.
+    shapes = [((240, 320), (200, 288)), ((200, 288), (240, 320)), ((240, 304), (240, 320)), ((256, 320), (256, 320))]
+    items = [(i, make_image(rng, *shape0), make_image(rng, *shape1)) for i, (shape0, shape1) in enumerate(shapes)]
+    assert len({bucket_key(img0, img1) for _, img0, img1 in items}) == 1
+
+    (key, group), = iter_buckets(items, len(items))
+    batched = match_bucket(matcher, key, group)
+    for (i, img0, img1), (mkpts0, mkpts1, mconf) in zip(group, batched):
+        expected = match_pair(matcher, img0, img1)
+        assert len(expected[0]) > 0
+        # Nothing from the border strip that the unbatched pass drops
+        border = matcher.coarse_matching.border_rm * 8
+        h, w = img0.shape[-2:]
+        assert np.all((mkpts0[:, 0] < w - border) & (mkpts0[:, 1] < h - border))
+        order, expected_order = np.lexsort(mkpts0.T), np.lexsort(expected[0].T)
+        np.testing.assert_allclose(mkpts0[order], expected[0][expected_order], atol=1e-3)
+        np.testing.assert_allclose(mkpts1[order], expected[1][expected_order], atol=1e-3)
+        np.testing.assert_allclose(mconf[order], expected[2][expected_order], rtol=1e-3, atol=1e-7)
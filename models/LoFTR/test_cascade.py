@@ -0,0 +1,83 @@
+import os
+import cv2
+import numpy as np
+import torch
+from LoFTR import FULL_RES, iter_results_cascade
+from cascade import DEFAULT_CASCADE, CascadeStats, low_res_ransac, needs_escalation
+from synthetic import look_at
+from verification import DEFAULT_RANSAC, find_fundamental_matrix
+
+# A clean pair has to be decided by the low resolution pass of the cascade. LoFTR's keypoints are about equally
+# accurate in pixels at every resolution, so scaled up to the FULL_RES frame the low resolution keypoints are
+# FULL_RES / low_res times less accurate; the inlier threshold of that pass has to grow with them.
+
+WIDTH, HEIGHT = FULL_RES, 840
+# Localisation error of the matches in pixels of the image they were matched in
+SIGMA = 0.2
+
+def clean_matches():
+    # Matches of 3D points seen by two cameras, in the FULL_RES frame
+    rng = np.random.default_rng(0)
+    K = np.array([[1000., 0, WIDTH / 2], [0, 1000., HEIGHT / 2], [0, 0, 1]])
+    points = np.c_[rng.uniform(-3, 3, (600, 2)), rng.uniform(-1, 1, 600)]
+
+    def project(center):
+        R = look_at(np.array(center), np.zeros(3))
+        x = (points @ R.T - R @ np.array(center)) @ K.T
+        return x[:, :2] / x[:, 2:]
+
+    mkpts0, mkpts1 = project([0., -8., 1.]), project([3., -7., 1.5])
+    inside = np.all((mkpts0 > 0) & (mkpts0 < [WIDTH, HEIGHT]) & (mkpts1 > 0) & (mkpts1 < [WIDTH, HEIGHT]), axis=1)
+    return mkpts0[inside], mkpts1[inside]
+
+class FakeMatcher:
+    # Returns the clean matches in the frame of the images it is given, with SIGMA pixels of localisation error
+    def __init__(self):
+        self.mkpts0, self.mkpts1 = clean_matches()
+        self.resolutions = []
+
+    def __call__(self, batch):
+        res = max(batch['image0'].shape[2:])
+        self.resolutions.append(res)
+        rng = np.random.default_rng(res)
+        scale = res / FULL_RES
+        for name, mkpts in (('mkpts0_f', self.mkpts0), ('mkpts1_f', self.mkpts1)):
+            batch[name] = torch.from_numpy((mkpts * scale + rng.normal(0, SIGMA, mkpts.shape)).astype(np.float32))
+        batch['mconf'] = torch.ones(len(self.mkpts0))
+
+def write_images(directory):
+    for image_id in ('a.jpg', 'b.jpg'):
+        cv2.imwrite(os.path.join(directory, image_id), np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8))
+    return [('a.jpg', 'b.jpg')]
+
+def test_low_res_ransac_scales_threshold():
+    ransac = low_res_ransac(DEFAULT_RANSAC, DEFAULT_CASCADE._replace(low_res=560), FULL_RES)
+    assert ransac.threshold == DEFAULT_RANSAC.threshold * 2
+    assert ransac._replace(threshold=DEFAULT_RANSAC.threshold) == DEFAULT_RANSAC
+
+def test_clean_pair_is_not_escalated(tmp_path):
+    pairs = write_images(str(tmp_path))
+    matcher = FakeMatcher()
+    cascade_stats = CascadeStats()
+    cv2.setRNGSeed(0)
+    results = list(iter_results_cascade(matcher, pairs, str(tmp_path) + os.sep, torch.device('cpu'),
+                                        cascade_stats=cascade_stats))
+    assert matcher.resolutions == [DEFAULT_CASCADE.low_res]
+    assert cascade_stats.pairs == 1 and cascade_stats.escalated == 0
+    (i, mkpts0, mkpts1, mconf, F, inliers), = results
+    assert i == 0 and np.any(F != 0)
+    assert inliers.mean() >= DEFAULT_CASCADE.confident_inlier_ratio
+
+def test_full_res_threshold_would_escalate():
+    # The same low resolution matches checked with the full resolution threshold look like an uncertain pair
+    mkpts0, mkpts1 = clean_matches()
+    rng = np.random.default_rng(0)
+    scale = FULL_RES / DEFAULT_CASCADE.low_res
+    mkpts0, mkpts1 = ((mkpts / scale + rng.normal(0, SIGMA, mkpts.shape)) * scale for mkpts in (mkpts0, mkpts1))
+    mkpts0, mkpts1 = mkpts0.astype(np.float32), mkpts1.astype(np.float32)
+    cv2.setRNGSeed(0)
+    _, inliers = find_fundamental_matrix(mkpts0, mkpts1, DEFAULT_RANSAC)
+    assert needs_escalation(len(mkpts0), inliers.sum(), DEFAULT_CASCADE)
+    cv2.setRNGSeed(0)
+    _, inliers = find_fundamental_matrix(mkpts0, mkpts1, low_res_ransac(DEFAULT_RANSAC, DEFAULT_CASCADE, FULL_RES))
+    assert not needs_escalation(len(mkpts0), inliers.sum(), DEFAULT_CASCADE)
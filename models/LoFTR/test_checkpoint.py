@@ -0,0 +1,112 @@
+import os
+import ast
+import pandas as pd
+import pytest
+from checkpoint import CheckpointWriter, CsvSink, read_progress
+
+# Resuming an interrupted run must neither lose nor duplicate results: the output and its progress file are cut back
+# to the last complete flush, and only the pairs after it are written again.
+
+PAIRS = [(f'{i}.jpg', f'{i + 1}.jpg') for i in range(23)]
+FLUSH_EVERY = 4
+
+def record(pair):
+    return {'pair': pair, 'n_matches': int(pair[0].split('.')[0]) * 10, 'F': '1.5 0.0 -2.25'}
+
+def crash(writer, pending):
+    # Write the pairs and stop like a killed process: the records not flushed yet are lost, no file is finished
+    for pair in pending:
+        writer.write(record(pair))
+    writer._progress.close()
+    writer.sink._file.close()
+
+def append_bytes(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+
+def resume(path):
+    # Run again with resume, writing only the pairs that are not complete yet
+    with CheckpointWriter(CsvSink(path), resume=True, flush_every=FLUSH_EVERY) as writer:
+        completed = set(writer.completed)
+        for pair in PAIRS:
+            if pair not in writer.completed:
+                writer.write(record(pair))
+    return completed
+
+def assert_complete(path):
+    results = pd.read_csv(path)
+    assert [tuple(ast.literal_eval(pair)) for pair in results['pair']] == PAIRS
+    assert list(results['n_matches']) == [record(pair)['n_matches'] for pair in PAIRS]
+    state, completed, valid_bytes = read_progress(path + '.progress')
+    assert state == os.path.getsize(path)
+    assert completed == set(PAIRS)
+    assert valid_bytes == os.path.getsize(path + '.progress')
+
+def test_without_crash(tmp_path):
+    path = str(tmp_path / 'scene.csv')
+    with CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY) as writer:
+        for pair in PAIRS:
+            writer.write(record(pair))
+    assert_complete(path)
+
+def test_resume_after_partial_row(tmp_path):
+    # Killed while a chunk was written to the CSV: a partial trailing row that the progress file does not know of,
+    # with long keypoint columns as in the real output, so it is longer than everything written after resuming
+    path = str(tmp_path / 'scene.csv')
+    crash(CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY), PAIRS[:10])
+    append_bytes(path, b'"(\'8.jpg\', \'9.jpg\')",80,"1.5 0.' + b'25 ' * 10000)
+    completed = resume(path)
+    assert completed == set(PAIRS[:8])
+    assert_complete(path)
+
+def test_resume_after_unrecorded_rows(tmp_path):
+    # Killed after a chunk was written to the CSV, but before it was recorded in the progress file
+    path = str(tmp_path / 'scene.csv')
+    writer = CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY)
+    for pair in PAIRS[:8]:
+        writer.write(record(pair))
+    writer.sink.append([record(pair) for pair in PAIRS[8:12]])
+    crash(writer, [])
+    completed = resume(path)
+    assert completed == set(PAIRS[:8])
+    assert_complete(path)
+
+def test_resume_after_partial_progress_line(tmp_path):
+    # Killed while the progress file was written: its last line is cut off, and the CSV holds a complete chunk more
+    path = str(tmp_path / 'scene.csv')
+    crash(CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY), PAIRS[:12])
+    with open(path + '.progress', 'rb') as f:
+        lines = f.readlines()
+    with open(path + '.progress', 'wb') as f:
+        f.write(b''.join(lines[:-1]) + lines[-1][:len(lines[-1]) // 2])
+    completed = resume(path)
+    assert completed == set(PAIRS[:8])
+    assert_complete(path)
+
+def test_resume_twice(tmp_path):
+    # A resumed run that is interrupted again
+    path = str(tmp_path / 'scene.csv')
+    crash(CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY), PAIRS[:6])
+    writer = CheckpointWriter(CsvSink(path), resume=True, flush_every=FLUSH_EVERY)
+    assert writer.completed == set(PAIRS[:4])
+    crash(writer, PAIRS[4:15])
+    append_bytes(path, b'"(\'12.jpg\'')
+    completed = resume(path)
+    assert completed == set(PAIRS[:12])
+    assert_complete(path)
+
+def test_resume_without_progress_file(tmp_path):
+    path = str(tmp_path / 'scene.csv')
+    crash(CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY), PAIRS[:10])
+    os.remove(path + '.progress')
+    assert resume(path) == set()
+    assert_complete(path)
+
+def test_resume_truncated_output(tmp_path):
+    # The CSV is shorter than the progress file says, e.g. it was replaced: refuse instead of guessing
+    path = str(tmp_path / 'scene.csv')
+    crash(CheckpointWriter(CsvSink(path), flush_every=FLUSH_EVERY), PAIRS[:10])
+    with open(path, 'r+b') as f:
+        f.truncate(10)
+    with pytest.raises(ValueError):
+        CheckpointWriter(CsvSink(path), resume=True, flush_every=FLUSH_EVERY)
@@ -0,0 +1,45 @@
+import os
+import cv2
+import numpy as np
+import pytest
+import torch
+from LoFTR import FULL_RES, get_pairs, iter_results_cascade
+from cascade import DEFAULT_CASCADE, CascadeStats
+from export import scene_buckets
+
+# export.py has to trace every input shape of the run it prepares, so that the run never traces a graph itself:
+# with --reduced-decode, and with --cascade for both passes, since every pair may be escalated to full resolution.
+
+SIZES = [(600, 800), (800, 600), (500, 900), (700, 700)]
+
+class RecordingMatcher:
+    # Records the input shapes of every call and finds no matches
+    def __init__(self):
+        self.calls = set()
+
+    def __call__(self, batch):
+        self.calls.add((tuple(batch['image0'].shape[2:]), tuple(batch['image1'].shape[2:]), 'mask0' in batch))
+        batch['mkpts0_f'] = batch['mkpts1_f'] = torch.zeros((0, 2))
+        batch['mconf'] = torch.zeros(0)
+
+def write_images(directory):
+    rng = np.random.default_rng(0)
+    for i, (h, w) in enumerate(SIZES):
+        cv2.imwrite(os.path.join(directory, f'{i}.jpg'), rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+
+@pytest.mark.parametrize('reduced_decode', [False, True])
+def test_exports_every_shape_of_cascade_run(tmp_path, reduced_decode):
+    filepath = str(tmp_path) + os.sep
+    write_images(filepath)
+    device = torch.device('cpu')
+    cascade = DEFAULT_CASCADE._replace(low_res=560, min_matches=0)
+    matcher = RecordingMatcher()
+    cascade_stats = CascadeStats()
+    list(iter_results_cascade(matcher, get_pairs(filepath), filepath, device, cascade=cascade,
+                              cascade_stats=cascade_stats, reduced_decode=reduced_decode))
+    # Without matches every pair is escalated
+    assert cascade_stats.escalated == cascade_stats.pairs == len(SIZES) * (len(SIZES) - 1) // 2
+
+    buckets = scene_buckets(filepath, device, [FULL_RES, cascade.low_res], reduced_decode=reduced_decode)
+    assert buckets == matcher.calls
+    assert scene_buckets(filepath, device, [FULL_RES], reduced_decode=reduced_decode) < buckets
@@ -0,0 +1,41 @@
+import json
+import pytest
+from instrumentation import Tracer
+
+# A streamed trace file has to be valid JSON however the run ends, so that the trace of a failed run can be opened.
+
+FLUSH_EVERY = 4
+
+def record_spans(tracer, n):
+    for i in range(n):
+        with tracer.span('match', ('a.jpg', f'{i}.jpg')):
+            pass
+
+def load_events(path):
+    with open(path) as f:
+        return json.load(f)['traceEvents']
+
+@pytest.mark.parametrize('n', [0, 3, 4, 10])
+def test_streamed_trace(tmp_path, n):
+    path = str(tmp_path / 'trace.json')
+    with Tracer(path=path, flush_every=FLUSH_EVERY) as tracer:
+        record_spans(tracer, n)
+    events = load_events(path)
+    assert [event['args']['pairs'] for event in events] == [[f'a.jpg-{i}.jpg'] for i in range(n)]
+
+def test_streamed_trace_after_exception(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    with pytest.raises(RuntimeError):
+        with Tracer(path=path, flush_every=FLUSH_EVERY) as tracer:
+            record_spans(tracer, 6)
+            raise RuntimeError
+    assert len(load_events(path)) == 6
+
+def test_trace_in_memory(tmp_path):
+    # Without a path nothing is written on exit, only by save
+    path = str(tmp_path / 'trace.json')
+    with Tracer() as tracer:
+        record_spans(tracer, 3)
+    assert len(tracer.events) == 3
+    tracer.save(path)
+    assert len(load_events(path)) == 3
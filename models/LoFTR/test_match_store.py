@@ -0,0 +1,108 @@
+import os
+import numpy as np
+from checkpoint import CheckpointWriter
+from match_store import MatchStore, MatchStoreSink
+
+# A match store has to give back exactly the matches written to it: through the CSR layout, the assembly of the
+# '.parts' files in close(), and after resuming a run, also from a finished store (_unpack).
+
+COUNTS = [0, 1, 500, 3, 0, 1, 2047, 17, 1, 0, 64]
+FLUSH_EVERY = 3
+
+def make_records(counts, seed=0):
+    rng = np.random.default_rng(seed)
+    records = []
+    for i, n in enumerate(counts):
+        records.append({'pair': (f'{i:08d}', f'{i + 1:08d}'),
+                        'mkpts0': rng.uniform(0, 1120, (n, 2)).astype(np.float32),
+                        'mkpts1': rng.uniform(0, 1120, (n, 2)).astype(np.float32),
+                        'mconf': rng.uniform(0, 1, n).astype(np.float32),
+                        'inliers': rng.random(n) < 0.5,
+                        'fund_matrix': rng.normal(size=(3, 3)) if n >= 8 else np.zeros((3, 3))})
+    return records
+
+def write_store(path, records, dtype='float32'):
+    with CheckpointWriter(MatchStoreSink(path, dtype), flush_every=FLUSH_EVERY) as writer:
+        for record in records:
+            writer.write(record)
+
+def crash(writer, pending):
+    # Write the records and stop like a killed process: records not flushed yet are lost, the parts stay behind
+    for record in pending:
+        writer.write(record)
+    writer._progress.close()
+    for f in writer.sink._files.values():
+        f.close()
+
+def assert_store(path, records, dtype=np.float32):
+    store = MatchStore(path)
+    # Read through the memory map (np.memmap refuses empty arrays, see match_store._memmap)
+    assert isinstance(store.offsets, np.memmap)
+    assert isinstance(store.arrays['mkpts0'], np.memmap) == (store.offsets[-1] > 0)
+    assert len(store) == len(records)
+    assert store.pairs == [record['pair'] for record in records]
+    np.testing.assert_array_equal(np.diff(store.offsets), [len(record['mconf']) for record in records])
+    for i, record in enumerate(records):
+        for matches in (store[i], store[record['pair']]):
+            for name in ('mkpts0', 'mkpts1', 'mconf'):
+                assert matches[name].dtype == dtype
+                np.testing.assert_array_equal(matches[name], record[name].astype(dtype))
+            np.testing.assert_array_equal(matches['inliers'], record['inliers'])
+            np.testing.assert_array_equal(matches['fund_matrix'], record['fund_matrix'])
+    df = store.to_dataframe()
+    assert list(df['pair']) == [record['pair'] for record in records]
+    for row, record in zip(df.itertuples(), records):
+        for name in ('mkpts0', 'mkpts1', 'mconf'):
+            assert getattr(row, name).dtype == np.float32
+            np.testing.assert_array_equal(getattr(row, name), record[name].astype(dtype).astype(np.float32))
+        np.testing.assert_array_equal(row.inliers, record['inliers'])
+        np.testing.assert_array_equal(row.fund_matrix, record['fund_matrix'])
+        assert row.fund_matrix_eval == " ".join(str(num) for num in record['fund_matrix'].flatten().tolist())
+        assert row.n_inliers == record['inliers'].sum()
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'scene.matches')
+    records = make_records(COUNTS)
+    write_store(path, records)
+    assert not os.path.exists(path + '.parts')
+    assert_store(path, records)
+
+def test_round_trip_float16(tmp_path):
+    path = str(tmp_path / 'scene.matches')
+    records = make_records(COUNTS)
+    write_store(path, records, 'float16')
+    assert_store(path, records, np.float16)
+
+def test_round_trip_without_matches(tmp_path):
+    path = str(tmp_path / 'scene.matches')
+    records = make_records([0, 0, 0])
+    write_store(path, records)
+    assert_store(path, records)
+
+def test_resume_after_partial_part(tmp_path):
+    # Killed while a chunk was appended to the part files: they hold bytes the progress file does not know of
+    path = str(tmp_path / 'scene.matches')
+    records = make_records(COUNTS)
+    crash(CheckpointWriter(MatchStoreSink(path), flush_every=FLUSH_EVERY), records[:8])
+    parts = path + '.parts'
+    for name, garbage in (('mkpts0.bin', b'\x01' * 12), ('counts.bin', b'\x07' * 5), ('pairs.jsonl', b'["000')):
+        with open(os.path.join(parts, name), 'ab') as f:
+            f.write(garbage)
+
+    with CheckpointWriter(MatchStoreSink(path), resume=True, flush_every=FLUSH_EVERY) as writer:
+        assert writer.completed == {record['pair'] for record in records[:6]}
+        for record in records:
+            if record['pair'] not in writer.completed:
+                writer.write(record)
+    assert_store(path, records)
+
+def test_resume_finished_store(tmp_path):
+    # A finished store is unpacked into part files again and extended with the remaining pairs
+    path = str(tmp_path / 'scene.matches')
+    records = make_records(COUNTS)
+    write_store(path, records[:5])
+    with CheckpointWriter(MatchStoreSink(path), resume=True, flush_every=FLUSH_EVERY) as writer:
+        assert writer.completed == {record['pair'] for record in records[:5]}
+        for record in records[5:]:
+            writer.write(record)
+    assert_store(path, records)
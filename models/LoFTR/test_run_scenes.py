@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import pytest
+from checkpoint import CheckpointWriter
+from LoFTR import get_sink
+from run_scenes import resumed_pairs
+
+# With --resume, the progress bar of run_scenes.py starts at the pairs that the scenes' outputs already hold, since
+# LoFTR.main only matches and counts the others.
+
+def record(i):
+    return {'pair': (f'{i}.jpg', f'{i + 1}.jpg'), 'mkpts0': np.zeros((i, 2)), 'mkpts1': np.zeros((i, 2)),
+            'mconf': np.zeros(i), 'inliers': np.zeros(i, dtype=bool), 'fund_matrix': np.zeros((3, 3))}
+
+def interrupt(name, output_format, n_written, flush_every=4):
+    # Output of a run that was killed after writing n_written records
+    writer = CheckpointWriter(get_sink(name, output_format), flush_every=flush_every)
+    for i in range(n_written):
+        writer.write(record(i))
+    writer._progress.close()
+
+@pytest.mark.parametrize('output_format', ['csv', 'store'])
+def test_resumed_pairs(tmp_path, output_format):
+    output_dir = str(tmp_path)
+    interrupt(os.path.join(output_dir, 'a'), output_format, 10)
+    with CheckpointWriter(get_sink(os.path.join(output_dir, 'b'), output_format), flush_every=4) as writer:
+        for i in range(6):
+            writer.write(record(i))
+    # Scene c has no output yet, and scene d's estimate is below its written pairs (e.g. with retrieval)
+    interrupt(os.path.join(output_dir, 'd'), output_format, 8)
+    plan = [('a', 20), ('b', 6), ('c', 5), ('d', 3)]
+    # Only complete flushes count: 8 of the 10 pairs of scene a
+    assert resumed_pairs(plan, output_dir, output_format) == [8, 6, 0, 3]
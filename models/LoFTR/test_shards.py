@@ -0,0 +1,113 @@
+import ast
+import os
+from itertools import combinations
+import numpy as np
+import pandas as pd
+import pytest
+from match_store import MatchStore, MatchStoreSink
+from shards import merge, parse_shard, select_shard, shard_name, shard_of, write_manifest
+
+# The merge is the last step before a submission: it has to put together exactly the full pair list, and refuse
+# shards that are missing, belong to another run or were written with other columns.
+
+IMAGE_IDS = [f'{i:08d}.jpg' for i in range(12)]
+ALL_PAIRS = list(combinations(IMAGE_IDS, 2))
+COUNT = 3
+
+def record(pair):
+    return {'pair': pair, 'n_matches': int(pair[0][:8]) + int(pair[1][:8]), 'fund_matrix_eval': '0.5 0 0 0 1 0 0 0 1'}
+
+def write_shard(directory, index, count=COUNT, all_pairs=ALL_PAIRS, columns=None, output_format='csv'):
+    # Output and manifest of one shard, as LoFTR.py --shard index/count writes them; returns the manifest path
+    name = os.path.join(directory, shard_name('scene', index, count))
+    pairs = select_shard(all_pairs, index, count)
+    records = [record(pair) for pair in pairs]
+    if output_format == 'csv':
+        path = name + '.csv'
+        pd.DataFrame(records, columns=columns).to_csv(path, index=False)
+    else:
+        path = name + '.matches'
+        sink = MatchStoreSink(path)
+        sink.open()
+        rng = np.random.default_rng(index)
+        sink.append([dict(r, mkpts0=rng.random((3, 2)), mkpts1=rng.random((3, 2)), mconf=rng.random(3),
+                          inliers=np.ones(3, dtype=bool), fund_matrix=np.eye(3)) for r in records])
+        sink.close()
+    write_manifest(name, path, index, count, all_pairs, pairs)
+    return name + '.json'
+
+def read_pairs(path):
+    return [tuple(ast.literal_eval(pair)) for pair in pd.read_csv(path)['pair']]
+
+def test_parse_shard():
+    assert parse_shard('2/5') == (2, 5)
+    for text in ('5/5', '-1/3', '1/0', '1', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(text)
+
+def test_shards_partition_pair_list():
+    shards = [select_shard(ALL_PAIRS, index, COUNT) for index in range(COUNT)]
+    assert all(shards)
+    assert sum(len(shard) for shard in shards) == len(ALL_PAIRS)
+    assert set().union(*(set(shard) for shard in shards)) == set(ALL_PAIRS)
+    for shard in shards:
+        # In the original order, and independent of the orientation of a pair
+        assert shard == [pair for pair in ALL_PAIRS if pair in set(shard)]
+        assert all(shard_of(pair, COUNT) == shard_of(pair[::-1], COUNT) for pair in shard)
+
+def test_merge_csv(tmp_path):
+    manifests = [write_shard(str(tmp_path), index) for index in range(COUNT)]
+    output_path = merge(manifests[::-1], str(tmp_path / 'merged'))
+    assert output_path == str(tmp_path / 'merged.csv')
+    expected = [pair for index in range(COUNT) for pair in select_shard(ALL_PAIRS, index, COUNT)]
+    assert read_pairs(output_path) == expected
+    merged = pd.read_csv(output_path)
+    assert list(merged.columns) == list(record(ALL_PAIRS[0]))
+    assert list(merged['n_matches']) == [record(pair)['n_matches'] for pair in expected]
+
+def test_merge_stores(tmp_path):
+    manifests = [write_shard(str(tmp_path), index, output_format='store') for index in range(COUNT)]
+    store = MatchStore(merge(manifests, str(tmp_path / 'merged')))
+    assert store.pairs == [pair for index in range(COUNT) for pair in select_shard(ALL_PAIRS, index, COUNT)]
+    shard = MatchStore(str(tmp_path / (shard_name('scene', 1, COUNT) + '.matches')))
+    for pair in shard.pairs:
+        np.testing.assert_array_equal(store[pair]['mkpts0'], shard[pair]['mkpts0'])
+
+def test_merge_rejects_missing_shard(tmp_path):
+    manifests = [write_shard(str(tmp_path), index) for index in range(COUNT)]
+    with pytest.raises(ValueError, match='missing shards: \\[1\\]'):
+        merge([manifests[0], manifests[2]], str(tmp_path / 'merged'))
+    assert not os.path.exists(tmp_path / 'merged.csv')
+
+def test_merge_rejects_repeated_shard(tmp_path):
+    manifests = [write_shard(str(tmp_path), index) for index in range(COUNT)]
+    with pytest.raises(ValueError, match='more than once'):
+        merge(manifests + [manifests[1]], str(tmp_path / 'merged'))
+
+def test_merge_rejects_other_pair_list(tmp_path):
+    # A shard of a run over another pair list, and a shard of a run split into another number of shards
+    manifests = [write_shard(str(tmp_path), index) for index in range(COUNT)]
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    other = write_shard(str(other_dir), 2, all_pairs=ALL_PAIRS[:-1])
+    with pytest.raises(ValueError, match='different shardings or pair lists'):
+        merge(manifests[:2] + [other], str(tmp_path / 'merged'))
+    other = write_shard(str(other_dir), 2, count=COUNT + 1)
+    with pytest.raises(ValueError, match='different shardings or pair lists'):
+        merge(manifests[:2] + [other], str(tmp_path / 'merged'))
+
+def test_merge_rejects_incomplete_output(tmp_path):
+    # A shard whose output lost its last pair, e.g. an interrupted run that was not resumed
+    manifests = [write_shard(str(tmp_path), index) for index in range(COUNT)]
+    path = tmp_path / (shard_name('scene', 0, COUNT) + '.csv')
+    pd.read_csv(path)[:-1].to_csv(path, index=False)
+    with pytest.raises(ValueError, match='1 of .* pairs missing'):
+        merge(manifests, str(tmp_path / 'merged'))
+
+def test_merge_rejects_different_csv_headers(tmp_path):
+    # E.g. one shard run with --trace, which adds the timing columns
+    manifests = [write_shard(str(tmp_path), index) for index in range(COUNT - 1)]
+    manifests.append(write_shard(str(tmp_path), COUNT - 1, columns=list(record(ALL_PAIRS[0])) + ['load_ms']))
+    with pytest.raises(ValueError, match='CSV header'):
+        merge(manifests, str(tmp_path / 'merged'))
+    assert not os.path.exists(tmp_path / 'merged.csv')
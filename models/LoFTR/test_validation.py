@@ -0,0 +1,165 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import validation
+from synthetic import generate_scene
+from validation import (LoadCalibration, DecomposeFundamentalMatrixWithIntrinsics, QuaternionFromMatrix,
+                        ComputeErrorForOneExample, EvaluateSubmission, EvaluateSubmissionParallel, MaaAccumulator, eps)
+
+# The vectorized validation (EvaluateSubmission, EvaluateSubmissionParallel, MaaAccumulator) has to give exactly the
+# same numbers as the original per-pair loop over DecomposeFundamentalMatrixWithIntrinsics, QuaternionFromMatrix and
+# ComputeErrorForOneExample, which reference_evaluate below keeps. Run with
+#   python -m pytest -q test_validation.py
+
+THRESHOLDS_Q = np.linspace(1, 10, 10)
+THRESHOLDS_T = np.geomspace(0.2, 5, 10)
+SCALING_FACTORS = {'synthetic_000': 1.0, 'synthetic_001': 2.5}
+
+def reference_maa(err_q, err_t, thresholds_q, thresholds_t):
+    # ComputeMaa as it was before vectorizing it
+    acc = []
+    for th_q, th_t in zip(thresholds_q, thresholds_t):
+        acc += [(np.bitwise_and(np.array(err_q) < th_q, np.array(err_t) < th_t)).sum() / len(err_q)]
+    return np.mean(acc)
+
+def reference_evaluate(predictions, input_dir, scaling_dict, thresholds_q, thresholds_t, output_dir):
+    # EvaluateSubmission as it was before vectorizing it, one pair at a time
+    scenes = []
+    for prediction in predictions.keys():
+        dataset, scene, pair = prediction.split(';')
+        if scene not in scenes:
+            scenes += [scene]
+
+    calib_dict = {scene: LoadCalibration(os.path.join(input_dir, scene, 'calibration.csv')) for scene in scenes}
+
+    errors_dict_q = {scene: {} for scene in scenes}
+    errors_dict_t = {scene: {} for scene in scenes}
+    for prediction_key, F_predicted in predictions.items():
+        dataset, scene, pair = prediction_key.split(';')
+        image_id_1, image_id_2 = pair.split('-')
+
+        K1, R1_gt, T1_gt = calib_dict[scene][image_id_1].K, calib_dict[scene][image_id_1].R, calib_dict[scene][image_id_1].T.reshape((3, 1))
+        K2, R2_gt, T2_gt = calib_dict[scene][image_id_2].K, calib_dict[scene][image_id_2].R, calib_dict[scene][image_id_2].T.reshape((3, 1))
+
+        R_pred_a, R_pred_b, T_pred = DecomposeFundamentalMatrixWithIntrinsics(F_predicted, K1, K2)
+        q_pred_a = QuaternionFromMatrix(R_pred_a)
+        q_pred_b = QuaternionFromMatrix(R_pred_b)
+
+        dR_gt = np.dot(R2_gt, R1_gt.T)
+        dT_gt = (T2_gt - np.dot(dR_gt, T1_gt)).flatten()
+        q_gt = QuaternionFromMatrix(dR_gt)
+        q_gt = q_gt / (np.linalg.norm(q_gt) + eps)
+
+        err_q_a, err_t_a = ComputeErrorForOneExample(q_gt, dT_gt, q_pred_a, T_pred, scaling_dict[scene])
+        err_q_b, err_t_b = ComputeErrorForOneExample(q_gt, dT_gt, q_pred_b, T_pred, scaling_dict[scene])
+        assert err_t_a == err_t_b
+        errors_dict_q[scene][pair] = min(err_q_a, err_q_b)
+        errors_dict_t[scene][pair] = err_t_a
+
+    maa_per_scene = {}
+    for scene in scenes:
+        maa_per_scene[scene] = reference_maa(list(errors_dict_q[scene].values()),
+                                             list(errors_dict_t[scene].values()), thresholds_q, thresholds_t)
+
+    scene_list, pair_list, maa_list = [], [], []
+    for prediction_key in predictions.keys():
+        dataset, scene, pair = prediction_key.split(';')
+        scene_list.append(scene)
+        pair_list.append(pair)
+        maa_list.append(reference_maa([errors_dict_q[scene][pair]], [errors_dict_t[scene][pair]],
+                                      thresholds_q, thresholds_t))
+    pd.DataFrame({"scene": scene_list, "pair": pair_list, "maa": maa_list}).to_csv(
+        os.path.join(output_dir, "validation_all.csv"), index=False)
+
+    return np.mean(list(maa_per_scene.values())), maa_per_scene, errors_dict_q, errors_dict_t
+
+@pytest.fixture(scope='module')
+def train_dir(tmp_path_factory):
+    # Two small synthetic scenes, the second one with a scaling factor other than 1
+    output_dir = str(tmp_path_factory.mktemp('train'))
+    for seed, scene in enumerate(SCALING_FACTORS):
+        generate_scene(output_dir, scene, n_images=6, width=160, height=120, n_boxes=2, seed=seed)
+    pd.DataFrame({'scene': list(SCALING_FACTORS), 'scaling_factor': list(SCALING_FACTORS.values())}).to_csv(
+        os.path.join(output_dir, 'scaling_factors.csv'), index=False)
+    return output_dir
+
+@pytest.fixture(scope='module')
+def predictions(train_dir):
+    # The ground truth F of every pair with noise from none to overwhelming, a zero F, and the scenes interleaved
+    rng = np.random.default_rng(0)
+    predictions = []
+    for scene in SCALING_FACTORS:
+        pair_covisibility = pd.read_csv(os.path.join(train_dir, scene, 'pair_covisibility.csv'), dtype={'pair': str})
+        for k, (pair, fundamental_matrix) in enumerate(zip(pair_covisibility['pair'],
+                                                           pair_covisibility['fundamental_matrix'])):
+            F = np.array([float(v) for v in fundamental_matrix.split(' ')]).reshape([3, 3])
+            noise = [0, 1e-4, 1e-3, 1e-2, 3e-2, 0.1, 0.3, 1.][k % 8]
+            F = F + noise * np.linalg.norm(F) * rng.normal(size=(3, 3))
+            if k == 3:
+                F = np.zeros((3, 3))
+            predictions.append((f'phototourism;{scene};{pair}', F))
+    order = rng.permutation(len(predictions))
+    return {predictions[i][0]: predictions[i][1] for i in order}
+
+def assert_same_results(results, expected):
+    maa, maa_per_scene, errors_dict_q, errors_dict_t = results
+    expected_maa, expected_maa_per_scene, expected_errors_q, expected_errors_t = expected
+    assert maa == expected_maa
+    assert maa_per_scene == expected_maa_per_scene
+    for errors, expected_errors in ((errors_dict_q, expected_errors_q), (errors_dict_t, expected_errors_t)):
+        assert list(errors) == list(expected_errors)
+        for scene in expected_errors:
+            assert list(errors[scene]) == list(expected_errors[scene])
+            # Exact equality, with nan equal to nan
+            np.testing.assert_array_equal(list(errors[scene].values()), list(expected_errors[scene].values()))
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.fixture(scope='module')
+def reference(train_dir, predictions, tmp_path_factory):
+    output_dir = str(tmp_path_factory.mktemp('reference'))
+    results = reference_evaluate(predictions, train_dir, SCALING_FACTORS, THRESHOLDS_Q, THRESHOLDS_T, output_dir)
+    # The perturbations have to spread the pairs over the thresholds for the comparison to mean anything
+    assert 0 < results[0] < 1
+    return results, read_bytes(os.path.join(output_dir, 'validation_all.csv'))
+
+def test_evaluate_submission(train_dir, predictions, reference, tmp_path):
+    results = EvaluateSubmission(predictions, train_dir, SCALING_FACTORS, THRESHOLDS_Q, THRESHOLDS_T, str(tmp_path))
+    assert_same_results(results, reference[0])
+    assert read_bytes(os.path.join(tmp_path, 'validation_all.csv')) == reference[1]
+
+def test_evaluate_submission_parallel(train_dir, predictions, reference, tmp_path):
+    results = EvaluateSubmissionParallel(predictions, train_dir, SCALING_FACTORS, THRESHOLDS_Q, THRESHOLDS_T,
+                                         str(tmp_path), processes=2)
+    assert_same_results(results, reference[0])
+    assert read_bytes(os.path.join(tmp_path, 'validation_all.csv')) == reference[1]
+
+def test_evaluate(train_dir, predictions, reference):
+    sample_id_list = list(predictions)
+    fund_matrix_list = [" ".join(str(num) for num in F.flatten().tolist()) for F in predictions.values()]
+    assert validation.evaluate(train_dir, sample_id_list, fund_matrix_list) == reference[0][0]
+    assert validation.evaluate(train_dir, sample_id_list, fund_matrix_list, processes=2) == reference[0][0]
+
+def test_maa_accumulator(train_dir, predictions, reference):
+    accumulator = MaaAccumulator(train_dir)
+    items = list(predictions.items())
+    for n, (sample_id, F) in enumerate(items, 1):
+        accumulator.add(sample_id, F)
+        # Same score as evaluating all predictions added so far
+        prefix = dict(items[:n])
+        expected = EvaluateSubmission(prefix, train_dir, SCALING_FACTORS, THRESHOLDS_Q, THRESHOLDS_T)
+        assert accumulator.maa() == expected[0]
+        assert accumulator.maa_per_scene() == expected[1]
+    assert len(accumulator) == len(predictions)
+    assert accumulator.maa() == reference[0][0]
+    assert accumulator.maa_per_scene() == reference[0][1]
+
+    # A sample id added again replaces its earlier prediction
+    sample_id, F = items[0]
+    accumulator.add(sample_id, np.zeros((3, 3)))
+    accumulator.add(sample_id, " ".join(str(num) for num in F.flatten().tolist()))
+    assert len(accumulator) == len(predictions)
+    assert accumulator.maa() == reference[0][0]
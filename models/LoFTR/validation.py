@@ -4,8 +4,11 @@ import csv
 import numpy as np
 import os
 import pandas as pd
+import multiprocessing as mp
 
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from calibration_store import get_store
 
 Gt = namedtuple('Gt', ['K', 'R', 'T'])
 eps = 1e-15
@@ -99,17 +102,103 @@ def ComputeErrorForOneExample(q_gt, T_gt, q, T, scale):
 
     return err_q * 180 / np.pi, err_t
 
+def DecomposeFundamentalMatrices(F, K1, K2):
+    '''DecomposeFundamentalMatrixWithIntrinsics for a stack of N pairs, with F, K1 and K2 of shape Nx3x3.'''
+
+    E = np.matmul(np.swapaxes(K2, 1, 2), np.matmul(F, K1))
+
+    U, S, Vh = np.linalg.svd(E)
+    U = np.where((np.linalg.det(U) < 0)[:, None, None], -U, U)
+    Vh = np.where((np.linalg.det(Vh) < 0)[:, None, None], -Vh, Vh)
+
+    W = np.array([[0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+    R_a = np.matmul(U, np.matmul(W, Vh))
+    R_b = np.matmul(U, np.matmul(W.T, Vh))
+    T = U[:, :, -1]
+
+    return R_a, R_b, T          # returns the rotation matrices R_a and R_b of shape Nx3x3 and the translation vectors T of shape Nx3
+
+def QuaternionsFromMatrices(matrices):
+    '''QuaternionFromMatrix for a stack of N rotation matrices, returns the quaternions as an Nx4 array.'''
+
+    M = np.asarray(matrices, dtype=np.float64)
+    m00, m01, m02 = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    m10, m11, m12 = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    m20, m21, m22 = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+
+    zero = np.zeros(len(M))
+    K = np.stack([np.stack([m00 - m11 - m22, zero, zero, zero], axis=-1),
+                  np.stack([m01 + m10, m11 - m00 - m22, zero, zero], axis=-1),
+                  np.stack([m02 + m20, m12 + m21, m22 - m00 - m11, zero], axis=-1),
+                  np.stack([m21 - m12, m02 - m20, m10 - m01, m00 + m11 + m22], axis=-1)], axis=1)
+    K /= 3.0
+
+    # The quaternion is the eigenvector of K that corresponds to the largest eigenvalue.
+    w, V = np.linalg.eigh(K)
+    q = V[np.arange(len(M)), :, np.argmax(w, axis=1)][:, [3, 0, 1, 2]]
+
+    return np.where(q[:, :1] < 0, -q, q)
+
+def Norms(x):
+    '''np.linalg.norm of every row of x. Stacked dot products (rather than a sum of squares) round the same way as
+    np.linalg.norm of a single vector.'''
+
+    x = np.ascontiguousarray(x)
+    return np.sqrt(np.matmul(x[:, None, :], x[:, :, None])[:, 0, 0])
+
+def ComputeErrors(q_gt, T_gt, q, T, scale):
+    '''ComputeErrorForOneExample for N examples, with q_gt and q of shape Nx4, T_gt and T of shape Nx3 and the scaling
+    factors of shape N. Returns the rotation and translation errors as arrays of shape N.'''
+
+    q_gt_norm = q_gt / (Norms(q_gt) + eps)[:, None]
+    q_norm = q / (Norms(q) + eps)[:, None]
+
+    loss_q = np.maximum(eps, (1.0 - np.sum(q_norm * q_gt_norm, axis=1)**2))
+    err_q = np.arccos(1 - 2 * loss_q)
+
+    # Apply the scaling factor for this scene.
+    T_gt_scaled = T_gt * scale[:, None]
+    T_scaled = T * Norms(T_gt)[:, None] * scale[:, None] / (Norms(T) + eps)[:, None]
+
+    err_t = np.minimum(Norms(T_gt_scaled - T_scaled), Norms(T_gt_scaled + T_scaled))
+
+    return err_q * 180 / np.pi, err_t
+
+def ComputePoseErrors(F, K1, R1_gt, T1_gt, K2, R2_gt, T2_gt, scale):
+    '''Rotation and translation errors of N predicted fundamental matrices, given the stacked Nx3x3 F, K and R and Nx3x1 T
+    of both images and the scaling factors of shape N.'''
+
+    R_pred_a, R_pred_b, T_pred = DecomposeFundamentalMatrices(F, K1, K2)
+    q_pred_a = QuaternionsFromMatrices(R_pred_a)
+    q_pred_b = QuaternionsFromMatrices(R_pred_b)
+
+    dR_gt = np.matmul(R2_gt, np.swapaxes(R1_gt, 1, 2))
+    dT_gt = (T2_gt - np.matmul(dR_gt, T1_gt))[:, :, 0]
+    q_gt = QuaternionsFromMatrices(dR_gt)
+    q_gt = q_gt / (Norms(q_gt) + eps)[:, None]
+
+    # blah blah cheirality...
+    err_q_a, err_t = ComputeErrors(q_gt, dT_gt, q_pred_a, T_pred, scale)
+    err_q_b, _ = ComputeErrors(q_gt, dT_gt, q_pred_b, T_pred, scale)
+    return np.minimum(err_q_a, err_q_b), err_t
+
+def ComputeAccuracies(err_q, err_t, thresholds_q, thresholds_t):
+    '''Whether every example is within every threshold, as boolean arrays of shape (thresholds, examples).'''
+
+    below_q = np.asarray(err_q)[None, :] < np.asarray(thresholds_q)[:, None]
+    below_t = np.asarray(err_t)[None, :] < np.asarray(thresholds_t)[:, None]
+    return below_q & below_t, below_q, below_t
+
 def ComputeMaa(err_q, err_t, thresholds_q, thresholds_t):
     '''Compute the mean Average Accuracy at different tresholds, for one scene.'''
 
     assert len(err_q) == len(err_t)
 
-    acc, acc_q, acc_t = [], [], []
-    for th_q, th_t in zip(thresholds_q, thresholds_t):
-        acc += [(np.bitwise_and(np.array(err_q) < th_q, np.array(err_t) < th_t)).sum() / len(err_q)]
-        acc_q += [(np.array(err_q) < th_q).sum() / len(err_q)]
-        acc_t += [(np.array(err_t) < th_t).sum() / len(err_t)]
-    return np.mean(acc), np.array(acc), np.array(acc_q), np.array(acc_t)
+    below, below_q, below_t = ComputeAccuracies(err_q, err_t, thresholds_q, thresholds_t)
+    acc = below.sum(axis=1) / len(err_q)
+    acc_q = below_q.sum(axis=1) / len(err_q)
+    acc_t = below_t.sum(axis=1) / len(err_t)
+    return np.mean(acc), acc, acc_q, acc_t
 
 def EvaluateSubmission(predictions, input_dir, scaling_dict, thresholds_q, thresholds_t, output_dir=None):
     '''Evaluate a prediction file against the ground truth.
@@ -123,35 +212,39 @@ def EvaluateSubmission(predictions, input_dir, scaling_dict, thresholds_q, thres
         if scene not in scenes:
             scenes += [scene]
 
-    # Load the ground truth.
+    # Load the ground truth, parsed once per scene and cached (see calibration_store.py).
+    store = get_store(input_dir)
     calib_dict = {}
     for scene in scenes:
-        calib_dict[scene] = LoadCalibration(os.path.join(input_dir, scene, "calibration.csv"))
+        calib_dict[scene] = store.scene(scene)
 
-    errors_dict_q = {scene: {} for scene in scenes}
-    errors_dict_t = {scene: {} for scene in scenes}
-    for prediction_key, F_predicted in predictions.items():
-        dataset, scene, pair = prediction_key.split(';')
+    # All predictions are evaluated at once, as stacks of 3x3 matrices. This gives the same errors as evaluating them
+    # one by one with DecomposeFundamentalMatrixWithIntrinsics, QuaternionFromMatrix and ComputeErrorForOneExample.
+    keys = [prediction_key.split(';') for prediction_key in predictions.keys()]
+    pairs_by_scene = {scene: ([], [], []) for scene in scenes}
+    for i, (dataset, scene, pair) in enumerate(keys):
         image_id_1, image_id_2 = pair.split('-')
+        positions, image_ids_1, image_ids_2 = pairs_by_scene[scene]
+        positions.append(i)
+        image_ids_1.append(image_id_1)
+        image_ids_2.append(image_id_2)
+    F_predicted = np.array(list(predictions.values()), dtype=np.float64).reshape((-1, 3, 3))
+    K1, R1_gt, K2, R2_gt = (np.empty((len(keys), 3, 3)) for _ in range(4))
+    T1_gt, T2_gt = (np.empty((len(keys), 3, 1)) for _ in range(2))
+    for scene, (positions, image_ids_1, image_ids_2) in pairs_by_scene.items():
+        calib = calib_dict[scene]
+        index_1, index_2 = calib.indices(image_ids_1), calib.indices(image_ids_2)
+        K1[positions], R1_gt[positions], T1_gt[positions, :, 0] = calib.K[index_1], calib.R[index_1], calib.T[index_1]
+        K2[positions], R2_gt[positions], T2_gt[positions, :, 0] = calib.K[index_2], calib.R[index_2], calib.T[index_2]
+    scale = np.array([scaling_dict[scene] for dataset, scene, pair in keys], dtype=np.float64)
+
+    err_q, err_t = ComputePoseErrors(F_predicted, K1, R1_gt, T1_gt, K2, R2_gt, T2_gt, scale)
 
-        K1, R1_gt, T1_gt = calib_dict[scene][image_id_1].K, calib_dict[scene][image_id_1].R, calib_dict[scene][image_id_1].T.reshape((3, 1))
-        K2, R2_gt, T2_gt = calib_dict[scene][image_id_2].K, calib_dict[scene][image_id_2].R, calib_dict[scene][image_id_2].T.reshape((3, 1))
-
-        R_pred_a, R_pred_b, T_pred = DecomposeFundamentalMatrixWithIntrinsics(F_predicted, K1, K2)
-        q_pred_a = QuaternionFromMatrix(R_pred_a)
-        q_pred_b = QuaternionFromMatrix(R_pred_b)
-
-        dR_gt = np.dot(R2_gt, R1_gt.T)
-        dT_gt = (T2_gt - np.dot(dR_gt, T1_gt)).flatten()
-        q_gt = QuaternionFromMatrix(dR_gt)
-        q_gt = q_gt / (np.linalg.norm(q_gt) + eps)
-
-        # blah blah cheirality...
-        err_q_a, err_t_a = ComputeErrorForOneExample(q_gt, dT_gt, q_pred_a, T_pred, scaling_dict[scene])
-        err_q_b, err_t_b = ComputeErrorForOneExample(q_gt, dT_gt, q_pred_b, T_pred, scaling_dict[scene])
-        assert err_t_a == err_t_b
-        errors_dict_q[scene][pair] = min(err_q_a, err_q_b)
-        errors_dict_t[scene][pair] = err_t_a
+    errors_dict_q = {scene: {} for scene in scenes}
+    errors_dict_t = {scene: {} for scene in scenes}
+    for (dataset, scene, pair), e_q, e_t in zip(keys, err_q, err_t):
+        errors_dict_q[scene][pair] = e_q
+        errors_dict_t[scene][pair] = e_t
 
     # Aggregate the results by computing the final metric for each scene, and then averaging across all scenes.
     maa_per_scene = {}
@@ -159,46 +252,140 @@ def EvaluateSubmission(predictions, input_dir, scaling_dict, thresholds_q, thres
         maa_per_scene[scene], _, _, _ = ComputeMaa(list(errors_dict_q[scene].values()), list(errors_dict_t[scene].values()), thresholds_q, thresholds_t)
 
     if output_dir is not None:
-        scene_list = []
-        pair_list = []
-        maa_list = []
-        for prediction_key, F_predicted in predictions.items():
-            dataset, scene, pair = prediction_key.split(';')
-            image_id_1, image_id_2 = pair.split('-')
+        WriteValidationAll(keys, errors_dict_q, errors_dict_t, thresholds_q, thresholds_t, output_dir)
+
+    return np.mean(list(maa_per_scene.values())), maa_per_scene, errors_dict_q, errors_dict_t
+
+def WriteValidationAll(keys, errors_dict_q, errors_dict_t, thresholds_q, thresholds_t, output_dir):
+    '''Write the mAA of every single pair to validation_all.csv, in the order of the split prediction keys.'''
+
+    scene_list = [scene for dataset, scene, pair in keys]
+    pair_list = [pair for dataset, scene, pair in keys]
+    e_q = np.array([errors_dict_q[scene][pair] for scene, pair in zip(scene_list, pair_list)])
+    e_t = np.array([errors_dict_t[scene][pair] for scene, pair in zip(scene_list, pair_list)])
+
+    # The mAA of every single pair is the fraction of the thresholds it is within.
+    below, _, _ = ComputeAccuracies(e_q, e_t, thresholds_q, thresholds_t)
+    maa_list = np.mean(below.astype(np.float64), axis=0)
 
-            e_dict_q = errors_dict_q[scene][pair]
-            e_dict_t = errors_dict_t[scene][pair]
+    df = pd.DataFrame({"scene":scene_list, "pair":pair_list, "maa":maa_list})
+    outpur_csv = os.path.join(output_dir, "validation_all.csv")
+    df.to_csv(outpur_csv, index=False)
 
-            maa_pair, _, _, _ = ComputeMaa([e_dict_q], [e_dict_t], thresholds_q, thresholds_t)
+def EvaluateSubmissionParallel(predictions, input_dir, scaling_dict, thresholds_q, thresholds_t, output_dir=None,
+                               processes=None, executor=None):
+    '''EvaluateSubmission with the scenes evaluated in parallel in a process pool, with the same results.
 
-            scene_list.append(scene)
-            pair_list.append(pair)
-            maa_list.append(maa_pair)
+    The predictions are split by scene and every scene is evaluated by EvaluateSubmission in a worker, largest scene
+    first. Pass an executor (e.g. a ProcessPoolExecutor) to reuse its processes over many calls, as in a
+    hyperparameter sweep; otherwise a pool of processes workers (default: one per CPU) is started for this call.'''
 
-        df = pd.DataFrame({"scene":scene_list, "pair":pair_list, "maa":maa_list})
-        outpur_csv = os.path.join(output_dir, "validation_all.csv")
-        df.to_csv(outpur_csv, index=False)
+    predictions_by_scene = {}
+    for prediction_key, F_predicted in predictions.items():
+        dataset, scene, pair = prediction_key.split(';')
+        predictions_by_scene.setdefault(scene, {})[prediction_key] = F_predicted
+
+    pool = executor or ProcessPoolExecutor(processes or os.cpu_count(), mp_context=mp.get_context('spawn'))
+    try:
+        scenes = sorted(predictions_by_scene, key=lambda scene: len(predictions_by_scene[scene]), reverse=True)
+        futures = {scene: pool.submit(EvaluateSubmission, predictions_by_scene[scene], input_dir,
+                                      {scene: scaling_dict[scene]}, thresholds_q, thresholds_t) for scene in scenes}
+        results = {scene: future.result() for scene, future in futures.items()}
+    finally:
+        if executor is None:
+            pool.shutdown()
+
+    # Merged in the order the scenes first appear in the predictions, as in EvaluateSubmission
+    maa_per_scene, errors_dict_q, errors_dict_t = {}, {}, {}
+    for scene in predictions_by_scene:
+        _, scene_maa, scene_errors_q, scene_errors_t = results[scene]
+        maa_per_scene.update(scene_maa)
+        errors_dict_q.update(scene_errors_q)
+        errors_dict_t.update(scene_errors_t)
+
+    if output_dir is not None:
+        keys = [prediction_key.split(';') for prediction_key in predictions.keys()]
+        WriteValidationAll(keys, errors_dict_q, errors_dict_t, thresholds_q, thresholds_t, output_dir)
 
     return np.mean(list(maa_per_scene.values())), maa_per_scene, errors_dict_q, errors_dict_t
 
-def evaluate(input_dir, sample_id_list, fund_matrix_list):
+class MaaAccumulator:
+    '''Running mAA of predictions that arrive one at a time, e.g. while LoFTR.py is still matching. Every prediction
+    updates the counts of its scene at each threshold in constant time, so the score is available at any moment and is
+    the same as evaluate() of all predictions added so far. A sample id added again replaces its earlier prediction.
+
+    Example:
+        >>> accumulator = MaaAccumulator(input_dir)
+        >>> accumulator.add('phototourism;brandenburg_gate;00883281_9633489441-01241436_8458479929', F)
+        >>> accumulator.maa(), accumulator.maa_per_scene()'''
+
+    def __init__(self, input_dir, thresholds_q=None, thresholds_t=None):
+        self.thresholds_q = np.linspace(1, 10, 10) if thresholds_q is None else np.asarray(thresholds_q)
+        self.thresholds_t = np.geomspace(0.2, 5, 10) if thresholds_t is None else np.asarray(thresholds_t)
+        self.store = get_store(input_dir)
+        self.scaling_dict = self.store.scaling_factors()
+        # Per scene: number of pairs within each threshold, and which thresholds every pair is within
+        self.counts = {}
+        self.below = {}
+
+    def __len__(self):
+        return sum(len(below) for below in self.below.values())
+
+    def add(self, sample_id, fund_matrix):
+        '''Add the prediction for one pair, with the fundamental matrix as a 3x3 array or as a string as in evaluate.
+        Returns its rotation and translation errors.'''
+
+        if isinstance(fund_matrix, str):
+            fund_matrix = [float(v) for v in fund_matrix.split(' ')]
+        dataset, scene, pair = sample_id.split(';')
+        image_id_1, image_id_2 = pair.split('-')
+        calib = self.store.scene(scene)
+        index_1, index_2 = calib.indices([image_id_1]), calib.indices([image_id_2])
+        err_q, err_t = ComputePoseErrors(np.asarray(fund_matrix, dtype=np.float64).reshape((1, 3, 3)),
+                                         calib.K[index_1], calib.R[index_1], calib.T[index_1, :, None],
+                                         calib.K[index_2], calib.R[index_2], calib.T[index_2, :, None],
+                                         np.array([self.scaling_dict[scene]], dtype=np.float64))
+        below = ComputeAccuracies(err_q, err_t, self.thresholds_q, self.thresholds_t)[0][:, 0]
+
+        counts = self.counts.setdefault(scene, np.zeros(len(self.thresholds_q), dtype=np.int64))
+        scene_below = self.below.setdefault(scene, {})
+        if pair in scene_below:
+            counts -= scene_below[pair]
+        scene_below[pair] = below
+        counts += below
+        return err_q[0], err_t[0]
+
+    def maa_per_scene(self):
+        return {scene: np.mean(counts / len(self.below[scene])) for scene, counts in self.counts.items()}
+
+    def maa(self):
+        # Mean over the scenes, as in EvaluateSubmission; nan before the first prediction
+        maa_per_scene = self.maa_per_scene()
+        return np.mean(list(maa_per_scene.values())) if maa_per_scene else np.nan
+
+def evaluate(input_dir, sample_id_list, fund_matrix_list, processes=1, executor=None):
+    # With processes > 1 or an executor, the scenes are evaluated in parallel (see EvaluateSubmissionParallel).
     thresholds_q = np.linspace(1, 10, 10)
     thresholds_t = np.geomspace(0.2, 5, 10)
 
-    # Load per-scene scaling factors.
-    scaling_dict = {}
-    with open(os.path.join(input_dir, f"scaling_factors.csv")) as f:
-        reader = csv.reader(f, delimiter=',')
-        for i, row in enumerate(reader):
-            # Skip header.
-            if i == 0:
-                continue
-            scaling_dict[row[0]] = float(row[1])
+    # Load per-scene scaling factors, read once per process.
+    scaling_dict = get_store(input_dir).scaling_factors()
 
     predictions = {}
     for sample_id, fundamental_matrix in zip(sample_id_list, fund_matrix_list):
         predictions[sample_id] = np.array([float(v) for v in fundamental_matrix.split(' ')]).reshape([3, 3])
 
+    if processes > 1 or executor is not None:
+        maa, _, _, _ = EvaluateSubmissionParallel(
+            predictions,
+            input_dir,
+            scaling_dict,
+            thresholds_q,
+            thresholds_t,
+            processes=processes,
+            executor=executor)
+        return maa
+
     maa, _, _, _ = EvaluateSubmission(
         predictions,
         input_dir,
@@ -212,15 +399,8 @@ def evaluate_single(input_dir, sample_id, fund_matrix):
     thresholds_q = np.linspace(1, 10, 10)
     thresholds_t = np.geomspace(0.2, 5, 10)
 
-    # Load per-scene scaling factors.
-    scaling_dict = {}
-    with open(os.path.join(input_dir, f"scaling_factors.csv")) as f:
-        reader = csv.reader(f, delimiter=',')
-        for i, row in enumerate(reader):
-            # Skip header.
-            if i == 0:
-                continue
-            scaling_dict[row[0]] = float(row[1])
+    # Load per-scene scaling factors, read once per process.
+    scaling_dict = get_store(input_dir).scaling_factors()
 
     predictions = {}
     predictions[sample_id] = np.array([float(v) for v in fund_matrix.split(' ')]).reshape([3, 3])
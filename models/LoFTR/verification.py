@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+from collections import namedtuple
+from functools import partial
+from pipeline import map_ordered
+from instrumentation import span, timed_call
+
+# Geometric verification of the LoFTR matches: robust estimation of the fundamental matrix and its inliers.
+
+RansacParams = namedtuple('RansacParams', ['method', 'threshold', 'confidence', 'max_iters'])
+
+# Settings of the adaptive mode (see find_fundamental_matrix_adaptive):
+#   min_conf        Drop matches with a lower LoFTR confidence
+#   max_matches     Keep at most this many matches, spread over the image by spatially uniform subsampling
+#   grid            The uniform subsampling keeps the most confident matches per cell of a grid x grid raster
+#   probe_iters     Iteration budget of the first, cheap estimation that measures the inlier ratio
+#   min_iters       Lower bound for the iteration budget derived from the inlier ratio
+AdaptiveParams = namedtuple('AdaptiveParams', ['min_conf', 'max_matches', 'grid', 'probe_iters', 'min_iters'])
+
+RANSAC_METHODS = {
+    'magsac': cv2.USAC_MAGSAC,
+    'usac_default': cv2.USAC_DEFAULT,
+    'usac_accurate': cv2.USAC_ACCURATE,
+    'usac_fast': cv2.USAC_FAST,
+    'ransac': cv2.FM_RANSAC,
+    'lmeds': cv2.FM_LMEDS,
+}
+
+# The settings LoFTR.py always used
+DEFAULT_RANSAC = RansacParams(method='magsac', threshold=0.2, confidence=0.99999, max_iters=50000)
+
+DEFAULT_ADAPTIVE = AdaptiveParams(min_conf=0.2, max_matches=2000, grid=16, probe_iters=1000, min_iters=100)
+
+# Minimal sample size of the fundamental matrix (7-point algorithm)
+SAMPLE_SIZE = 7
+
+def find_fundamental_matrix(mkpts0, mkpts1, params=DEFAULT_RANSAC):
+    """
+    Estimate the fundamental matrix between two sets of matched keypoints.
+
+    Returns:
+        F:              3x3 fundamental matrix, all zeros if there are too few matches or the estimation failed
+        inliers:        Boolean inlier mask with one entry per match
+    """
+    if len(mkpts0) < 8:
+        return np.zeros((3, 3)), np.zeros(len(mkpts0), dtype=bool)
+    F, mask = cv2.findFundamentalMat(mkpts0, mkpts1, RANSAC_METHODS[params.method], params.threshold,
+                                     params.confidence, params.max_iters)
+    if F is None or F.shape[0] < 3:
+        return np.zeros((3, 3)), np.zeros(len(mkpts0), dtype=bool)
+    # Some methods return several stacked solutions, the first one is the best.
+    return F[:3], mask.ravel().astype(bool)
+
+def uniform_subsample(mkpts0, mconf, max_matches, grid):
+    """
+    Indices of at most max_matches matches, spread evenly over image0.
+
+    Matches are ranked by confidence within each cell of a grid x grid raster over their bounding box, and taken
+    round-robin by rank, so that every cell contributes its best matches first.
+    """
+    if len(mkpts0) <= max_matches:
+        return np.arange(len(mkpts0))
+    lo, hi = mkpts0.min(axis=0), mkpts0.max(axis=0)
+    cell_xy = np.minimum(((mkpts0 - lo) / (hi - lo + 1e-9) * grid).astype(np.int64), grid - 1)
+    cell = cell_xy[:, 1] * grid + cell_xy[:, 0]
+    # Sort by cell, then by descending confidence; the rank is the position within the cell.
+    order = np.lexsort((-mconf, cell))
+    sorted_cell = cell[order]
+    first_of_cell = np.searchsorted(sorted_cell, sorted_cell, side='left')
+    rank = np.arange(len(order)) - first_of_cell
+    chosen = order[np.lexsort((-mconf[order], rank))[:max_matches]]
+    return np.sort(chosen)
+
+def required_iterations(inlier_ratio, confidence, max_iters, min_iters=1):
+    # Standard RANSAC bound: iterations needed to draw one all-inlier sample with the given confidence.
+    if inlier_ratio <= 0:
+        return max_iters
+    p_good_sample = inlier_ratio ** SAMPLE_SIZE
+    if p_good_sample >= 1:
+        return min_iters
+    n = np.log(1 - confidence) / np.log(1 - p_good_sample)
+    return int(np.clip(np.ceil(n), min_iters, max_iters))
+
+def epipolar_inliers(F, mkpts0, mkpts1, threshold):
+    # Matches whose distance to the epipolar line is below threshold in both images
+    pts0 = np.hstack([mkpts0, np.ones((len(mkpts0), 1))])
+    pts1 = np.hstack([mkpts1, np.ones((len(mkpts1), 1))])
+    lines1 = pts0 @ F.T
+    lines0 = pts1 @ F
+    residual = np.abs(np.sum(pts1 * lines1, axis=1))
+    d1 = residual / (np.linalg.norm(lines1[:, :2], axis=1) + 1e-12)
+    d0 = residual / (np.linalg.norm(lines0[:, :2], axis=1) + 1e-12)
+    return np.maximum(d0, d1) <= threshold
+
+def find_fundamental_matrix_adaptive(mkpts0, mkpts1, mconf, params=DEFAULT_RANSAC, adaptive=DEFAULT_ADAPTIVE):
+    """
+    Estimate the fundamental matrix with pre-filtered matches and an iteration budget adapted to the pair.
+
+    The matches are filtered by confidence and subsampled to at most adaptive.max_matches evenly spread matches.
+    A first estimation with adaptive.probe_iters iterations measures the inlier ratio. If the RANSAC bound for that
+    ratio is within the probe budget, the probe result is kept (early termination); otherwise the estimation is
+    repeated with the bound as iteration budget, capped by params.max_iters.
+
+    Returns:
+        F:              3x3 fundamental matrix, all zeros if there are too few matches or the estimation failed
+        inliers:        Boolean inlier mask over all input matches, by epipolar distance to F
+    """
+    keep = np.flatnonzero(mconf >= adaptive.min_conf)
+    keep = keep[uniform_subsample(mkpts0[keep], mconf[keep], adaptive.max_matches, adaptive.grid)]
+    probe = params._replace(max_iters=min(adaptive.probe_iters, params.max_iters))
+    F, mask = find_fundamental_matrix(mkpts0[keep], mkpts1[keep], probe)
+    if not F.any():
+        return F, np.zeros(len(mkpts0), dtype=bool)
+    n_iters = required_iterations(mask.mean(), params.confidence, params.max_iters, adaptive.min_iters)
+    if n_iters > probe.max_iters:
+        F_full, mask_full = find_fundamental_matrix(mkpts0[keep], mkpts1[keep], params._replace(max_iters=n_iters))
+        if mask_full.sum() >= mask.sum():
+            F = F_full
+    return F, epipolar_inliers(F, mkpts0, mkpts1, params.threshold)
+
+def verify_matches(mkpts0, mkpts1, mconf, params=DEFAULT_RANSAC, adaptive=None):
+    # Fixed-budget estimation, or the adaptive mode if adaptive settings are given.
+    if adaptive is None:
+        return find_fundamental_matrix(mkpts0, mkpts1, params)
+    return find_fundamental_matrix_adaptive(mkpts0, mkpts1, mconf, params, adaptive)
+
+def iter_verified(matches, params=DEFAULT_RANSAC, threads=0, processes=0, stats=None, adaptive=None, trace=None,
+                  executor=None):
+    """
+    Run the geometric verification for a stream of matches.
+
+    Args:
+        matches:        Iterable of (pair index, mkpts0, mkpts1, mconf)
+        params:         RansacParams
+        threads:        Verify in a thread pool of this size while the matches of the next pairs are computed
+        processes:      Verify in a process pool of this size instead (takes precedence over threads). Only the
+                        match arrays are sent to the processes.
+        stats:          Optional pipeline.StageStats of the verification stage
+        adaptive:       AdaptiveParams to use find_fundamental_matrix_adaptive instead of the fixed budget
+        trace:          Optional instrumentation.PairTrace, records a 'ransac' span per pair
+        executor:       Pool of the threads or processes (see pipeline.make_pool), to reuse it over several calls
+
+    Yields:
+        (pair index, mkpts0, mkpts1, mconf, F, inliers), in the order of matches
+    """
+    verify = partial(verify_matches, params=params, adaptive=adaptive)
+    if threads == 0 and processes == 0:
+        for i, mkpts0, mkpts1, mconf in matches:
+            with span(trace, 'ransac', i):
+                F, inliers = verify(mkpts0, mkpts1, mconf)
+            yield i, mkpts0, mkpts1, mconf, F, inliers
+        return
+    if trace is not None:
+        # The pool times every call itself, so the span covers the estimation and not the wait in the queue.
+        verify = partial(timed_call, verify)
+    verified = map_ordered(verify, matches, processes or threads, stats, processes=processes > 0,
+                           args=lambda m: m[1:], executor=executor)
+    for (i, mkpts0, mkpts1, mconf), result in verified:
+        if trace is not None:
+            result, (start_time, seconds, pid, tid) = result
+            trace.record('ransac', start_time, seconds, i, pid=pid, tid=tid)
+        F, inliers = result
+        yield i, mkpts0, mkpts1, mconf, F, inliers